@@ -37,6 +37,10 @@
 # Author: Guillaume Pellerin <yomguy@parisson.com>
 
 import os
+import time
+import json
+import heapq
+import random
 import shout
 import Queue
 import datetime
@@ -44,29 +48,80 @@ import mimetypes
 import hashlib
 from threading import Thread
 from deefuzzer.station import *
+from deefuzzer.engine import *
+from deefuzzer.shard import *
 from deefuzzer.tools import *
 
 mimetypes.add_type('application/x-yaml', '.yaml')
 
+# The options of the deefuzzer section applied by a reload
+RELOAD_OPTIONS = ('station', 'stationconfig', 'stationfolder', 'stationdefaults')
+
+# The station options a running station applies without reconnecting, by
+# section, None for the whole section
+LIVE_OPTIONS = {'jingles': None, 'feeds': None, 'rss': None, 'media': ('shuffle',)}
+
 
 class DeeFuzzer(Thread):
     """a DeeFuzzer diffuser"""
 
     logger = None
     m3u = None
+    mount_index = None
+    mounts_changed = False
     rss = None
     station_settings = []
     station_instances = {}
+    station_names = {}
+    station_mounts = {}
     watch_folder = {}
+    folder_scanner = None
     log_queue = Queue.Queue()
     main_loop = False
     ignore_errors = False
     max_retry = 0
+    io_workers = 4
+    engine = 'thread'
+    engine_threads = 1
+    engine_workers = 8
+    processes = 1
+    media_index = None
+    rescan_interval = 5
+    restart_delay = 1
+    restart_max_delay = 300
+    restart_reset_time = 60
+    replace_timeout = 10
+    shard = None
+    shards = []
+    control_queue = None
+    metrics_host = '127.0.0.1'
+    metrics_port = 0
+    metrics_file = None
+    metrics_interval = 10
+    control_socket = None
+    profile_dir = None
+    profile_interval = None
+    supervisor = None
+    auto_reload = False
+    reload_requested = False
+    conf_errors = 0
+    station_conf_cache = None
 
-    def __init__(self, conf_file):
+    def __init__(self, conf_file, shard=None, log_queue=None):
         Thread.__init__(self)
         self.conf_file = conf_file
         self.conf = get_conf_dict(self.conf_file)
+        self.station_settings = []
+        self.station_instances = {}
+        self.station_names = {}
+        self.station_mounts = {}
+        self.shard_metrics = {}
+        self.served_files = {}
+        self.written_files = {}
+        self.shard = shard
+        if log_queue is not None:
+            # Worker process: the supervisor writes the logs
+            self.log_queue = log_queue
 
         if 'deefuzzer' not in self.conf:
             return
@@ -76,39 +131,113 @@ class DeeFuzzer(Thread):
         self.log_dir = os.sep.join(log_file.split(os.sep)[:-1])
         if not os.path.exists(self.log_dir) and self.log_dir:
             os.makedirs(self.log_dir)
-        self.logger = QueueLogger(log_file, self.log_queue)
-        self.logger.start()
-        print self.conf['deefuzzer']
+        # The parsed station config files are cached next to the log by default
+        self.conf_cache = os.path.join(self.log_dir, 'stationconfig.cache') if self.log_dir else ''
+        conf_cache = self.conf['deefuzzer'].pop('confcache', self.conf_cache)
+        # An empty value disables the cache
+        self.conf_cache = str(conf_cache) if conf_cache else ''
+        self.conf_workers = int(self.conf['deefuzzer'].pop('confworkers', 0))
+        if log_queue is None:
+            self.logger = QueueLogger(log_file, self.log_queue)
+            self.logger.start()
+            print self.conf['deefuzzer']
+        self.open_conf_cache()
         for key in self.conf['deefuzzer'].keys():
             if key == 'm3u':
                 self.m3u = str(self.conf['deefuzzer'][key])
 
+            elif key == 'mountindex':
+                # JSON file describing the mounts of all the stations
+                self.mount_index = str(self.conf['deefuzzer'][key])
+
+            elif key == 'mediaindex':
+                # SQLite file caching the metadata of the media of all the stations
+                self.media_index = str(self.conf['deefuzzer'][key])
+
             elif key == 'ignoreerrors':
                 # Ignore errors and continue as long as possible
                 self.ignore_errors = bool(self.conf['deefuzzer'][key])
 
-            elif key == 'max_retry':
+            elif key == 'max_retry' or key == 'maxretry':
                 # Maximum number of attempts to restart the stations on crash.
                 self.max_retry = int(self.conf['deefuzzer'][key])
 
-            elif key == 'station':
-                # Load station definitions from the main config file
-                if not isinstance(self.conf['deefuzzer'][key], list):
-                    self.add_station(self.conf['deefuzzer'][key])
-                else:
-                    for s in self.conf['deefuzzer'][key]:
-                        self.add_station(s)
+            elif key == 'ioworkers':
+                # Maximum number of concurrent disk accesses for all the stations
+                self.io_workers = int(self.conf['deefuzzer'][key])
+
+            elif key == 'rescaninterval':
+                # Seconds between two scans of the station folders and configs
+                self.rescan_interval = float(self.conf['deefuzzer'][key])
+
+            elif key == 'restartdelay':
+                # First delay before restarting a crashed station, doubled on each retry
+                self.restart_delay = float(self.conf['deefuzzer'][key])
+
+            elif key == 'restartmaxdelay':
+                # Upper bound of the station restart delay
+                self.restart_max_delay = float(self.conf['deefuzzer'][key])
+
+            elif key == 'processes':
+                # Number of worker processes sharing the stations, 0 for one per core
+                self.processes = int(self.conf['deefuzzer'][key])
+
+            elif key == 'engine':
+                # 'thread' runs one thread per station, 'loop' runs the icecast
+                # stations as coroutines on a few event loop threads
+                self.engine = str(self.conf['deefuzzer'][key]['mode'])
+                if 'threads' in self.conf['deefuzzer'][key]:
+                    self.engine_threads = int(self.conf['deefuzzer'][key]['threads'])
+                if 'workers' in self.conf['deefuzzer'][key]:
+                    self.engine_workers = int(self.conf['deefuzzer'][key]['workers'])
+
+            elif key == 'metrics':
+                # Station metrics served over HTTP and written to a JSON file
+                options = self.conf['deefuzzer'][key]
+                if 'host' in options:
+                    self.metrics_host = str(options['host'])
+                if 'port' in options:
+                    self.metrics_port = int(options['port'])
+                if 'file' in options:
+                    self.metrics_file = str(options['file'])
+                if 'interval' in options:
+                    self.metrics_interval = float(options['interval'])
+
+            elif key == 'chunkcache':
+                # Memory shared by the stations of the process to cache the media blocks
+                options = self.conf['deefuzzer'][key]
+                if 'size' in options:
+                    set_chunk_cache(int(float(options['size']) * 0x100000))
+
+            elif key == 'controlsocket':
+                # Local UNIX socket taking commands, like 'profile 30 my_station'
+                self.control_socket = str(self.conf['deefuzzer'][key])
+
+            elif key == 'autoreload':
+                # Reload the stations when the config files change
+                self.auto_reload = bool(int(self.conf['deefuzzer'][key]))
+
+            elif key == 'profiler':
+                # Folder and sampling interval of the profiles
+                options = self.conf['deefuzzer'][key]
+                if 'dir' in options:
+                    self.profile_dir = str(options['dir'])
+                if 'interval' in options:
+                    self.profile_interval = float(options['interval'])
 
-            elif key == 'stationconfig':
-                # Load additional station definitions from the requested folder
-                self.load_stations_fromconfig(self.conf['deefuzzer'][key])
+            elif key == 'station' or key == 'stationconfig':
+                self.add_stations_option(key, self.conf['deefuzzer'][key])
 
             elif key == 'stationfolder':
                 # Create stations automagically from a folder structure
                 if isinstance(self.conf['deefuzzer'][key], dict):
-                    self.watch_folder = self.conf['deefuzzer'][key]
+                    self.watch_folder = copy_conf(self.conf['deefuzzer'][key])
             else:
                 setattr(self, key, self.conf['deefuzzer'][key])
+        self.close_conf_cache()
+
+        if self.shard is not None:
+            return
 
         # Set the deefuzzer logger
         self._info('Starting DeeFuzzer')
@@ -128,20 +257,209 @@ class DeeFuzzer(Thread):
     def _err(self, msg):
         self._log('err', msg)
 
+    def owns_station(self, i):
+        """Returns whether the station at index i is run by this process"""
+        if self.shard is None:
+            return True
+        return shard_owner(station_key(i, self.station_settings[i]), self.shards) == self.shard
+
+    def read_control(self):
+        """Applies the messages sent by the shard supervisor"""
+        if self.control_queue is None:
+            return
+        while True:
+            try:
+                command, value = self.control_queue.get_nowait()
+            except Queue.Empty:
+                return
+            if command == 'shards':
+                self.shards = value
+                # The first shard writes the playlist
+                self.mounts_changed = True
+                self._info('Shard %d now shares the stations with shards %s' % (self.shard, value))
+            elif command == 'profile':
+                seconds, name = value
+                if name is None or self.find_station(name) is not None:
+                    self.profile(seconds, name)
+            elif command == 'reload':
+                self.reload_requested = True
+
+    def find_station(self, name):
+        """Returns the running station with the given name, short name or mountpoint"""
+        for settings in self.station_settings:
+            station = settings.get('station_instance')
+            if station is None:
+                continue
+            if name in (settings.get('station_name'), station.short_name, station.channel.mount.lstrip('/')):
+                return station
+        return None
+
+    def get_profile_dir(self):
+        return self.profile_dir or self.log_dir or '.'
+
+    def profile(self, seconds, name=None):
+        """Starts the sampling profiler on a station, or on the whole process
+        if name is None.  Returns the path of the profile, or None if there is
+        no such station"""
+        target = None
+        label = 'all'
+        if name:
+            target = self.find_station(name)
+            if target is None:
+                return None
+            label = target.short_name
+        if self.shard is not None:
+            label += '_shard%d' % self.shard
+        self._info('Profiling %s for %s s' % (label, seconds))
+        return start_profiler(self.get_profile_dir(), label, seconds, target, self.profile_interval, self._info)
+
+    def control_command(self, line):
+        """Runs a command received on the control socket and returns the answer"""
+        args = line.split()
+        if args[0] == 'profile':
+            try:
+                seconds = float(args[1])
+            except (IndexError, ValueError):
+                return 'usage: profile SECONDS [STATION]'
+            if seconds <= 0:
+                return 'usage: profile SECONDS [STATION]'
+            name = ' '.join(args[2:])
+            if not name or name == 'all':
+                name = None
+            if self.supervisor:
+                # The stations run in the worker processes
+                self.supervisor.broadcast('profile', (seconds, name))
+                return 'profiling in the worker processes, see %s' % self.get_profile_dir()
+            path = self.profile(seconds, name)
+            if path is None:
+                return 'error: no running station named %s' % name
+            return path
+        if args[0] == 'reload':
+            self.request_reload()
+            return 'reloading ' + self.conf_file
+        return 'error: unknown command %s' % args[0]
+
+    def start_control_socket(self):
+        if not self.control_socket:
+            return
+        try:
+            ControlSocket(self.control_socket, self.control_command).start()
+            self._info('Listening to commands on ' + self.control_socket)
+        except Exception, e:
+            self._err('Could not open the control socket: %s' % str(e))
+
+    def get_metrics(self):
+        """Returns the metrics of the stations of this process and the last
+        ones sent by the worker processes"""
+        stations = []
+        for settings in self.station_settings:
+            station = settings.get('station_instance')
+            if station is not None:
+                stations.append(station.get_metrics())
+        for shard in sorted(self.shard_metrics.keys()):
+            stations.extend(self.shard_metrics[shard])
+        metrics = {'time': time.time(), 'stations': stations}
+        cache = get_chunk_cache()
+        if cache is not None:
+            metrics['chunk_cache'] = cache.stats()
+        return metrics
+
+    def start_metrics(self):
+        """Starts the metrics HTTP endpoint and snapshot file, if configured"""
+        if not self.metrics_port and not self.metrics_file:
+            return
+        try:
+            MetricsExporter(self.get_metrics, self.metrics_host, self.metrics_port,
+                            self.metrics_file, self.metrics_interval, self._err,
+                            self.served_files).start()
+        except Exception, e:
+            self._err('Could not start the metrics endpoint: %s' % str(e))
+            return
+        if self.metrics_port:
+            self._info('Serving metrics on http://%s:%d/metrics' % (self.metrics_host, self.metrics_port))
+
+    def send_metrics(self):
+        """Sends the metrics of the stations of a worker process to the supervisor"""
+        if self.metrics_port or self.metrics_file:
+            self.log_queue.put({'shard': self.shard, 'metrics': self.get_metrics()['stations']})
+
+    def get_mounts(self):
+        """Returns the name, the stream URL and the mirror URLs of the stations"""
+        defaults = self.conf['deefuzzer'].get('stationdefaults')
+        mounts = []
+        for settings in self.station_settings:
+            if settings.get('station_removed'):
+                continue
+            # The stations run by other processes are not merged with the defaults
+            station = self.get_effective_conf(settings.get('station_conf', settings), defaults)
+            try:
+                urls = []
+                for server in [station['server']] + station.get('server_mirrors', []):
+                    options = dict(station['server'])
+                    options.update(server)
+                    mountpoint = options.get('mountpoint', station['infos'].get('short_name', 'default'))
+                    url = 'http://%s:%s/%s' % (options['host'], options['port'], mountpoint)
+                    if int(options.get('appendtype', 0)):
+                        url += '.' + station['media']['format']
+                    urls.append(url)
+                mounts.append({'name': station['infos']['name'],
+                               'short_name': station['infos'].get('short_name', ''),
+                               'url': urls[0],
+                               'mirrors': urls[1:],
+                               'format': station['media'].get('format', ''),
+                               'bitrate': station['media'].get('bitrate', '')})
+            except (KeyError, TypeError, ValueError, AttributeError):
+                continue
+        return mounts
+
+    def write_file_changed(self, path, data, label):
+        """Writes data to path atomically, unless the file already holds it"""
+        if path not in self.written_files:
+            try:
+                f = open(path, 'rb')
+                self.written_files[path] = f.read()
+                f.close()
+            except IOError:
+                self.written_files[path] = None
+        if self.written_files[path] == data:
+            return
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        write_file_atomic(path, data)
+        self.written_files[path] = data
+        self._info('Writing %s to : %s' % (label, path))
+
     def set_m3u_playlist(self):
-        m3u_dir = os.sep.join(self.m3u.split(os.sep)[:-1])
-        if not os.path.exists(m3u_dir) and m3u_dir:
-            os.makedirs(m3u_dir)
-        m3u = open(self.m3u, 'w')
-        m3u.write('#EXTM3U\n')
-        for station in self.station_settings:
-            m3u.write('#EXTINF:%s,%s\n' % ('-1', station['infos']['name']))
-            m3u.write('http://' + station['server']['host'] + ':' + \
-                str(station['server']['port']) + '/' + station['server']['mountpoint'] + '\n')
-        m3u.close()
-        self._info('Writing M3U file to : ' + self.m3u)
-
-    def create_stations_fromfolder(self):
+        """Generates the M3U playlist and the JSON index of the mounts of all
+        the stations.  They are written to their files when they changed, and
+        served from memory by the metrics endpoint as /playlist.m3u and
+        /mounts.json"""
+        mounts = self.get_mounts()
+        lines = ['#EXTM3U']
+        for mount in mounts:
+            lines.append('#EXTINF:-1,%s' % mount['name'])
+            lines.append(mount['url'])
+        m3u = u'\n'.join([unicode(line, 'utf-8') if isinstance(line, str) else line
+                          for line in lines]).encode('utf-8') + '\n'
+        index = json.dumps(mounts, indent=2, sort_keys=True) + '\n'
+        self.served_files['/playlist.m3u'] = ('audio/x-mpegurl', m3u)
+        self.served_files['/mounts.json'] = ('application/json', index)
+
+        if self.shard is not None and self.shard != min(self.shards):
+            # The first shard writes and sends them
+            return
+        if self.shard is not None and self.metrics_port:
+            self.log_queue.put({'shard': self.shard, 'files': dict(self.served_files)})
+        try:
+            if self.m3u:
+                self.write_file_changed(self.m3u, m3u, 'M3U file')
+            if self.mount_index:
+                self.write_file_changed(self.mount_index, index, 'mount index')
+        except Exception, e:
+            self._err('Could not write the playlist: %s' % str(e))
+
+    def create_stations_fromfolder(self, force=False):
         """Scan a folder for subfolders containing media, and make stations from them all."""
 
         options = self.watch_folder
@@ -149,7 +467,7 @@ class DeeFuzzer(Thread):
             # We have no folder specified.  Bail.
             return
 
-        if self.main_loop:
+        if self.main_loop and not force:
             if 'livecreation' not in options:
                 # We have no folder specified.  Bail.
                 return
@@ -171,26 +489,53 @@ class DeeFuzzer(Thread):
         if 'short_name' not in options['infos']:
             options['infos']['short_name'] = '[name]'
 
-        files = os.listdir(folder)
-        for file in files:
-            filepath = os.path.join(folder, file)
-            if os.path.isdir(filepath):
-                if folder_contains_music(filepath):
-                    self.create_station(filepath, options)
+        # Only the subfolders which changed since the previous scan are listed
+        if self.folder_scanner is None or self.folder_scanner.root != folder:
+            if self.folder_scanner is not None:
+                self.folder_scanner.close()
+            self.folder_scanner = FolderScanner(folder)
+        for filepath in self.folder_scanner.scan():
+            self.create_station(filepath, options)
 
     def station_exists(self, name):
+        return name in self.station_names
+
+    def get_mount_key(self, station):
+        """Returns the server and the mountpoint a station definition streams
+        to, or None if it does not tell them"""
+        server = station.get('server')
+        if not isinstance(server, dict):
+            server = {}
+        mountpoint = server.get('mountpoint')
+        if mountpoint is None and isinstance(station.get('infos'), dict):
+            mountpoint = station['infos'].get('short_name')
+        if mountpoint is None:
+            return None
+        mountpoint = str(mountpoint).strip('/')
         try:
-            for s in self.station_settings:
-                if 'infos' not in s:
-                    continue
-                if 'short_name' not in s['infos']:
-                    continue
-                if s['infos']['short_name'] == name:
-                    return True
-            return False
-        except:
+            if int(server.get('appendtype', 0)):
+                # The channel mounts mountpoint.format, as in create_channel
+                mountpoint += '.' + str(station['media']['format'])
+        except (KeyError, TypeError, ValueError):
             pass
-        return True
+        return '%s:%s/%s' % (server.get('host', ''), server.get('port', ''), mountpoint)
+
+    def register_station(self, i):
+        """Indexes the station at index i by short name and by mountpoint"""
+        settings = self.station_settings[i]
+        if isinstance(settings.get('infos'), dict) and 'short_name' in settings['infos']:
+            self.station_names.setdefault(settings['infos']['short_name'], i)
+        key = self.get_mount_key(settings)
+        if key is not None:
+            self.station_mounts.setdefault(key, i)
+
+    def index_stations(self):
+        """Indexes again all the stations which were not removed"""
+        self.station_names = {}
+        self.station_mounts = {}
+        for i, settings in enumerate(self.station_settings):
+            if not settings.get('station_removed'):
+                self.register_station(i)
 
     def create_station(self, folder, options):
         """Create a station definition for a folder given the specified options."""
@@ -207,6 +552,7 @@ class DeeFuzzer(Thread):
         if 'media' not in s:
             s['media'] = {}
         s['media']['source'] = folder
+        s['station_fromfolder'] = True
 
         self.add_station(s)
 
@@ -216,7 +562,7 @@ class DeeFuzzer(Thread):
         if isinstance(folder, dict) or isinstance(folder, list):
             # We were given a list or dictionary.  Loop though it and load em all
             for f in folder:
-                self.load_station_configs(f)
+                self.load_stations_fromconfig(f)
             return
 
         if os.path.isfile(folder):
@@ -229,17 +575,72 @@ class DeeFuzzer(Thread):
             return
 
         self._info('Loading station config files in ' + folder)
-        files = os.listdir(folder)
-        for file in files:
+        files = []
+        for file in sorted(os.listdir(folder)):
             filepath = os.path.join(folder, file)
             if os.path.isfile(filepath):
-                self.load_station_config(filepath)
+                files.append(filepath)
+        self.load_station_configs(files)
 
     def load_station_config(self, file):
         """Load station configuration(s) from a config file."""
+        self.load_station_configs([file])
+
+    def open_conf_cache(self):
+        """Loads the config cache once for all the station config files of
+        the config file"""
+        self.station_conf_cache = None
+        if self.conf_cache:
+            self.station_conf_cache = ConfCache(self.conf_cache)
+
+    def close_conf_cache(self):
+        """Saves the config cache without the files which were not loaded"""
+        cache = self.station_conf_cache
+        self.station_conf_cache = None
+        if cache is None:
+            return
+        cache.prune()
+        try:
+            cache.save()
+        except Exception, e:
+            self._err('Could not save the config cache %s: %s' % (self.conf_cache, str(e)))
+
+    def load_station_configs(self, files):
+        """Load the station configurations of config files, from the config
+        cache for the unchanged files and in parallel for the others"""
+        started = time.time()
+        results = load_conf_files(files, self.station_conf_cache, self.conf_workers)
+        cached = 0
+        for file, stationdef, seconds, from_cache, error in results:
+            if error:
+                self._err('Could not load station config file %s: %s' % (file, error))
+                self.conf_errors += 1
+                continue
+            if from_cache:
+                cached += 1
+            if self.shard is None:
+                self._info('Loaded station config file %s in %.1f ms%s' %
+                           (file, seconds * 1000, from_cache and ' (cached)' or ''))
+            self.add_station_config(stationdef)
+        if len(files) > 1 and self.shard is None:
+            self._info('Loaded %d station config files in %.2f s, %d from the cache' %
+                       (len(files), time.time() - started, cached))
+
+    def add_stations_option(self, key, value):
+        """Adds the stations of a station or stationconfig option"""
+        if key == 'station':
+            # Load station definitions from the main config file
+            if not isinstance(value, list):
+                self.add_station(value)
+            else:
+                for s in value:
+                    self.add_station(s)
+
+        elif key == 'stationconfig':
+            # Load additional station definitions from the requested folder
+            self.load_stations_fromconfig(value)
 
-        self._info('Loading station config file ' + file)
-        stationdef = get_conf_dict(file)
+    def add_station_config(self, stationdef):
         if isinstance(stationdef, dict):
             if 'station' in stationdef:
                 if isinstance(stationdef['station'], dict):
@@ -251,113 +652,440 @@ class DeeFuzzer(Thread):
     def add_station(self, this_station):
         """Adds a station configuration to the list of stations."""
         try:
-            # We should probably test to see if we're putting the same station in multiple times
-            # Same in this case probably means the same media folder, server, and mountpoint
+            if isinstance(this_station.get('server'), list):
+                # The stream is sent to the first server and mirrored to the others
+                servers = this_station['server']
+                this_station['server'] = servers[0]
+                this_station['server_mirrors'] = servers[1:]
+            # The same server and mountpoint can only be fed by one station
+            key = self.get_mount_key(this_station)
+            if key is not None and key in self.station_mounts:
+                self._err('Ignoring a second station streaming to ' + key)
+                return
+            # The definition as configured, compared to the new one on reload
+            this_station['station_conf'] = copy_conf(this_station)
             self.station_settings.append(this_station)
+            self.register_station(len(self.station_settings) - 1)
+            self.mounts_changed = True
         except Exception:
             return
 
-    def run(self):
-        q = Queue.Queue(1)
-        ns = 0
-        p = Producer(q)
-        p.start()
-        # Keep the Stations running
-        while True:
-            self.create_stations_fromfolder()
-            ns_new = len(self.station_settings)
-            print ns_new
-            if ns_new > ns:
-                self._info('Loading new stations')
-
-            for i in range(0, ns_new):
-                name = ''
-                try:
-                    if 'station_name' in self.station_settings[i]:
-                        name = self.station_settings[i]['station_name']
-
-                    if 'retries' not in self.station_settings[i]:
-                        self.station_settings[i]['retries'] = 0
-
-                    try:
-                        if 'station_instance' in self.station_settings[i]:
-                            # Check for station running here
-                            if self.station_settings[i]['station_instance'].isAlive():
-                                # Station exists and is alive.  Don't recreate.
-                                self.station_settings[i]['retries'] = 0
-                                continue
-
-                            if self.max_retry >= 0 and self.station_settings[i]['retries'] <= self.max_retry:
-                                # Station passed the max retries count is will not be reloaded
-                                if 'station_stop_logged' not in self.station_settings[i]:
-                                    self._err('Station ' + name + ' is stopped and will not be restarted.')
-                                    self.station_settings[i]['station_stop_logged'] = True
-                                continue
-
-                            self.station_settings[i]['retries'] += 1
-                            trynum = str(self.station_settings[i]['retries'])
-                            self._info('Restarting station ' + name + ' (try ' + trynum + ')')
-                    except Exception as e:
-                        self._err('Error checking status for ' + name)
-                        self._err(str(e))
-                        if not self.ignore_errors:
-                            raise
-
-                    # Apply station defaults if they exist
-                    if 'stationdefaults' in self.conf['deefuzzer']:
-                        if isinstance(self.conf['deefuzzer']['stationdefaults'], dict):
-                            self.station_settings[i] = merge_defaults(
-                                self.station_settings[i],
-                                self.conf['deefuzzer']['stationdefaults']
-                            )
-
-                    if name == '':
-                        name = 'Station ' + str(i)
-                        if 'info' in self.station_settings[i]:
-                            if 'short_name' in self.station_settings[i]['infos']:
-                                name = self.station_settings[i]['infos']['short_name']
-                                y = 1
-                                while name in self.station_instances.keys():
-                                    y += 1
-                                    name = self.station_settings[i]['infos']['short_name'] + " " + str(y)
-
-                        self.station_settings[i]['station_name'] = name
-                        namehash = hashlib.md5(name).hexdigest()
-                        self.station_settings[i]['station_statusfile'] = os.sep.join([self.log_dir, namehash])
-
-                    new_station = Station(self.station_settings[i], q, self.log_queue, self.m3u)
-                    if new_station.valid:
-                        self.station_settings[i]['station_instance'] = new_station
-                        self.station_settings[i]['station_instance'].start()
-                        self._info('Started station ' + name)
-                    else:
-                        self._err('Error validating station ' + name)
-                except Exception:
-                    self._err('Error initializing station ' + name)
-                    if not self.ignore_errors:
-                        raise
-                    continue
+    def start_station(self, i):
+        """Creates and starts the station at index i.  Returns False on failure."""
+        name = ''
+        try:
+            if 'station_name' in self.station_settings[i]:
+                name = self.station_settings[i]['station_name']
 
-                if self.m3u:
-                    self.set_m3u_playlist()
+            if 'retries' not in self.station_settings[i]:
+                self.station_settings[i]['retries'] = 0
 
-            ns = ns_new
-            self.main_loop = True
+            # Apply station defaults if they exist
+            if 'stationdefaults' in self.conf['deefuzzer']:
+                if isinstance(self.conf['deefuzzer']['stationdefaults'], dict):
+                    self.station_settings[i] = merge_defaults(
+                        self.station_settings[i],
+                        self.conf['deefuzzer']['stationdefaults']
+                    )
 
-            time.sleep(5)
-            # end main loop
+            if name == '':
+                name = 'Station ' + str(i)
+                if 'info' in self.station_settings[i]:
+                    if 'short_name' in self.station_settings[i]['infos']:
+                        name = self.station_settings[i]['infos']['short_name']
+                        y = 1
+                        while name in self.station_instances.keys():
+                            y += 1
+                            name = self.station_settings[i]['infos']['short_name'] + " " + str(y)
 
+                self.station_settings[i]['station_name'] = name
+                namehash = hashlib.md5(name).hexdigest()
+                self.station_settings[i]['station_statusfile'] = os.sep.join([self.log_dir, namehash])
 
-class Producer(Thread):
-    """a DeeFuzzer Producer master thread.  Used for locking/blocking"""
+            if self.media_index:
+                self.station_settings[i]['station_mediaindex'] = self.media_index
+            self.station_settings[i]['station_profiledir'] = self.get_profile_dir()
+            if self.profile_interval:
+                self.station_settings[i]['station_profileinterval'] = self.profile_interval
 
-    def __init__(self, q):
-        Thread.__init__(self)
-        self.q = q
+            new_station = Station(self.station_settings[i], self.io, self.log_queue, self.m3u)
+            if new_station.valid:
+                self.station_settings[i]['station_instance'] = new_station
+                self.station_settings[i]['station_start_time'] = time.time()
+                new_station.exit_callback = self.station_exit_callback(i)
+                if self.loop_engine and new_station.type == 'icecast':
+                    self.loop_engine.add(new_station)
+                else:
+                    new_station.start()
+                self._info('Started station ' + name)
+            else:
+                self._err('Error validating station ' + name)
+                return False
+        except Exception:
+            self._err('Error initializing station ' + name)
+            if not self.ignore_errors:
+                raise
+            return False
+
+        return True
+
+    def station_exit_callback(self, i):
+        """Returns the callback a station calls from its own thread when it ends"""
+        return lambda station: self.station_events.put((i, station))
+
+    def station_exited(self, i, station=None):
+        """Schedules the restart of a station which has ended or failed to start,
+        with an exponential backoff"""
+        settings = self.station_settings[i]
+        if station is not None and settings.get('station_replaced') is station:
+            # The station replaced by a reload has left the mountpoint
+            del settings['station_replaced']
+            if 'station_instance' not in settings:
+                # Not started yet by the replace_timeout timer
+                self.drop_timers(i)
+                self.schedule_start(i, 0)
+            return
+        if station is not None and settings.get('station_instance') is not station:
+            # Stale notification from a station which was already replaced
+            return
+        settings.pop('station_instance', None)
+        name = settings.get('station_name', 'Station ' + str(i))
+
+        if time.time() - settings.get('station_start_time', 0) > self.restart_reset_time:
+            # The station ran long enough, this is a new crash and not a restart loop
+            settings['retries'] = 0
+
+        if self.max_retry >= 0 and settings.get('retries', 0) >= self.max_retry:
+            self._err('Station ' + name + ' is stopped and will not be restarted.')
+            settings['station_stopped'] = True
+            return
+
+        settings['retries'] = settings.get('retries', 0) + 1
+        delay = min(self.restart_max_delay, self.restart_delay * 2 ** (settings['retries'] - 1))
+        delay *= random.uniform(0.5, 1.5)
+        self.restart_seq += 1
+        heapq.heappush(self.restart_timers, (time.time() + delay, self.restart_seq, i))
+        self._info('Restarting station %s in %.1f s (try %d)' % (name, delay, settings['retries']))
+
+    def scan_stations(self):
+        """Looks for new station definitions and starts the ones not running yet"""
+        self.create_stations_fromfolder()
+        ns_new = len(self.station_settings)
+        if ns_new > self.station_count:
+            self._info('Loading new stations')
+            self.station_count = ns_new
+
+        scheduled = set(timer[2] for timer in self.restart_timers)
+        for i in range(0, ns_new):
+            if i in scheduled or not self.owns_station(i):
+                continue
+            if 'station_instance' in self.station_settings[i]:
+                continue
+            if self.station_settings[i].get('station_stopped'):
+                # Stopped for good after too many retries
+                continue
+            if self.station_settings[i].get('station_removed'):
+                # Removed from the config by a reload
+                continue
+            if not self.start_station(i):
+                self.station_exited(i)
+
+    def request_reload(self):
+        """Asks the main loop, or the worker processes, to reload the config.
+        This is safe to call from a signal handler or another thread."""
+        if self.supervisor:
+            self.supervisor.broadcast('reload', None)
+        else:
+            self.reload_requested = True
+
+    def get_conf_signature(self):
+        """Returns the sizes and modification times of the config file and
+        of the station config files, which change when they are edited"""
+        paths = [self.conf_file]
+        folders = self.conf['deefuzzer'].get('stationconfig', [])
+        if not isinstance(folders, dict) and not isinstance(folders, list):
+            folders = [folders]
+        for folder in folders:
+            folder = str(folder)
+            if os.path.isdir(folder):
+                paths.extend([os.path.join(folder, file) for file in sorted(os.listdir(folder))])
+            else:
+                paths.append(folder)
+        signature = []
+        for path in paths:
+            try:
+                stats = os.stat(path)
+                signature.append((path, stats.st_size, stats.st_mtime))
+            except OSError:
+                signature.append((path, None, None))
+        return signature
+
+    def load_stations(self, options):
+        """Returns the station definitions of the station and stationconfig
+        options of a deefuzzer section, leaving the current ones alone"""
+        station_settings = self.station_settings
+        station_names = self.station_names
+        station_mounts = self.station_mounts
+        self.station_settings = []
+        self.station_names = {}
+        self.station_mounts = {}
+        self.conf_errors = 0
+        self.open_conf_cache()
+        try:
+            for key in options.keys():
+                self.add_stations_option(key, options[key])
+            self.close_conf_cache()
+            return self.station_settings
+        finally:
+            self.station_conf_cache = None
+            self.station_settings = station_settings
+            self.station_names = station_names
+            self.station_mounts = station_mounts
+
+    def get_definition_key(self, conf, counts):
+        """Returns the identifier matching a station definition with its new
+        version on reload: its mountpoint, numbered when it is not unique"""
+        key = station_key('', conf)
+        counts[key] = counts.get(key, 0) + 1
+        return '%s#%d' % (key, counts[key])
+
+    def get_effective_conf(self, conf, defaults):
+        if isinstance(defaults, dict):
+            return merge_defaults(conf, defaults)
+        return conf
+
+    def is_live_change(self, old, new):
+        """Returns whether a running station can go from the old to the new
+        definition without reconnecting"""
+        if 'icecast' not in new.get('server', {}).get('type', 'icecast'):
+            # Only the icecast stations apply options at the start of a track
+            return False
+        for section in set(old) | set(new):
+            if old.get(section) == new.get(section):
+                continue
+            if section not in LIVE_OPTIONS:
+                return False
+            keys = LIVE_OPTIONS[section]
+            if keys is None:
+                continue
+            if not isinstance(old.get(section), dict) or not isinstance(new.get(section), dict):
+                return False
+            for key in set(old[section]) | set(new[section]):
+                if old[section].get(key) != new[section].get(key) and key not in keys:
+                    return False
+        return True
+
+    def schedule_start(self, i, delay):
+        self.restart_seq += 1
+        heapq.heappush(self.restart_timers, (time.time() + delay, self.restart_seq, i))
+
+    def drop_timers(self, i):
+        self.restart_timers = [timer for timer in self.restart_timers if timer[2] != i]
+        heapq.heapify(self.restart_timers)
+
+    def stop_station(self, i):
+        """Stops the station at index i and returns its instance, if it was running"""
+        settings = self.station_settings[i]
+        station = settings.pop('station_instance', None)
+        if station is not None:
+            self._info('Stopping station ' + settings.get('station_name', 'Station ' + str(i)))
+            station.stop()
+        self.drop_timers(i)
+        return station
+
+    def remove_station(self, i):
+        """Stops the station at index i for good.  Its slot is kept so that
+        the indexes of the other stations do not change."""
+        self.stop_station(i)
+        self.station_settings[i]['station_removed'] = True
+
+    def replace_station(self, i, definition):
+        """Restarts the station at index i with a new definition.  It keeps
+        its name and status file, so it goes on with its playlist.  The new
+        station starts when the old one has left the mountpoint, or after
+        replace_timeout seconds."""
+        settings = self.station_settings[i]
+        station = self.stop_station(i)
+        for key in ('station_name', 'station_statusfile'):
+            if key in settings:
+                definition[key] = settings[key]
+        self.station_settings[i] = definition
+        if station is not None:
+            definition['station_replaced'] = station
+            self.schedule_start(i, self.replace_timeout)
+
+    def reconfigure_station(self, i, definition, defaults):
+        """Gives a new definition to the station at index i, which applies it
+        while it streams"""
+        settings = self.station_settings[i]
+        for key in settings.keys():
+            if key == 'retries' or key.startswith('station_'):
+                definition.setdefault(key, settings[key])
+        definition = self.get_effective_conf(definition, defaults)
+        self.station_settings[i] = definition
+        station = definition.get('station_instance')
+        if station is not None:
+            station.reconfigure(definition)
+
+    def reload(self):
+        """Reads the config file again and applies the difference between the
+        new station definitions and the current ones.  The new stations start,
+        the removed ones stop and the changed ones restart, unless only their
+        jingles, shuffle or feeds options changed: these stations go on
+        streaming and apply them at their next track.  The other options of
+        the deefuzzer section need a restart."""
+        self._info('Reloading ' + self.conf_file)
+        try:
+            conf = get_conf_dict(self.conf_file)
+            options = conf['deefuzzer']
+            for key in ('log', 'confcache', 'confworkers'):
+                options.pop(key, None)
+            definitions = self.load_stations(options)
+        except Exception, e:
+            self._err('Could not reload %s: %s' % (self.conf_file, str(e)))
+            return
+        if self.conf_errors:
+            # A station in a broken file would be taken as removed
+            self._err('Reload cancelled, %d station config files could not be loaded' % self.conf_errors)
+            return
+
+        current = self.conf['deefuzzer']
+        ignored = [key for key in set(options) | set(current)
+                   if key not in RELOAD_OPTIONS and options.get(key) != current.get(key)]
+        if ignored:
+            self._err('Restart to apply the new %s options' % ', '.join(sorted(ignored)))
+
+        old_defaults = current.get('stationdefaults')
+        new_defaults = options.get('stationdefaults')
+        running = {}
+        counts = {}
+        for i, settings in enumerate(self.station_settings):
+            if settings.get('station_removed') or settings.get('station_fromfolder'):
+                continue
+            running[self.get_definition_key(settings['station_conf'], counts)] = i
+
+        added = removed = restarted = reconfigured = 0
+        counts = {}
+        for definition in definitions:
+            i = running.pop(self.get_definition_key(definition['station_conf'], counts), None)
+            if i is None:
+                self.station_settings.append(definition)
+                added += 1
+                continue
+            old = self.get_effective_conf(self.station_settings[i]['station_conf'], old_defaults)
+            new = self.get_effective_conf(definition['station_conf'], new_defaults)
+            if old == new:
+                self.station_settings[i]['station_conf'] = definition['station_conf']
+            elif self.is_live_change(old, new):
+                self.reconfigure_station(i, definition, new_defaults)
+                reconfigured += 1
+            else:
+                self.replace_station(i, definition)
+                restarted += 1
+        for i in running.values():
+            self.remove_station(i)
+            removed += 1
+        self.index_stations()
+
+        watch_folder = options.get('stationfolder')
+        if not isinstance(watch_folder, dict):
+            watch_folder = {}
+        old_watch_folder = current.get('stationfolder')
+        if not isinstance(old_watch_folder, dict):
+            old_watch_folder = {}
+
+        # Only the options applied by a reload are replaced
+        for key in RELOAD_OPTIONS:
+            if key in options:
+                current[key] = options[key]
+            else:
+                current.pop(key, None)
+
+        if watch_folder != old_watch_folder or new_defaults != old_defaults:
+            # The stations made from the folders are made again
+            for i, settings in enumerate(self.station_settings):
+                if settings.get('station_fromfolder') and not settings.get('station_removed'):
+                    self.remove_station(i)
+                    removed += 1
+            self.index_stations()
+            self.watch_folder = copy_conf(watch_folder)
+            if self.folder_scanner is not None:
+                self.folder_scanner.close()
+                self.folder_scanner = None
+            first = len(self.station_settings)
+            self.create_stations_fromfolder(True)
+            for i in range(first, len(self.station_settings)):
+                # The time for the stations they replace to leave the mountpoints
+                self.schedule_start(i, self.restart_delay)
+                added += 1
+
+        self._info('Reloaded: %d stations added, %d removed, %d restarted, %d reconfigured' %
+                   (added, removed, restarted, reconfigured))
+        if added or removed or restarted:
+            self.mounts_changed = True
 
     def run(self):
+        self.io = IOCoordinator(self.io_workers)
+        relay_hub.logger = self._info
+        self.loop_engine = None
+        if self.engine == 'loop':
+            self.loop_engine = LoopEngine(self.engine_threads, self.engine_workers, self._err)
+            self._info('Using the event loop engine (%d threads)' % self.engine_threads)
+        self.station_events = Queue.Queue()
+        self.restart_timers = []
+        self.restart_seq = 0
+        self.station_count = 0
+        next_scan = 0
+        if self.auto_reload:
+            self.conf_signature = self.get_conf_signature()
+        if self.shard is None:
+            self.start_metrics()
+            self.start_control_socket()
+
+        # Keep the Stations running
         while True:
+            now = time.time()
+            if now >= next_scan:
+                self.read_control()
+                if self.auto_reload and not self.reload_requested:
+                    signature = self.get_conf_signature()
+                    if signature != self.conf_signature:
+                        self._info('The config files changed')
+                        self.reload_requested = True
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+                    if self.auto_reload:
+                        self.conf_signature = self.get_conf_signature()
+                self.scan_stations()
+                if self.shard is not None:
+                    self.send_metrics()
+                self.main_loop = True
+                next_scan = now + self.rescan_interval
+
+            while self.restart_timers and self.restart_timers[0][0] <= now:
+                when, seq, i = heapq.heappop(self.restart_timers)
+                if not self.owns_station(i):
+                    continue
+                if self.start_station(i):
+                    # The replaced station, if any, is not waited for anymore
+                    self.station_settings[i].pop('station_replaced', None)
+                else:
+                    self.station_exited(i)
+
+            if self.mounts_changed:
+                # Once for all the stations added or removed since the previous loop
+                self.mounts_changed = False
+                if self.m3u or self.mount_index or self.metrics_port:
+                    self.set_m3u_playlist()
+
+            # Sleep until a station ends or the next scheduled task
+            wakeup = next_scan
+            if self.restart_timers:
+                wakeup = min(wakeup, self.restart_timers[0][0])
             try:
-                self.q.put(True, True)
-            except:
+                i, station = self.station_events.get(True, max(0.01, wakeup - time.time()))
+                self.station_exited(i, station)
+            except Queue.Empty:
                 pass
+            # end main loop
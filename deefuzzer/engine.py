@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2011 Guillaume Pellerin
+
+# <yomguy@parisson.com>
+
+# This software is a computer program whose purpose is to stream audio
+# and video data through icecast2 servers.
+
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import time
+import heapq
+import Queue
+from threading import Thread
+
+
+class Blocking(object):
+    """A blocking call yielded by a station coroutine.  The event loop runs
+    it in a worker thread and resumes the coroutine with its result."""
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+
+class WorkerPool(object):
+    """A fixed set of threads running the blocking calls of the event loops"""
+
+    def __init__(self, size):
+        self.queue = Queue.Queue()
+        self.threads = []
+        for i in range(max(1, int(size))):
+            t = Thread(target=self.work)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, call, callback):
+        self.queue.put((call, callback))
+
+    def work(self):
+        while True:
+            call, callback = self.queue.get()
+            try:
+                result = call.func(*call.args)
+            except Exception, e:
+                result = e
+            callback(result)
+
+
+class EventLoop(Thread):
+    """Runs many station coroutines on one OS thread.
+
+    A coroutine yields either a number of seconds to sleep before being
+    resumed, or a Blocking call which is handed over to the worker pool."""
+
+    def __init__(self, pool, logger=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.pool = pool
+        self.logger = logger
+        self.inbox = Queue.Queue()
+        self.timers = []
+        self.seq = 0
+        self.count = 0
+
+    def add(self, station, coroutine):
+        self.count += 1
+        self.inbox.put((station, coroutine, None))
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger(msg)
+
+    def _schedule(self, when, station, coroutine, value):
+        self.seq += 1
+        heapq.heappush(self.timers, (when, self.seq, station, coroutine, value))
+
+    def _resume(self, station, coroutine, value):
+        self.inbox.put((station, coroutine, value))
+
+    def _step(self, station, coroutine, value):
+        try:
+            if isinstance(value, Exception):
+                result = coroutine.throw(value)
+            else:
+                result = coroutine.send(value)
+        except StopIteration:
+            self._finish(station)
+            return
+        except Exception, e:
+            self._log('Station ' + str(station.short_name) + ' crashed in event loop: ' + str(e))
+            self._finish(station)
+            return
+
+        if isinstance(result, Blocking):
+            self.pool.submit(result, lambda r: self._resume(station, coroutine, r))
+        else:
+            self._schedule(time.time() + (result or 0), station, coroutine, None)
+
+    def _finish(self, station):
+        self.count -= 1
+        station.engine_running = False
+        station.notify_exit()
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.timers:
+                timeout = max(0, self.timers[0][0] - time.time())
+            try:
+                if timeout is None:
+                    item = self.inbox.get(True)
+                elif timeout:
+                    item = self.inbox.get(True, timeout)
+                else:
+                    item = self.inbox.get_nowait()
+                self._step(*item)
+                while True:
+                    self._step(*self.inbox.get_nowait())
+            except Queue.Empty:
+                pass
+
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                when, seq, station, coroutine, value = heapq.heappop(self.timers)
+                self._step(station, coroutine, value)
+
+
+class LoopEngine(object):
+    """Distributes the stations over a few event loop threads sharing one
+    pool of workers for the blocking calls (playlist scans, metadata...)"""
+
+    def __init__(self, threads=1, workers=8, logger=None):
+        self.pool = WorkerPool(workers)
+        self.loops = []
+        for i in range(max(1, int(threads))):
+            loop = EventLoop(self.pool, logger)
+            loop.start()
+            self.loops.append(loop)
+
+    def add(self, station):
+        """Starts a station on the least loaded event loop"""
+        loop = min(self.loops, key=lambda l: l.count)
+        station.engine_running = True
+        loop.add(station, station.run_steps())
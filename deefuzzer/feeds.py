@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2011 Guillaume Pellerin
+
+# <yomguy@parisson.com>
+
+# This software is a computer program whose purpose is to stream audio
+# and video data through icecast2 servers.
+
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import os
+import time
+import json
+import datetime
+from xml.sax import saxutils
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+from tools import *
+
+
+class FeedBuilder(object):
+    """Renders the RSS and JSON feeds of a media list.
+
+    The rendering of each item is cached, keyed by the media identity (path,
+    size and metadata), so that a new build only formats the start and end
+    times of the items and concatenates the cached fragments."""
+
+    # Placeholder for the start and end time rows in the cached description
+    times_marker = '@@DEEFUZZER_TIMES@@'
+    description_item = '<tr><td>%s:   </td><td><b>%s</b></td></tr>'
+    dynamic_keys = ('StartTime', 'EndTime')
+
+    def __init__(self, link, description, media_url, metadata_url,
+                 enclosure=0, showfilepath=0, showfilename=0):
+        self.link = link
+        self.description = description
+        self.media_url = media_url
+        self.metadata_url = metadata_url
+        self.enclosure = enclosure
+        self.showfilepath = showfilepath
+        self.showfilename = showfilename
+        self.items = {}
+        self.hits = 0
+        self.misses = 0
+
+    def render_item(self, media, metadata):
+        """Returns the (rss head, rss tail, json head) fragments of an item or
+        None if the item can not be published"""
+        media_stats = os.stat(media.media)
+        media_date = time.localtime(media_stats[8])
+        media_date = time.strftime("%a, %d %b %Y %H:%M:%S +0200", media_date)
+
+        json_item = {}
+        media_description = '<table>'
+        for key in metadata.keys():
+            if metadata[key] != '':
+                if key == 'filepath' and not self.showfilepath:
+                    continue
+                if key == 'filename' and not self.showfilename:
+                    continue
+                media_description += self.description_item % (key.capitalize(), metadata[key])
+                json_item[key] = metadata[key]
+        if self.showfilepath:
+            media_description += self.description_item % ('Filepath', media.media)
+            json_item['filepath'] = media.media
+        if self.showfilename:
+            media_description += self.description_item % ('Filename', media.file_name)
+            json_item['filename'] = media.file_name
+        media_description += self.times_marker + '</table>'
+
+        song = ''
+        try:
+            song = media.get_song(True)
+        except:
+            pass
+
+        if self.enclosure:
+            media_link = self.media_url + media.file_name
+            media_link = media_link.decode('utf-8')
+            item = RSSItem(
+                title=song,
+                link=media_link,
+                description=media_description,
+                enclosure=Enclosure(media_link, str(media.size), 'audio/mpeg'),
+                guid=Guid(media_link),
+                pubDate=media_date, )
+        else:
+            media_link = self.metadata_url + '/' + media.file_name + '.xml'
+            try:
+                media_link = media_link.decode('utf-8')
+            except:
+                return None
+            item = RSSItem(
+                title=song,
+                link=media_link,
+                description=media_description,
+                guid=Guid(media_link),
+                pubDate=media_date, )
+
+        f = StringIO.StringIO()
+        item.publish(saxutils.XMLGenerator(f, 'utf-8'))
+        rss_head, rss_tail = f.getvalue().split(self.times_marker)
+
+        json_head = json.dumps(json_item, separators=(',', ':'))[:-1]
+        if json_item:
+            json_head += ','
+        return rss_head, rss_tail, json_head
+
+    def get_item(self, media, items):
+        metadata = {}
+        for key in media.metadata.keys():
+            if key not in self.dynamic_keys:
+                metadata[key] = media.metadata[key]
+        key = (media.media, media.size, tuple(sorted(metadata.items())))
+        if key in items:
+            return items[key]
+        if key in self.items:
+            self.hits += 1
+            item = self.items[key]
+        else:
+            self.misses += 1
+            item = self.render_item(media, metadata)
+        items[key] = item
+        return item
+
+    def build(self, media_list, title, rss=True, json_feed=True):
+        """Returns the RSS document and the JSON document of the media list"""
+        _date_now = datetime.datetime.now()
+        media_absolute_playtime = _date_now
+        items = {}
+        rss_items = []
+        json_items = []
+
+        for media in media_list:
+            media.metadata['Duration'] = str(media.length).split('.')[0]
+            media.metadata['Bitrate'] = str(media.bitrate) + ' kbps'
+            start_time = str(media_absolute_playtime).split('.')[0]
+            end_time = str(media_absolute_playtime + media.length).split('.')[0]
+            media.metadata['StartTime'] = start_time
+            media.metadata['EndTime'] = end_time
+            media_absolute_playtime += media.length
+
+            item = self.get_item(media, items)
+            if item is None:
+                continue
+            rss_head, rss_tail, json_head = item
+            if rss:
+                times = self.description_item % ('Starttime', start_time)
+                times += self.description_item % ('Endtime', end_time)
+                rss_items.append(rss_head + saxutils.escape(times) + rss_tail)
+            if json_feed:
+                json_items.append(json_head + '"StartTime":"%s","EndTime":"%s"}' % (start_time, end_time))
+
+        # Forget the items which are not in the list anymore
+        self.items = items
+
+        rss_data = None
+        if rss:
+            channel = RSS2(title=title,
+                           link=self.link,
+                           description=self.description.decode('utf-8'),
+                           lastBuildDate=str(_date_now),
+                           items=[], )
+            head, tail = channel.to_xml('utf-8').rsplit('</channel>', 1)
+            rss_data = head + ''.join(rss_items) + '</channel>' + tail
+
+        json_data = None
+        if json_feed:
+            json_data = '[' + ','.join(json_items) + ']'
+
+        return rss_data, json_data
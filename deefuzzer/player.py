@@ -37,43 +37,66 @@
 # Author: Guillaume Pellerin <yomguy@parisson.com>
 
 from relay import *
+from tools.chunkcache import file_identity
+import os
 import time
+import mmap
 
 
 class Player:
     """A file streaming iterator"""
 
+    offset = 0
+    position = 0
+    relay = None
+    relay_buffer_policy = 'drop'
+    relay_dropped = 0
+
     def __init__(self, stream_type='icecast'):
         if stream_type == 'icecast':
             self.main_buffer_size = 0x100000
-            self.relay_queue_size = 0x100000
+            self.relay_buffer_size = 0x800000
             self.sub_buffer_size = 0x10000
         elif stream_type == 'stream-m':
             self.main_buffer_size = 0x100000
-            self.relay_queue_size = 0x100000
+            self.relay_buffer_size = 0x800000
             self.sub_buffer_size = 0x10000
 
-    def set_media(self, media):
+    def set_media(self, media, offset=0):
+        """Sets the media to read, from the given byte offset"""
         self.media = media
+        self.offset = offset
+        self.position = offset
 
     def start_relay(self, url):
+        """Subscribes to the shared upstream connection of the URL"""
+        self.stop_relay()
         self.url = url
-        self.relay = Relay(self.sub_buffer_size, self.relay_queue_size)
-        self.relay.set_url(self.url)
-        self.relay.open()
-        self.relay.start()
-        self.queue = self.relay.queue
+        self.relay = relay_hub.subscribe(self.url, self.sub_buffer_size, self.relay_buffer_size,
+                                         self.relay_buffer_policy)
 
     def stop_relay(self):
-        self.relay.close()
+        if self.relay:
+            self.relay.close()
+            self.relay_dropped += self.relay.buffer.dropped
+            self.relay = None
+
+    def relay_stats(self):
+        """Returns the bytes waiting in the relay buffer and the bytes
+        dropped since the player was created"""
+        if not self.relay:
+            return 0, self.relay_dropped
+        return self.relay.buffer.size, self.relay_dropped + self.relay.buffer.dropped
 
     def file_read_fast(self):
         """Read media and stream data through a generator."""
         m = open(self.media, 'r')
+        m.seek(self.offset)
         while True:
             __main_chunk = m.read(self.sub_buffer_size)
             if not __main_chunk:
                 break
+            self.position += len(__main_chunk)
             yield __main_chunk
         m.close()
 
@@ -81,6 +104,7 @@ class Player:
         """Read a bigger part of the media and stream the little parts
          of the data through a generator"""
         m = open(self.media, 'r')
+        m.seek(self.offset)
         while True:
             self.main_chunk = m.read(self.main_buffer_size)
             if not self.main_chunk:
@@ -92,22 +116,107 @@ class Player:
                 self.sub_chunk = self.main_chunk[start:end]
                 if not self.sub_chunk:
                     break
+                self.position += len(self.sub_chunk)
                 yield self.sub_chunk
                 i += 1
         self.main_chunk = 0
         self.sub_chunk = 0
         m.close()
 
+    def file_read_mmap(self):
+        """Map the media in memory and stream zero-copy slices of it through
+        a generator.
+
+        The chunks are buffer objects on the mapping, so neither the player
+        nor shout or the recorder copy the data in Python.  The mapping is
+        released with the last chunk referencing it.
+
+        Reading a page of the mapping beyond the end of a file truncated in
+        place kills the process with SIGBUS, so the size of the file is
+        checked before each chunk and the track ends at its new size."""
+        m = open(self.media, 'rb')
+        try:
+            try:
+                data = mmap.mmap(m.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                # Empty files and pipes cannot be mapped
+                m.seek(self.offset)
+                for chunk in self.file_read_into(m):
+                    yield chunk
+                return
+            size = len(data)
+            while self.position < size:
+                size = min(size, os.fstat(m.fileno()).st_size)
+                if self.position >= size:
+                    break
+                chunk = buffer(data, self.position, min(self.sub_buffer_size, size - self.position))
+                self.position += len(chunk)
+                yield chunk
+        finally:
+            m.close()
+
+    def file_read_into(self, m):
+        """Read an open media into a preallocated buffer through a generator.
+        A chunk is only valid until the next one is read."""
+        data = bytearray(self.sub_buffer_size)
+        while True:
+            size = m.readinto(data)
+            if not size:
+                break
+            self.position += size
+            yield buffer(data, 0, size)
+
+    def file_read_cached(self, cache, metrics=None):
+        """Read media through a ChunkCache shared with the other players, in
+        blocks of sub_buffer_size bytes aligned in the file.  The missing
+        blocks are read from the disk and added to the cache."""
+        identity = file_identity(self.media)
+        size = identity[2]
+        m = None
+        while self.position < size:
+            start = self.position - self.position % self.sub_buffer_size
+            key = identity + (start,)
+            block = cache.get(key)
+            if block is None:
+                if m is None:
+                    m = open(self.media, 'rb')
+                m.seek(start)
+                block = m.read(self.sub_buffer_size)
+                if not block:
+                    break
+                cache.put(key, block)
+                if metrics:
+                    metrics.add('cache_misses')
+            elif metrics:
+                metrics.add('cache_hits')
+            # A whole block is not copied
+            chunk = block[self.position - start:]
+            if not chunk:
+                break
+            self.position += len(chunk)
+            yield chunk
+        if m:
+            m.close()
+
     def relay_read(self):
-        """Read a distant media through its URL"""
+        """Read a distant media through its URL.  The chunks are buffer
+        objects on the relay buffer, valid until the next one is read."""
+        relay = self.relay
         while True:
-            self.sub_chunk = self.queue.get(self.sub_buffer_size)
+            self.sub_chunk = relay.read(self.sub_buffer_size)
             if not self.sub_chunk:
                 break
             yield self.sub_chunk
-            self.queue.task_done()
         self.sub_chunk = 0
 
+    def relay_poll(self):
+        """Returns the next chunk of the relay without waiting: a buffer
+        object valid until the next one is read, None if no data is waiting,
+        or an empty string once the relay is closed"""
+        if not self.relay:
+            return ''
+        return self.relay.read(self.sub_buffer_size, False)
+
 
 class FileReader:
 
@@ -120,9 +229,8 @@ class FileReader:
 
 class URLReader:
 
-    def __init__(self, relay):
-        self.__relayparam = relay
-        self.relay = urllib.urlopen(self.__relayparam)
+    def __init__(self, relay, logger=None):
+        self.connection = RelayConnection(relay, logger)
         self.rec_mode = 0
 
     def set_recorder(self, recorder, mode=1):
@@ -130,20 +238,10 @@ class URLReader:
         self.recorder = recorder
 
     def read_callback(self, size):
-        chunk = None
-
-        try:
-            chunk = self.relay.read(size)
-        except:
-            while True:
-                try:
-                    self.relay = urllib.urlopen(self.__relayparam)
-                    chunk = self.relay.read(size)
-                    break
-                except:
-                    time.sleep(0.5)
-                    continue
-
+        chunk = self.connection.read(size)
         if self.rec_mode == 1 and chunk:
             self.recorder.write(chunk)
         return chunk
+
+    def close(self):
+        self.connection.stop()
@@ -37,26 +37,455 @@
 # Author: Guillaume Pellerin <yomguy@parisson.com>
 
 import os
+import math
+import time
+import struct
+import collections
+from threading import Thread, Condition
+from tools.archive import *
+from tools.mp3 import parse_mp3_frame_header, is_mp3_info_frame
+from tools.utils import write_file_atomic
 
 
 class Recorder:
-    """A file streaming iterator"""
+    """Records a stream to a file.
 
-    def __init__(self, path):
+    write() only queues the chunks, a writer thread writes them in batches,
+    so a slow disk never delays the streaming loop.  When more than
+    buffer_size bytes are waiting, the new chunks are dropped and counted as
+    overruns.  The fsync policy is 'never', 'close', or a number of seconds
+    between two fsyncs while recording."""
+
+    buffer_size = 0x1000000
+    batch_size = 0x100000
+    fsync = 'never'
+
+    def __init__(self, path, fsync=None, buffer_size=None, metrics=None):
         self.path = path
         self.recording = True
+        if fsync is not None:
+            self.fsync = fsync
+        if buffer_size:
+            self.buffer_size = buffer_size
+        self.metrics = metrics
+        self.media = None
+        # Items of (time, chunk, title), title is for the marks without chunk
+        self.chunks = collections.deque()
+        self.size = 0
+        self.overruns = 0
+        self.closed = False
+        self.writer = None
+        self.cond = Condition()
 
     def open(self, filename):
         self.filename = filename
         self.media = open(self.path + os.sep + self.filename, 'w')
+        self.start_writer()
+
+    def start_writer(self):
+        self.closed = False
+        self.writer = Thread(target=self.run)
+        self.writer.setDaemon(True)
+        self.writer.start()
 
     def write(self, chunk):
+        if not self.recording:
+            return
+        with self.cond:
+            if self.closed:
+                return
+            if self.size + len(chunk) > self.buffer_size:
+                self.overruns += 1
+                if self.metrics:
+                    self.metrics.add('record_overruns')
+                return
+            # The chunks may be buffers on memory reused by the player
+            self.chunks.append((time.time(), str(chunk), None))
+            self.size += len(chunk)
+            self.cond.notify()
+
+    def mark(self, title):
+        """Marks the start of a track at the current point of the recording"""
+        if not self.recording:
+            return
+        with self.cond:
+            if not self.closed:
+                self.chunks.append((time.time(), None, title))
+                self.cond.notify()
+
+    def run(self):
+        interval = 0
+        if self.fsync not in ('never', 'close'):
+            interval = float(self.fsync)
+        synced = time.time()
+        dirty = False
+        while True:
+            with self.cond:
+                while not self.chunks and not self.closed:
+                    self.cond.wait()
+                batch = []
+                size = 0
+                while self.chunks and size < self.batch_size:
+                    item = self.chunks.popleft()
+                    batch.append(item)
+                    if item[1] is not None:
+                        size += len(item[1])
+                self.size -= size
+                done = self.closed and not self.chunks
+            try:
+                if batch:
+                    self.store(batch)
+                    dirty = dirty or size > 0
+                if dirty and interval and time.time() - synced >= interval:
+                    self.sync()
+                    synced = time.time()
+                    dirty = False
+            except:
+                pass
+            if done:
+                break
+        self.finish()
+
+    def store(self, batch):
+        data = ''.join([chunk for t, chunk, title in batch if chunk is not None])
+        if data:
+            self.media.write(data)
+            self.media.flush()
+
+    def sync(self):
+        if self.media:
+            os.fsync(self.media.fileno())
+
+    def finish(self):
         try:
-            if self.recording:
-                self.media.write(chunk)
-                self.media.flush()
+            if self.fsync != 'never':
+                self.sync()
         except:
             pass
+        self.media.close()
 
     def close(self):
+        """Writes the queued chunks and closes the file"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.writer:
+            self.writer.join()
+
+
+class SegmentedRecorder(Recorder):
+    """Records a stream in segments of segment_time seconds aligned on the
+    clock, so that hourly segments start on the hour, and of at most
+    segment_size bytes.
+
+    A RecordIndex next to the segments keeps their times and sizes, the
+    start of each track and a mark every mark_interval seconds, so that a
+    time can be found and extracted without reading the files.  After each
+    new segment, the segments older than retention_time seconds, then the
+    oldest ones while the archive is larger than retention_size bytes, are
+    removed in the background."""
+
+    segment_time = 3600
+    segment_size = 0
+    mark_interval = 60
+    retention_time = 0
+    retention_size = 0
+
+    def __init__(self, path, name, extension, fsync=None, buffer_size=None, metrics=None,
+                 segment_time=None, segment_size=None, retention_time=None, retention_size=None,
+                 logger=None):
+        Recorder.__init__(self, path, fsync, buffer_size, metrics)
+        self.name = name
+        self.extension = extension
+        if segment_time is not None:
+            self.segment_time = segment_time
+        if segment_size is not None:
+            self.segment_size = segment_size
+        if retention_time is not None:
+            self.retention_time = retention_time
+        if retention_size is not None:
+            self.retention_size = retention_size
+        self.logger = logger
+        self.index = None
+        self.segment = None
+        self.segment_end = 0
+        self.offset = 0
+        self.last_mark = 0
+        self.first_title = None
+        self.pruner = None
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger(msg)
+
+    def open(self, filename=None):
+        self.index = RecordIndex(os.path.join(self.path, self.name + '.index'))
+        self.start_writer()
+
+    def store(self, batch):
+        data = []
+        for t, chunk, title in batch:
+            if chunk is None:
+                if self.media:
+                    self.index.add_mark(t, self.segment, self.offset, title)
+                else:
+                    # The track starts with the first segment
+                    self.first_title = title
+                continue
+            if not self.media or t >= self.segment_end or \
+                    (self.segment_size and self.offset + len(chunk) > self.segment_size):
+                self.media_write(data)
+                data = []
+                self.new_segment(t)
+            elif t - self.last_mark >= self.mark_interval:
+                self.index.add_mark(t, self.segment, self.offset, None)
+                self.index.flush()
+                self.last_mark = t
+            data.append(chunk)
+            self.offset += len(chunk)
+        self.media_write(data)
+
+    def media_write(self, data):
+        if data:
+            self.media.write(''.join(data))
+            self.media.flush()
+
+    def end_segment(self, t):
+        if not self.media:
+            return
+        try:
+            if self.fsync != 'never':
+                self.sync()
+        except:
+            pass
         self.media.close()
+        self.media = None
+        self.index.end_segment(self.segment, t, self.offset)
+        self.index.flush()
+
+    def new_segment(self, t):
+        self.end_segment(t)
+        if self.segment_time:
+            self.segment_end = (int(t) // int(self.segment_time) + 1) * int(self.segment_time)
+        else:
+            self.segment_end = float('inf')
+        name = '%s-%s' % (self.name, time.strftime('%Y%m%d-%H%M%S', time.localtime(t)))
+        self.segment = name + '.' + self.extension
+        i = 1
+        while os.path.exists(os.path.join(self.path, self.segment)):
+            self.segment = '%s-%d.%s' % (name, i, self.extension)
+            i += 1
+        self.media = open(os.path.join(self.path, self.segment), 'w')
+        self.offset = 0
+        self.index.add_segment(self.segment, t)
+        self.index.add_mark(t, self.segment, 0, self.first_title)
+        self.first_title = None
+        self.index.flush()
+        self.last_mark = t
+        self.prune()
+
+    def finish(self):
+        self.end_segment(time.time())
+        if self.pruner:
+            self.pruner.join()
+
+    def prune(self):
+        if not (self.retention_time or self.retention_size):
+            return
+        if self.pruner and self.pruner.isAlive():
+            return
+        self.pruner = Thread(target=self.run_prune, args=(self.segment,))
+        self.pruner.setDaemon(True)
+        self.pruner.start()
+
+    def run_prune(self, current):
+        try:
+            removed = self.index.prune(self.retention_time, self.retention_size, current)
+            if removed:
+                self._log('removed %d old segments of %s' % (len(removed), self.name))
+        except Exception, e:
+            self._log('could not prune the recordings of %s: %s' % (self.name, str(e)))
+
+
+class HlsWriter(Recorder):
+    """Cuts a MP3 or Ogg stream in segments of about segment_time seconds,
+    on frame or page boundaries, and keeps a rolling HLS playlist of the
+    last window segments in a directory, to be served by any web server.
+
+    The segments are numbered from the start time of the writer, so that
+    a restarted station does not reuse the names of cached segments.  Each
+    segment and the playlist are written atomically.  A segment of an Ogg
+    stream starts with the header pages of its logical stream, and a new
+    logical stream (a new track) starts a new segment."""
+
+    segment_time = 10
+    window = 6
+
+    def __init__(self, path, name, extension, segment_time=None, window=None, buffer_size=None,
+                 metrics=None):
+        Recorder.__init__(self, path, 'never', buffer_size, metrics)
+        self.name = name
+        self.extension = extension
+        if segment_time:
+            self.segment_time = segment_time
+        if window:
+            self.window = window
+        self.playlist = os.path.join(self.path, self.name + '.m3u8')
+        self.data = ''
+        self.sequence = int(time.time())
+        self.segments = []
+        self.segment = []
+        self.duration = 0.0
+        self.discontinuity = False
+        # Ogg state
+        self.headers = []
+        self.granule = 0
+        self.rate = 0
+
+    def open(self, filename=None):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.start_writer()
+
+    def store(self, batch):
+        self.data += ''.join([chunk for t, chunk, title in batch if chunk is not None])
+        if self.extension == 'ogg':
+            offset = self.split_ogg()
+        else:
+            offset = self.split_mp3()
+        self.data = self.data[offset:]
+
+    def split_mp3(self):
+        data = self.data
+        offset = 0
+        while True:
+            if data[offset:offset + 3] == 'ID3':
+                if offset + 10 > len(data):
+                    break
+                size = 0
+                for c in data[offset + 6:offset + 10]:
+                    size = (size << 7) | (ord(c) & 0x7f)
+                offset += 10 + size
+                continue
+            header = parse_mp3_frame_header(data, offset)
+            if header is None:
+                if offset + 4 > len(data):
+                    break
+                # Look for the next frame synchronization
+                offset = data.find('\xff', offset + 1)
+                if offset < 0:
+                    offset = len(data)
+                continue
+            length, samples, samplerate = header
+            if offset + length + 4 > len(data):
+                break
+            if parse_mp3_frame_header(data, offset + length) is None and \
+                    data[offset + length:offset + length + 3] not in ('ID3', 'TAG'):
+                # A false synchronization in garbage or a tag
+                offset = data.find('\xff', offset + 1)
+                if offset < 0:
+                    offset = len(data)
+                continue
+            if not is_mp3_info_frame(data, offset, length):
+                self.add(data[offset:offset + length], float(samples) / samplerate)
+            offset += length
+        return offset
+
+    def split_ogg(self):
+        data = self.data
+        offset = 0
+        while True:
+            if data[offset:offset + 4] != 'OggS':
+                if offset + 4 > len(data):
+                    break
+                offset = data.find('OggS', offset + 1)
+                if offset < 0:
+                    offset = max(len(data) - 3, 0)
+                    break
+                continue
+            if offset + 27 > len(data):
+                break
+            count = ord(data[offset + 26])
+            if offset + 27 + count > len(data):
+                break
+            length = 27 + count + sum([ord(c) for c in data[offset + 27:offset + 27 + count]])
+            if offset + length > len(data):
+                break
+            page = data[offset:offset + length]
+            offset += length
+            granule = struct.unpack('<q', page[6:14])[0]
+            body = page[27 + count:]
+            if ord(page[5]) & 2:
+                # A new logical stream starts with its header pages
+                self.cut(True)
+                self.headers = [page]
+                self.granule = 0
+                self.rate = 0
+                if body[:7] == '\x01vorbis':
+                    self.rate = struct.unpack('<I', body[12:16])[0]
+                elif body[:8] == 'OpusHead':
+                    self.rate = 48000
+                elif body[:5] == '\x7fFLAC':
+                    self.rate = struct.unpack('>I', body[27:31])[0] >> 12
+                continue
+            if granule == 0:
+                self.headers.append(page)
+                continue
+            duration = 0.0
+            if self.rate and granule > self.granule:
+                duration = float(granule - self.granule) / self.rate
+            if granule > 0:
+                self.granule = granule
+            self.add(page, duration)
+        return offset
+
+    def add(self, frame, duration):
+        if not self.segment and self.headers:
+            self.segment = list(self.headers)
+        self.segment.append(frame)
+        self.duration += duration
+        if self.duration >= self.segment_time:
+            self.cut()
+
+    def cut(self, discontinuity=False):
+        if self.segment and self.duration > 0:
+            name = '%s-%d.%s' % (self.name, self.sequence, self.extension)
+            write_file_atomic(os.path.join(self.path, name), ''.join(self.segment))
+            self.segments.append((self.sequence, name, self.duration, self.discontinuity))
+            self.sequence += 1
+            self.discontinuity = False
+            self.write_playlist()
+        self.segment = []
+        self.duration = 0.0
+        if discontinuity and self.segments:
+            self.discontinuity = True
+
+    def write_playlist(self, end=False):
+        # The segments which left the playlist are kept for one more window,
+        # the clients may still be downloading them
+        while len(self.segments) > 2 * self.window:
+            sequence, name, duration, discontinuity = self.segments.pop(0)
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+        segments = self.segments[-self.window:]
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3',
+                 '#EXT-X-TARGETDURATION:%d' % math.ceil(max([s[2] for s in segments])),
+                 '#EXT-X-MEDIA-SEQUENCE:%d' % segments[0][0]]
+        for sequence, name, duration, discontinuity in segments:
+            if discontinuity:
+                lines.append('#EXT-X-DISCONTINUITY')
+            lines.append('#EXTINF:%.3f,' % duration)
+            lines.append(name)
+        if end:
+            lines.append('#EXT-X-ENDLIST')
+        write_file_atomic(self.playlist, '\n'.join(lines) + '\n')
+
+    def finish(self):
+        try:
+            self.cut()
+            if self.segments:
+                self.write_playlist(True)
+        except:
+            pass
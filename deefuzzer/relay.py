@@ -36,43 +36,295 @@
 
 # Author: Guillaume Pellerin <yomguy@parisson.com>
 
-from threading import Thread
-import Queue
-import urllib
+from threading import Thread, Lock, Condition, Event
+import time
+import random
+import urllib2
+
+
+class RingBuffer(object):
+    """A preallocated ring of bytes between one writer and one reader.
+
+    When the ring is full, the 'drop' policy discards its oldest bytes and
+    the 'block' policy makes the writer wait for the reader.  read() returns
+    buffer objects on the ring itself, a chunk is not overwritten before the
+    next call to read()."""
+
+    def __init__(self, capacity, policy='drop'):
+        self.data = bytearray(capacity)
+        self.capacity = capacity
+        self.policy = policy
+        # The unread bytes start at start, the last chunk read at hold_start
+        self.start = 0
+        self.size = 0
+        self.hold_start = 0
+        self.held = 0
+        self.dropped = 0
+        self.closed = False
+        self.cond = Condition()
+
+    def free(self):
+        return self.capacity - self.size - self.held
+
+    def ahead(self):
+        """Returns the free bytes after the unread ones, before the chunk
+        held by the reader"""
+        if not self.held:
+            return self.free()
+        return (self.hold_start - self.start - self.size) % self.capacity
+
+    def write(self, chunk):
+        with self.cond:
+            length = len(chunk)
+            if self.policy == 'block':
+                offset = 0
+                while offset < length and not self.closed:
+                    if not self.free():
+                        self.cond.wait()
+                        continue
+                    size = min(length - offset, self.free())
+                    self.put(buffer(chunk, offset, size))
+                    offset += size
+                return
+            room = self.capacity - self.held
+            if length > room:
+                # Only the end of the chunk can fit
+                self.dropped += length - room
+                chunk = buffer(chunk, length - room)
+                length = room
+            if self.held and self.ahead() < length:
+                # Dropping the oldest bytes would free the space after the
+                # held chunk, not before it: the unread bytes are all dropped
+                # and the chunk is written after the held one
+                self.dropped += self.size
+                self.start = (self.hold_start + self.held) % self.capacity
+                self.size = 0
+            elif self.free() < length:
+                drop = length - self.free()
+                self.start = (self.start + drop) % self.capacity
+                self.size -= drop
+                self.dropped += drop
+            if not self.closed:
+                self.put(chunk)
+
+    def put(self, chunk):
+        length = len(chunk)
+        end = (self.start + self.size) % self.capacity
+        first = min(length, self.capacity - end)
+        self.data[end:end + first] = buffer(chunk, 0, first)
+        if first < length:
+            self.data[0:length - first] = buffer(chunk, first)
+        self.size += length
+        self.cond.notify_all()
+
+    def read(self, size, block=True):
+        """Returns up to size bytes, waiting for them if the ring is empty,
+        or an empty string once the ring is closed and empty.  If block is
+        False, returns None instead of waiting."""
+        with self.cond:
+            self.held = 0
+            self.cond.notify_all()
+            while not self.size and not self.closed:
+                if not block:
+                    return None
+                self.cond.wait()
+            if not self.size:
+                return ''
+            length = min(size, self.size, self.capacity - self.start)
+            chunk = buffer(self.data, self.start, length)
+            self.hold_start = self.start
+            self.start = (self.start + length) % self.capacity
+            self.size -= length
+            self.held = length
+            return chunk
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class RelaySubscriber(object):
+    """A reader of a Relay with its own ring buffer, so its position in the
+    stream does not depend on the other readers.  With the 'drop' policy, a
+    subscriber which does not keep up loses its oldest bytes instead of
+    blocking the Relay.  With 'block', the Relay waits for it."""
+
+    def __init__(self, relay, buffer_size, policy='drop'):
+        self.relay = relay
+        self.buffer = RingBuffer(buffer_size, policy)
+
+    def put(self, chunk):
+        self.buffer.write(chunk)
+
+    def read(self, size, block=True):
+        return self.buffer.read(size, block)
+
+    def close(self):
+        self.relay.hub.unsubscribe(self)
+        # Wake up the reader, an empty chunk ends Player.relay_read()
+        self.buffer.close()
+
+
+class RelayConnection(object):
+    """The connection to a distant stream, as a state machine:
+
+    connecting -> streaming when the URL opens, backoff when it fails
+    streaming -> backoff when the source ends, fails or stalls
+    backoff -> connecting after a delay doubling at each failure in a row,
+    with a random jitter so that the relays do not all retry together
+    any state -> stopped by stop()
+
+    A stall is a connection or a read which gets no data for stall_time
+    seconds.  A dead source costs a connection attempt per backoff delay,
+    and no CPU."""
+
+    CONNECTING = 'connecting'
+    STREAMING = 'streaming'
+    BACKOFF = 'backoff'
+    STOPPED = 'stopped'
+
+    stall_time = 10
+    backoff_min = 0.5
+    backoff_max = 30
+
+    def __init__(self, url, logger=None):
+        self.url = url
+        self.logger = logger
+        self.state = self.CONNECTING
+        self.stream = None
+        self.failures = 0
+        self.reconnects = 0
+        self.wakeup = Event()
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger('relay %s: %s' % (self.url, msg))
+
+    def connect(self):
+        # The socket of the previous connection is not left to the collector
+        self.disconnect()
+        try:
+            # The timeout bounds the connection and each read of the socket
+            self.stream = urllib2.urlopen(self.url, timeout=self.stall_time)
+        except Exception, e:
+            self.fail('cannot connect: %s' % str(e))
+            return
+        if self.state == self.STOPPED:
+            self.disconnect()
+            return
+        if self.failures:
+            self._log('connected')
+        self.state = self.STREAMING
+
+    def disconnect(self):
+        if self.stream:
+            try:
+                self.stream.close()
+            except:
+                pass
+            self.stream = None
+
+    def fail(self, reason):
+        self.disconnect()
+        if self.state == self.STOPPED:
+            return
+        self.failures += 1
+        delay = min(self.backoff_max, self.backoff_min * 2 ** (self.failures - 1))
+        delay *= random.uniform(0.5, 1)
+        self._log('%s, retrying in %.1f s' % (reason, delay))
+        self.state = self.BACKOFF
+        self.wakeup.wait(delay)
+        if self.state == self.BACKOFF:
+            self.reconnects += 1
+            self.state = self.CONNECTING
+
+    def read(self, size):
+        """Returns the next chunk of at most size bytes of the stream, after
+        connecting or reconnecting as needed, or an empty string once
+        stopped"""
+        while self.state != self.STOPPED:
+            if self.state != self.STREAMING:
+                self.connect()
+                continue
+            try:
+                chunk = self.stream.read(size)
+            except Exception, e:
+                self.fail('stalled or failed: %s' % str(e))
+                continue
+            if not chunk:
+                self.fail('the source ended')
+                continue
+            self.failures = 0
+            return chunk
+        return ''
+
+    def stop(self):
+        self.state = self.STOPPED
+        self.wakeup.set()
+        self.disconnect()
 
 
 class Relay(Thread):
+    """Reads a distant stream once and writes each chunk to the buffers of
+    all its subscribers"""
 
-    def __init__(self, sub_buffer_size, queue_size):
+    def __init__(self, url, sub_buffer_size, hub=None):
         Thread.__init__(self)
+        self.setDaemon(True)
+        self.url = url
         self.sub_buffer_size = sub_buffer_size
-        self.queue_size = queue_size
-        self.queue = Queue.Queue(self.queue_size)
-        self.stream = None
+        self.hub = hub
+        self.subscribers = []
+        self.connection = RelayConnection(url, hub and hub.logger)
 
-    def set_url(self, url):
-        self.url = url
+    def subscribe(self, buffer_size, policy='drop'):
+        subscriber = RelaySubscriber(self, buffer_size, policy)
+        self.subscribers = self.subscribers + [subscriber]
+        return subscriber
 
-    def open(self):
-        try:
-            self.stream = urllib.urlopen(self.url)
-            self.isopen = True
-        except:
-            self.isopen = False
+    def unsubscribe(self, subscriber):
+        self.subscribers = [s for s in self.subscribers if s is not subscriber]
 
     def close(self):
-        if self.stream:
-            self.isopen = False
+        self.connection.stop()
 
     def run(self):
         while True:
-            if self.isopen:
-                self.chunk = self.stream.read(self.sub_buffer_size)
-                self.queue.put_nowait(self.chunk)
-#                print self.queue.qsize()
-            else:
-                if self.stream:
-                    self.stream.close()
-                else:
-                    self.open()
+            chunk = self.connection.read(self.sub_buffer_size)
+            if not chunk:
+                break
+            for subscriber in self.subscribers:
+                subscriber.put(chunk)
+
+
+class RelayHub(object):
+    """Shares one upstream connection, a Relay, between all the players
+    relaying the same URL in this process.  The Relay is started with its
+    first subscriber and closed when its last subscriber leaves."""
+
+    logger = None
+
+    def __init__(self):
+        self.lock = Lock()
+        self.relays = {}
+
+    def subscribe(self, url, sub_buffer_size, buffer_size, policy='drop'):
+        with self.lock:
+            relay = self.relays.get(url)
+            if relay is None:
+                relay = Relay(url, sub_buffer_size, self)
+                self.relays[url] = relay
+                relay.start()
+            return relay.subscribe(buffer_size, policy)
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            relay = subscriber.relay
+            relay.unsubscribe(subscriber)
+            if not relay.subscribers and self.relays.get(relay.url) is relay:
+                del self.relays[relay.url]
+                relay.close()
+
 
+relay_hub = RelayHub()
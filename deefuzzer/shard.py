@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2006-2011 Guillaume Pellerin
+
+# <yomguy@parisson.com>
+
+# This software is a computer program whose purpose is to stream audio
+# and video data through icecast2 servers.
+
+# This software is governed by the CeCILL license under French law and
+# abiding by the rules of distribution of free software. You can use,
+# modify and/ or redistribute the software under the terms of the CeCILL
+# license as circulated by CEA, CNRS and INRIA at the following URL
+# "http://www.cecill.info".
+
+# As a counterpart to the access to the source code and  rights to copy,
+# modify and redistribute granted by the license, users are provided only
+# with a limited warranty and the software's author, the holder of the
+# economic rights, and the successive licensors have only limited
+# liability.
+
+# In this respect, the user's attention is drawn to the risks associated
+# with loading, using,  modifying and/or developing or reproducing the
+# software by the user in light of its specific status of free software,
+# that may mean that it is complicated to manipulate, and that also
+# therefore means that it is reserved for developers and  experienced
+# professionals having in-depth computer knowledge. Users are therefore
+# encouraged to load and test the software's suitability as regards their
+# requirements in conditions enabling the security of their systems and/or
+# data to be ensured and, more generally, to use and operate it in the
+# same conditions as regards security.
+
+# The fact that you are presently reading this means that you have had
+# knowledge of the CeCILL license and that you accept its terms.
+
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import time
+import Queue
+import signal
+import hashlib
+import multiprocessing
+from threading import Thread
+
+
+def station_key(index, station):
+    """Returns a stable identifier of a station definition, used to assign it to a shard"""
+    try:
+        return str(station['server']['mountpoint'])
+    except (KeyError, TypeError):
+        pass
+    try:
+        return str(station['infos']['short_name'])
+    except (KeyError, TypeError):
+        pass
+    return str(index)
+
+
+def shard_owner(key, shards):
+    """Returns the shard owning a station key among the live shards.
+
+    This is a rendezvous (highest random weight) hash: when a shard is
+    retired only its own stations move to the other shards."""
+    best = None
+    best_weight = None
+    for shard in shards:
+        weight = hashlib.md5('%s:%s' % (shard, key)).hexdigest()
+        if best_weight is None or weight > best_weight:
+            best = shard
+            best_weight = weight
+    return best
+
+
+def run_shard(conf_file, shard, shards, log_queue, control_queue):
+    """Entry point of a worker process: run the stations owned by one shard"""
+    from deefuzzer.core import DeeFuzzer
+
+    d = DeeFuzzer(conf_file, shard=shard, log_queue=log_queue)
+    d.shards = shards
+    d.control_queue = control_queue
+    # The handler of the supervisor was inherited through fork
+    signal.signal(signal.SIGHUP, lambda signum, frame: d.request_reload())
+    d.run()
+
+
+class LogForwarder(Thread):
+    """Moves the log messages of the worker processes to the main logger queue.
+    The metrics snapshots they send on the same queue are stored by shard in
+    the metrics dictionary, and the playlists in the files dictionary"""
+
+    def __init__(self, source, destination, metrics=None, files=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.source = source
+        self.destination = destination
+        self.metrics = metrics
+        self.files = files
+
+    def run(self):
+        while True:
+            try:
+                msg = self.source.get(1)
+                if isinstance(msg, dict) and 'metrics' in msg:
+                    if self.metrics is not None:
+                        self.metrics[msg['shard']] = msg['metrics']
+                    continue
+                if isinstance(msg, dict) and 'files' in msg:
+                    if self.files is not None:
+                        self.files.update(msg['files'])
+                    continue
+                self.destination.put(msg)
+            except:
+                pass
+
+
+class ShardSupervisor(object):
+    """Splits the stations of a DeeFuzzer across several worker processes.
+
+    Dead workers are restarted.  A worker dying more than max_restarts
+    times in a row is retired and its stations are rebalanced over the
+    remaining workers."""
+
+    max_restarts = 3
+    stable_time = 60
+
+    def __init__(self, deefuzzer):
+        self.deefuzzer = deefuzzer
+        self.count = deefuzzer.processes
+        if self.count <= 0:
+            self.count = multiprocessing.cpu_count()
+        self.shards = range(self.count)
+        self.log_queue = multiprocessing.Queue()
+        self.workers = {}
+        self.controls = {}
+        self.started = {}
+        self.failures = dict((shard, 0) for shard in self.shards)
+
+    def _info(self, msg):
+        self.deefuzzer._info(msg)
+
+    def _err(self, msg):
+        self.deefuzzer._err(msg)
+
+    def start_worker(self, shard):
+        self.controls[shard] = multiprocessing.Queue()
+        p = multiprocessing.Process(target=run_shard,
+                                    name='deefuzzer-shard-%d' % shard,
+                                    args=(self.deefuzzer.conf_file, shard, list(self.shards),
+                                          self.log_queue, self.controls[shard]))
+        p.daemon = True
+        p.start()
+        self.workers[shard] = p
+        self.started[shard] = time.time()
+
+    def retire_worker(self, shard):
+        self.shards.remove(shard)
+        del self.workers[shard]
+        del self.controls[shard]
+        self.deefuzzer.shard_metrics.pop(shard, None)
+        self._err('Shard %d keeps crashing, rebalancing its stations' % shard)
+        self.broadcast('shards', list(self.shards))
+
+    def broadcast(self, command, value):
+        """Sends a command to all the worker processes"""
+        for control in self.controls.values():
+            control.put((command, value))
+
+    def check_worker(self, shard):
+        p = self.workers[shard]
+        if p.is_alive():
+            return
+        if time.time() - self.started[shard] > self.stable_time:
+            self.failures[shard] = 0
+        self.failures[shard] += 1
+        self._err('Shard %d died (exit code %s)' % (shard, p.exitcode))
+        if self.failures[shard] > self.max_restarts and len(self.shards) > 1:
+            self.retire_worker(shard)
+            return
+        self._info('Restarting shard %d (try %d)' % (shard, self.failures[shard]))
+        self.start_worker(shard)
+
+    def run(self):
+        LogForwarder(self.log_queue, self.deefuzzer.log_queue, self.deefuzzer.shard_metrics,
+                     self.deefuzzer.served_files).start()
+        self.deefuzzer.start_metrics()
+        self.deefuzzer.supervisor = self
+        self.deefuzzer.start_control_socket()
+        self._info('Splitting stations across %d processes' % self.count)
+        for shard in self.shards:
+            self.start_worker(shard)
+        while True:
+            time.sleep(1)
+            for shard in list(self.shards):
+                self.check_worker(shard)
@@ -47,14 +47,55 @@ import urllib
 import mimetypes
 import json
 import hashlib
+import itertools
 
 from threading import Thread
 from player import *
 from recorder import *
 from relay import *
 from streamer import *
+from engine import *
+from feeds import *
 from tools import *
 
+# libshout connection states
+SHOUTERR_CONNECTED = getattr(shout, 'SHOUTERR_CONNECTED', -7)
+SHOUTERR_BUSY = getattr(shout, 'SHOUTERR_BUSY', -10)
+
+
+class Track(object):
+    """A media ready to be played by a station: its metadata, and a player
+    on the file whose stream may already hold the first chunk"""
+
+    def __init__(self, media):
+        self.media = media
+        self.media_obj = MediaBase()
+        self.title = ''
+        self.artist = ''
+        self.song = ''
+        self.frame_index = None
+        self.player = None
+        self.stream = None
+        self.status_id = 0
+
+
+class TrackPrefetch(Thread):
+    """Prepares the next track of a station while the current one plays"""
+
+    def __init__(self, station):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.station = station
+        self.track = None
+
+    def run(self):
+        self.track = self.station.prefetch_next_track()
+
+    def get(self):
+        """Waits for the preparation and returns the Track, or None"""
+        self.join()
+        return self.track
+
 
 class Station(Thread):
     """a DeeFuzzer shouting station thread"""
@@ -73,7 +114,21 @@ class Station(Thread):
     twitter_mode = 0
     jingles_mode = 0
     relay_mode = 0
+    relay_buffer_size = 8
+    relay_buffer_time = 30
+    relay_buffer_policy = 'drop'
     record_mode = 0
+    record_fsync = 'never'
+    record_buffer_size = 16
+    record_segment_time = 0
+    record_segment_size = 0
+    record_retention_days = 0
+    record_retention_size = 0
+    hls_mode = 0
+    hls_segment_time = 10
+    hls_window = 6
+    hls = None
+    mirrors = []
     run_mode = 1
     appendtype = 0
     feeds_json = 0
@@ -82,17 +137,46 @@ class Station(Thread):
     feeds_playlist = 1
     feeds_showfilepath = 0
     feeds_showfilename = 0
+    feeds_gzip = 1
+    media_watch = 0
+    media_frameindex = 0
+    media_zerocopy = 0
+    media_prefetch = 0
+    prefetch = None
+    track = None
+    track_end = None
+    status_id = 0
+    frame_index = None
+    resume_media = None
+    resume_position = 0
+    status_interval = 10
+    status_time = 0
     short_name = ''
     channelIsOpen = False
     starting_id = -1
     jingles_frequency = 2
     statusfile = ''
     base_directory = ''
-
-    def __init__(self, station, q, logqueue, m3u):
+    engine_running = False
+    exit_callback = None
+    stopping = False
+    pending_station = None
+    media_index = None
+    library_watch = None
+    relay_reader = None
+    send_queue_limit = 0x40000
+    open_timeout = 10
+    relay_poll_interval = 0.1
+    profile_dir = '.'
+    profile_interval = None
+
+    def __init__(self, station, io, logqueue, m3u):
         Thread.__init__(self)
         self.station = station
-        self.q = q
+        self.io = io
+        self.io_stats = IOStats()
+        self.metrics = StationMetrics()
+        self.feeds_builders = {}
         self.logqueue = logqueue
         self.m3u = m3u
 
@@ -103,11 +187,27 @@ class Station(Thread):
             try:
                 if os.path.exists(self.statusfile):
                     f = open(self.statusfile, 'r')
-                    self.starting_id = int(f.read())
+                    status = f.read().split('\n')
                     f.close()
+                    self.starting_id = int(status[0])
+                    if len(status) > 2 and status[1]:
+                        # The track which was playing and the position reached in it
+                        self.resume_media = status[1]
+                        self.resume_position = float(status[2])
             except:
                 pass
 
+        if 'station_mediaindex' in self.station:
+            try:
+                self.media_index = get_media_index(self.station['station_mediaindex'])
+            except Exception, e:
+                self._err('Could not open the media index: %s' % str(e))
+
+        if 'station_profiledir' in self.station:
+            self.profile_dir = self.station['station_profiledir']
+        if 'station_profileinterval' in self.station:
+            self.profile_interval = self.station['station_profileinterval']
+
         if 'base_dir' in self.station:
             self.base_directory = self.station['base_dir'].strip()
 
@@ -130,6 +230,14 @@ class Station(Thread):
         self.ogg_quality = int(self.station['media']['ogg_quality'])
         self.samplerate = int(self.station['media']['samplerate'])
         self.voices = int(self.station['media']['voices'])
+        if 'watch' in self.station['media']:
+            self.media_watch = int(self.station['media']['watch'])
+        if 'frameindex' in self.station['media']:
+            self.media_frameindex = int(self.station['media']['frameindex'])
+        if 'zerocopy' in self.station['media']:
+            self.media_zerocopy = int(self.station['media']['zerocopy'])
+        if 'prefetch' in self.station['media']:
+            self.media_prefetch = int(self.station['media']['prefetch'])
 
         # Server
         if 'mountpoint' in self.station['server']:
@@ -149,82 +257,30 @@ class Station(Thread):
         else:
             self.type = 'icecast'
 
-        if 'stream-m' in self.type:
-            self.channel = HTTPStreamer()
-            self.channel.mount = '/publish/' + self.mountpoint
-        elif 'icecast' in self.type:
-            self.channel = shout.Shout()
-            self.channel.mount = '/' + self.mountpoint
-            if self.appendtype:
-                self.channel.mount = self.channel.mount + '.' + self.media_format
-        else:
+        self.channel = self.create_channel(self.station['server'])
+        if self.channel is None:
             self._err('Not a compatible server type. Choose "stream-m" or "icecast".')
             return
-
-        self.channel.url = self.station['infos']['url']
-        self.channel.name = self.station['infos']['name']
-        self.channel.genre = self.station['infos']['genre']
-        self.channel.description = self.station['infos']['description']
-        self.channel.format = self.media_format
-        self.channel.host = self.station['server']['host']
-        self.channel.port = int(self.station['server']['port'])
-        self.channel.user = 'source'
-        self.channel.password = self.station['server']['sourcepassword']
-        self.channel.public = int(self.station['server']['public'])
-        if self.channel.format == 'mp3':
-            self.channel.audio_info = {'bitrate': str(self.bitrate),
-                                       'samplerate': str(self.samplerate),
-                                       'channels': str(self.voices), }
-        else:
-            self.channel.audio_info = {'bitrate': str(self.bitrate),
-                                       'samplerate': str(self.samplerate),
-                                       'quality': str(self.ogg_quality),
-                                       'channels': str(self.voices), }
+        self.create_mirrors()
 
         self.server_url = 'http://' + self.channel.host + ':' + str(self.channel.port)
         self.channel_url = self.server_url + self.channel.mount
 
-        # RSS
-        if 'feeds' in self.station:
-            self.station['rss'] = self.station['feeds']
-
-        if 'rss' in self.station:
-            if 'mode' in self.station['rss']:
-                self.feeds_mode = int(self.station['rss']['mode'])
-            self.feeds_dir = self._path_add_base(self.station['rss']['dir'])
-            self.feeds_enclosure = int(self.station['rss']['enclosure'])
-            if 'json' in self.station['rss']:
-                self.feeds_json = int(self.station['rss']['json'])
-            if 'rss' in self.station['rss']:
-                self.feeds_rss = int(self.station['rss']['rss'])
-            if 'playlist' in self.station['rss']:
-                self.feeds_playlist = int(self.station['rss']['playlist'])
-            if 'showfilename' in self.station['rss']:
-                self.feeds_showfilename = int(self.station['rss']['showfilename'])
-            if 'showfilepath' in self.station['rss']:
-                self.feeds_showfilepath = int(self.station['rss']['showfilepath'])
-
-            self.feeds_media_url = self.channel.url + '/media/'
-            if 'media_url' in self.station['rss']:
-                if not self.station['rss']['media_url'] == '':
-                    self.feeds_media_url = self.station['rss']['media_url']
-
-        self.base_name = self.feeds_dir + os.sep + self.short_name + '_' + self.channel.format
-        self.feeds_current_file = self.base_name + '_current'
-        self.feeds_playlist_file = self.base_name + '_playlist'
-
         # Logging
         self._info('Opening ' + self.short_name + ' - ' + self.channel.name)
 
-        self.metadata_relative_dir = 'metadata'
-        self.metadata_url = self.channel.url + '/rss/' + self.metadata_relative_dir
-        self.metadata_dir = self.feeds_dir + os.sep + self.metadata_relative_dir
-        if not os.path.exists(self.metadata_dir):
-            os.makedirs(self.metadata_dir)
+        # RSS
+        self.set_feeds_options()
 
         # The station's player
         self.player = Player(self.type)
 
+        # Watch the media folder instead of scanning it before each track
+        if self.media_watch and self.media_source and os.path.isdir(self.media_source):
+            self.library_watch = watch_library(self.media_source, self.channel.format)
+            if not self.library_watch:
+                self._err('inotify is not available (pyinotify is required), scanning the media folder instead')
+
         # OSCing
         # mode = 0 means Off, mode = 1 means On
         if 'control' in self.station:
@@ -240,26 +296,39 @@ class Station(Thread):
                 self.osc_controller.add_method('/record', 'i', self.record_callback)
                 self.osc_controller.add_method('/player', 'i', self.player_callback)
                 self.osc_controller.add_method('/run', 'i', self.run_callback)
+                self.osc_controller.add_method('/profile', 'i', self.profile_callback)
                 self.osc_controller.start()
 
         # Jingling between each media.
-        if 'jingles' in self.station:
-            if 'mode' in self.station['jingles']:
-                self.jingles_mode = int(self.station['jingles']['mode'])
-            if 'shuffle' in self.station['jingles']:
-                self.jingles_shuffle = int(self.station['jingles']['shuffle'])
-            if 'frequency' in self.station['jingles']:
-                self.jingles_frequency = int(self.station['jingles']['frequency'])
-            if 'dir' in self.station['jingles']:
-                self.jingles_dir = self._path_add_base(self.station['jingles']['dir'])
-            if self.jingles_mode == 1:
-                self.jingles_callback('/jingles', [1])
+        self.set_jingles_options()
+
+        # HLS output
+        if 'hls' in self.station:
+            self.hls_mode = int(self.station['hls']['mode'])
+            self.hls_dir = self._path_add_base(self.station['hls']['dir'])
+            if 'segment_time' in self.station['hls']:
+                self.hls_segment_time = float(self.station['hls']['segment_time'])
+            if 'window' in self.station['hls']:
+                self.hls_window = int(self.station['hls']['window'])
+            if self.hls_mode:
+                self.hls = HlsWriter(self.hls_dir, self.short_name.replace('/', '_'), self.channel.format,
+                                     self.hls_segment_time, self.hls_window, metrics=self.metrics)
+                self.hls.open()
 
         # Relaying
         if 'relay' in self.station:
             self.relay_mode = int(self.station['relay']['mode'])
             self.relay_url = self.station['relay']['url']
             self.relay_author = self.station['relay']['author']
+            if 'buffer_size' in self.station['relay']:
+                self.relay_buffer_size = float(self.station['relay']['buffer_size'])
+            if 'buffer_time' in self.station['relay']:
+                self.relay_buffer_time = float(self.station['relay']['buffer_time'])
+            if 'buffer_policy' in self.station['relay']:
+                self.relay_buffer_policy = self.station['relay']['buffer_policy']
+            self.player.relay_buffer_size = int(min(self.relay_buffer_size * 0x100000,
+                                                    self.relay_buffer_time * self.bitrate * 125))
+            self.player.relay_buffer_policy = self.relay_buffer_policy
             if self.relay_mode == 1:
                 self.relay_callback('/media/relay', [1])
 
@@ -283,6 +352,18 @@ class Station(Thread):
         if 'record' in self.station:
             self.record_mode = int(self.station['record']['mode'])
             self.record_dir = self._path_add_base(self.station['record']['dir'])
+            if 'fsync' in self.station['record']:
+                self.record_fsync = str(self.station['record']['fsync'])
+            if 'buffer_size' in self.station['record']:
+                self.record_buffer_size = float(self.station['record']['buffer_size'])
+            if 'segment_time' in self.station['record']:
+                self.record_segment_time = int(self.station['record']['segment_time'])
+            if 'segment_size' in self.station['record']:
+                self.record_segment_size = float(self.station['record']['segment_size'])
+            if 'retention_days' in self.station['record']:
+                self.record_retention_days = float(self.station['record']['retention_days'])
+            if 'retention_size' in self.station['record']:
+                self.record_retention_size = float(self.station['record']['retention_size'])
             if self.record_mode:
                 self.record_callback('/record', [1])
 
@@ -307,6 +388,98 @@ class Station(Thread):
     def _err(self, msg):
         self._log('err', msg)
 
+    def set_feeds_options(self):
+        """Reads the feeds section.  The options missing from it get their
+        default value back when the station is reconfigured"""
+        if 'feeds' in self.station:
+            self.station['rss'] = self.station['feeds']
+
+        if 'rss' in self.station:
+            options = self.station['rss']
+            self.feeds_mode = int(options.get('mode', Station.feeds_mode))
+            self.feeds_dir = self._path_add_base(options['dir'])
+            self.feeds_enclosure = int(options['enclosure'])
+            self.feeds_json = int(options.get('json', Station.feeds_json))
+            self.feeds_rss = int(options.get('rss', Station.feeds_rss))
+            self.feeds_playlist = int(options.get('playlist', Station.feeds_playlist))
+            self.feeds_showfilename = int(options.get('showfilename', Station.feeds_showfilename))
+            self.feeds_showfilepath = int(options.get('showfilepath', Station.feeds_showfilepath))
+            self.feeds_gzip = int(options.get('gzip', Station.feeds_gzip))
+
+            self.feeds_media_url = self.channel.url + '/media/'
+            if 'media_url' in options:
+                if not options['media_url'] == '':
+                    self.feeds_media_url = options['media_url']
+
+        self.base_name = self.feeds_dir + os.sep + self.short_name + '_' + self.channel.format
+        self.feeds_current_file = self.base_name + '_current'
+        self.feeds_playlist_file = self.base_name + '_playlist'
+
+        self.metadata_relative_dir = 'metadata'
+        self.metadata_url = self.channel.url + '/rss/' + self.metadata_relative_dir
+        self.metadata_dir = self.feeds_dir + os.sep + self.metadata_relative_dir
+        if not os.path.exists(self.metadata_dir):
+            os.makedirs(self.metadata_dir)
+
+        # The builders keep the options they were created with
+        self.feeds_builders = {}
+
+    def set_jingles_options(self):
+        """Reads the jingles section, also when the station is reconfigured"""
+        if 'jingles' in self.station:
+            options = self.station['jingles']
+            self.jingles_mode = int(options.get('mode', Station.jingles_mode))
+            self.jingles_frequency = int(options.get('frequency', Station.jingles_frequency))
+            if 'shuffle' in options:
+                self.jingles_shuffle = int(options['shuffle'])
+            if 'dir' in options:
+                self.jingles_dir = self._path_add_base(options['dir'])
+            if self.jingles_mode == 1:
+                self.jingles_callback('/jingles', [1])
+        else:
+            self.jingles_mode = 0
+
+    def reconfigure(self, station):
+        """Takes a new definition of the station differing from the current
+        one only by options which apply without reconnecting: the jingles,
+        the shuffle mode and the feeds.  They are applied by the station
+        itself at the start of the next track."""
+        self.pending_station = station
+
+    def apply_pending_station(self):
+        station = self.pending_station
+        if station is None:
+            return
+        self.pending_station = None
+        self.station = station
+        self.shuffle_mode = int(self.station['media']['shuffle'])
+        self.set_jingles_options()
+        self.set_feeds_options()
+        self._info('Applied the new jingles, shuffle and feeds options')
+
+    def stop(self):
+        """Ends the station for good: the stream stops at the next chunk, then
+        the outputs and the channel are closed and exit_callback is called"""
+        self.stopping = True
+        if self.osc_control_mode:
+            self.osc_controller.stop()
+        if self.relay_mode and self.type == 'icecast':
+            self.player.stop_relay()
+        self.close_relay_reader()
+        self.close_library_watch()
+
+    def close_library_watch(self):
+        """Detaches the station from the watched library, if any.  The watch
+        is kept, the station thread may still be choosing a track with it."""
+        if self.library_watch:
+            self.library_watch.close()
+
+    def close_relay_reader(self):
+        """Closes the connection of the stream-m relay, if any"""
+        if self.relay_reader:
+            self.relay_reader.close()
+            self.relay_reader = None
+
     def run_callback(self, path, value):
         value = value[0]
         self.run_mode = value
@@ -364,11 +537,24 @@ class Station(Thread):
         if value:
             if not os.path.exists(self.record_dir):
                 os.makedirs(self.record_dir)
-            self.rec_file = self.short_name.replace('/', '_') + '-'
-            self.rec_file += datetime.datetime.now().strftime("%x-%X").replace('/', '_')
-            self.rec_file += '.' + self.channel.format
-            self.recorder = Recorder(self.record_dir)
-            self.recorder.open(self.rec_file)
+            if self.record_segment_time or self.record_segment_size:
+                self.recorder = SegmentedRecorder(self.record_dir, self.short_name.replace('/', '_'),
+                                                  self.channel.format, self.record_fsync,
+                                                  int(self.record_buffer_size * 0x100000), self.metrics,
+                                                  self.record_segment_time,
+                                                  int(self.record_segment_size * 0x100000),
+                                                  self.record_retention_days * 86400,
+                                                  int(self.record_retention_size * 0x100000),
+                                                  self._info)
+                self.recorder.open()
+                self.recorder.mark(self.song)
+            else:
+                self.rec_file = self.short_name.replace('/', '_') + '-'
+                self.rec_file += datetime.datetime.now().strftime("%x-%X").replace('/', '_')
+                self.rec_file += '.' + self.channel.format
+                self.recorder = Recorder(self.record_dir, self.record_fsync,
+                                         int(self.record_buffer_size * 0x100000), self.metrics)
+                self.recorder.open(self.rec_file)
         else:
             try:
                 self.recorder.recording = False
@@ -376,7 +562,8 @@ class Station(Thread):
             except:
                 pass
 
-            if self.type == 'icecast':
+            # The segments are not tagged, their tracks are in the index
+            if self.type == 'icecast' and not isinstance(self.recorder, SegmentedRecorder):
                 date = datetime.datetime.now().strftime("%Y")
                 media = None
                 if self.channel.format == 'mp3':
@@ -401,40 +588,47 @@ class Station(Thread):
         message = "received OSC message '%s' with arguments '%d'" % (path, value)
         self._info(message)
 
+    def profile_callback(self, path, value):
+        value = value[0]
+        message = "received OSC message '%s' with arguments '%d'" % (path, value)
+        self._info(message)
+        if value > 0:
+            path = start_profiler(self.profile_dir, self.short_name, value, self,
+                                  self.profile_interval, self._info)
+            self._info('Profiling for %d s to %s' % (value, path))
+
     def get_playlist(self):
         file_list = []
 
         try:
             if os.path.isdir(self.media_source):
-                self.q.get(1)
-                try:
-                    for root, dirs, files in os.walk(self.media_source):
-                        for file in files:
-                            s = file.split('.')
-                            ext = s[len(s) - 1]
-                            if ext.lower() == self.channel.format and not os.sep + '.' in file:
-                                file_list.append(root + os.sep + file)
-                    file_list.sort()
-                except:
-                    pass
-                self.q.task_done()
+                with self.io.access('library', self.media_source, self.io_stats):
+                    try:
+                        for root, dirs, files in os.walk(self.media_source):
+                            for file in files:
+                                s = file.split('.')
+                                ext = s[len(s) - 1]
+                                if ext.lower() == self.channel.format and not os.sep + '.' in file:
+                                    file_list.append(root + os.sep + file)
+                        file_list.sort()
+                    except:
+                        pass
 
             if os.path.isfile(self.media_source):
-                self.q.get(1)
-                try:
-                    f = open(self.media_source, 'r')
+                with self.io.access('library', self.media_source, self.io_stats):
                     try:
-                        for path in f.readlines():
-                            path = path.strip()
-                            if '#' != path[0]:
-                                fp = self._path_m3u_rel(path)
-                                if os.path.isfile(fp):
-                                    file_list.append(fp)
+                        f = open(self.media_source, 'r')
+                        try:
+                            for path in f.readlines():
+                                path = path.strip()
+                                if '#' != path[0]:
+                                    fp = self._path_m3u_rel(path)
+                                    if os.path.isfile(fp):
+                                        file_list.append(fp)
+                        except:
+                            f.close()
                     except:
-                        f.close()
-                except:
-                    pass
-                self.q.task_done()
+                        pass
         except:
             pass
 
@@ -467,195 +661,263 @@ class Station(Thread):
                 message = message[:113] + self.feeds_url
                 self.update_twitter(message)
 
-    def get_next_media(self):
-        # Init playlist
-        if self.lp:
-            playlist = self.playlist
-            new_playlist = self.get_playlist()
-            lp_new = len(new_playlist)
+    def update_playlist_from_watch(self):
+        """Applies the changes reported by the library watcher to the playlist"""
+        if not self.counter:
+            self.playlist = self.library_watch.get_files()
+            self.lp = len(self.playlist)
+            self.id = 0
+            if -1 < self.starting_id < self.lp:
+                self.id = self.starting_id
 
-            if not self.counter:
-                self.id = 0
-                if -1 < self.starting_id < lp_new:
-                    self.id = self.starting_id
-                self.playlist = new_playlist
-                self.lp = lp_new
+            # Shake it, Fuzz it !
+            if self.shuffle_mode:
+                random.shuffle(self.playlist)
 
-                # Shake it, Fuzz it !
-                if self.shuffle_mode:
-                    random.shuffle(self.playlist)
+            self._info('Generating new playlist (' + str(self.lp) + ' tracks)')
+            return
 
-                self._info('Generating new playlist (' + str(self.lp) + ' tracks)')
+        added, removed = self.library_watch.get_changes()
+        if not added and not removed:
+            return
 
-            # use a hash check instead to detect when a filename changes as well as playlist length
-            # Also, recompute the hash every time for the built-in playlist so we can catch when that
-            # changes as well
-            elif self.get_array_hash(new_playlist) != self.get_array_hash(self.playlist):
-                self.id += 1
-                if self.id >= lp_new:
-                    self.id = 0
-                else:
-                    self.lp = lp_new
+        playlist = self.playlist
+        if removed:
+            # Keep the position on the track which was going to be played next
+            self.id -= len([track for track in playlist[:self.id] if track in removed])
+            playlist = [track for track in playlist if track not in removed]
+
+        self.new_tracks = sorted(added)
+        if self.new_tracks:
+            if self.twitter_mode == 1:
+                self.tweet()
+
+            # Shake it, Fuzz it !
+            if self.shuffle_mode:
+                random.shuffle(playlist)
+
+            # Play new tracks first
+            for track in self.new_tracks:
+                playlist.insert(0, track)
+            self.id = 0
+
+        self.playlist = playlist
+        self.lp = len(self.playlist)
+        if self.id >= self.lp:
+            self.id = 0
+
+        self._info('Updating playlist (%d added, %d removed, %d tracks)' % (len(added), len(removed), self.lp))
+
+    def update_playlist_from_scan(self):
+        """Scans the media source and updates the playlist if it has changed"""
+        playlist = self.playlist
+        new_playlist = self.get_playlist()
+        lp_new = len(new_playlist)
+
+        if not self.counter:
+            self.id = 0
+            if -1 < self.starting_id < lp_new:
+                self.id = self.starting_id
+            self.playlist = new_playlist
+            self.lp = lp_new
+
+            # Shake it, Fuzz it !
+            if self.shuffle_mode:
+                random.shuffle(self.playlist)
+
+            self._info('Generating new playlist (' + str(self.lp) + ' tracks)')
+
+        # use a hash check instead to detect when a filename changes as well as playlist length
+        # Also, recompute the hash every time for the built-in playlist so we can catch when that
+        # changes as well
+        elif self.get_array_hash(new_playlist) != self.get_array_hash(self.playlist):
+            self.id += 1
+            if self.id >= lp_new:
+                self.id = 0
+            else:
+                self.lp = lp_new
 
-                # Twitting new tracks
-                new_playlist_set = set(new_playlist)
-                playlist_set = set(playlist)
-                new_tracks = new_playlist_set - playlist_set
-                self.new_tracks = list(new_tracks.copy())
+            # Twitting new tracks
+            new_playlist_set = set(new_playlist)
+            playlist_set = set(playlist)
+            new_tracks = new_playlist_set - playlist_set
+            self.new_tracks = list(new_tracks.copy())
 
-                if self.twitter_mode == 1 and self.counter:
-                    self.tweet()
+            if self.twitter_mode == 1 and self.counter:
+                self.tweet()
 
-                # Shake it, Fuzz it !
-                if self.shuffle_mode:
-                    random.shuffle(playlist)
+            # Shake it, Fuzz it !
+            if self.shuffle_mode:
+                random.shuffle(playlist)
 
-                # Play new tracks first
-                for track in self.new_tracks:
-                    playlist.insert(0, track)
+            # Play new tracks first
+            for track in self.new_tracks:
+                playlist.insert(0, track)
 
-                self.playlist = playlist
+            self.playlist = playlist
 
-                self._info('Generating new playlist (' + str(self.lp) + ' tracks)')
+            self._info('Generating new playlist (' + str(self.lp) + ' tracks)')
 
-            if self.jingles_mode and not (self.counter % self.jingles_frequency) and self.jingles_length:
+    def pick_next_media(self):
+        """Chooses the next media in the playlist or the jingles and moves
+        the playlist position.  Returns None if there is no media"""
+        if self.lp:
+            if self.library_watch:
+                self.update_playlist_from_watch()
+            else:
+                self.update_playlist_from_scan()
+
+        if self.lp:
+            if self.resume_media and not (self.media_frameindex and self.resume_media in self.playlist
+                                          and os.path.exists(self.resume_media)):
+                self.resume_media = None
+
+            if self.resume_media:
+                # Restarting: play the interrupted track again, set_read_mode seeks in it
+                media = self.resume_media
+            elif self.jingles_mode and not (self.counter % self.jingles_frequency) and self.jingles_length:
                 media = self.jingles_list[self.jingle_id]
                 self.jingle_id = (self.jingle_id + 1) % self.jingles_length
             else:
                 media = self.playlist[self.id]
                 self.id = (self.id + 1) % self.lp
-
-            self.q.get(1)
-            try:
-                f = open(self.statusfile, 'w')
-                f.write(str(self.id))
-                f.close()
-                if self.feeds_playlist:
-                    self.update_feeds(self.media_to_objs(self.playlist), self.feeds_playlist_file, '(playlist)')
-            except:
-                pass
-            self.q.task_done()
             return media
-        else:
+        return None
+
+    def get_next_media(self):
+        media = self.pick_next_media()
+        if media is None:
             mess = 'No media in source!'
             self._err(mess)
             self.run_mode = 0
+            return None
+
+        self.status_id = self.id
+        try:
+            self.write_status(media, self.resume_position if self.resume_media else 0)
+            if self.feeds_playlist:
+                self.update_feeds(self.media_to_objs(self.playlist), self.feeds_playlist_file, '(playlist)')
+        except:
+            pass
+        return media
+
+    def write_status(self, media=None, position=0):
+        """Writes the next playlist id, the current track and the position in
+        this track to the status file"""
+        status = str(self.status_id)
+        if media and self.media_frameindex:
+            status += '\n%s\n%.3f' % (media, position)
+        with self.io.access('status', self.statusfile, self.io_stats):
+            write_file_atomic(self.statusfile, status)
+        self.status_time = time.time()
+
+    def write_outputs(self, chunk):
+        """Writes a chunk sent to the stream to the recording and the HLS
+        segments"""
+        if self.record_mode:
+            try:
+                # Record the chunk
+                self.recorder.write(chunk)
+            except:
+                self._err('could not write the buffer to the file')
+        if self.hls:
+            self.hls.write(chunk)
+
+    def close_outputs(self):
+        if self.record_mode:
+            self.recorder.close()
+        if self.hls:
+            self.hls.close()
+
+    def update_status_position(self):
+        """Saves the position in the current track every status_interval seconds,
+        so that a restarted station can resume where it was"""
+        if not self.frame_index or time.time() - self.status_time < self.status_interval:
+            return
+        try:
+            self.write_status(self.media, self.frame_index.time_at(self.track.player.position))
+        except:
+            self.status_time = time.time()
+
+    def get_frame_index(self, path):
+        """Returns the frame index of a MP3 file, from the media index if possible"""
+        frame_index = None
+        if self.media_index:
+            frame_index = self.media_index.get_frame_index(path)
+        if frame_index is None:
+            with self.io.access('media', None, self.io_stats):
+                frame_index = Mp3FrameIndex().build(path)
+            if self.media_index:
+                self.media_index.put_frame_index(path, frame_index)
+        return frame_index
 
     def media_to_objs(self, media_list):
         media_objs = []
         for media in media_list:
+            if self.media_index:
+                file_meta = self.media_index.get(media)
+                if file_meta:
+                    media_objs.append(file_meta)
+                    continue
+
             file_meta = MediaBase()
             file_name, file_title, file_ext = get_file_info(media)
-            self.q.get(1)
             try:
-                if file_ext.lower() == 'mp3' or mimetypes.guess_type(media)[0] == 'audio/mpeg':
-                    file_meta = Mp3(media)
-                elif file_ext.lower() == 'ogg' or mimetypes.guess_type(media)[0] == 'audio/ogg':
-                    file_meta = Ogg(media)
-                elif file_ext.lower() == 'webm' or mimetypes.guess_type(media)[0] == 'video/webm':
-                    file_meta = WebM(media)
+                with self.io.access('media', None, self.io_stats):
+                    if file_ext.lower() == 'mp3' or mimetypes.guess_type(media)[0] == 'audio/mpeg':
+                        file_meta = Mp3(media)
+                    elif file_ext.lower() == 'ogg' or mimetypes.guess_type(media)[0] == 'audio/ogg':
+                        file_meta = Ogg(media)
+                    elif file_ext.lower() == 'webm' or mimetypes.guess_type(media)[0] == 'video/webm':
+                        file_meta = WebM(media)
+                if self.media_index and file_meta.media:
+                    self.media_index.put(file_meta)
             except Exception, e:
                 self._err('Could not get specific media type class for %s' % (media))
                 self._err('Error: %s' % (str(e)))
                 pass
-            self.q.task_done()
             media_objs.append(file_meta)
+
+        if self.media_index:
+            # Newly parsed files are written in one transaction, so that the
+            # first call on a whole playlist warms the index in bulk
+            try:
+                with self.io.access('index', self.media_index.path, self.io_stats):
+                    self.media_index.flush()
+            except Exception, e:
+                self._err('Could not update the media index: %s' % str(e))
         return media_objs
 
+    def get_feed_builder(self, rss_file):
+        if rss_file not in self.feeds_builders:
+            self.feeds_builders[rss_file] = FeedBuilder(self.channel.url, self.channel.description,
+                                                        self.feeds_media_url, self.metadata_url,
+                                                        self.feeds_enclosure, self.feeds_showfilepath,
+                                                        self.feeds_showfilename)
+        return self.feeds_builders[rss_file]
+
     def update_feeds(self, media_list, rss_file, sub_title):
         if not self.feeds_mode:
             return
 
-        rss_item_list = []
         if not os.path.exists(self.feeds_dir):
             os.makedirs(self.feeds_dir)
         channel_subtitle = self.channel.name + ' ' + sub_title
-        _date_now = datetime.datetime.now()
-        date_now = str(_date_now)
-        media_absolute_playtime = _date_now
-        json_data = []
+        rss_data, json_data = self.get_feed_builder(rss_file).build(media_list, channel_subtitle,
+                                                                    self.feeds_rss, self.feeds_json)
 
-        for media in media_list:
-            json_item = {}
-            media_stats = os.stat(media.media)
-            media_date = time.localtime(media_stats[8])
-            media_date = time.strftime("%a, %d %b %Y %H:%M:%S +0200", media_date)
-            media.metadata['Duration'] = str(media.length).split('.')[0]
-            media.metadata['Bitrate'] = str(media.bitrate) + ' kbps'
-            media.metadata['StartTime'] = str(media_absolute_playtime).split('.')[0]
-            media.metadata['EndTime'] = str(media_absolute_playtime+media.length).split('.')[0]
-
-            media_description = '<table>'
-            media_description_item = '<tr><td>%s:   </td><td><b>%s</b></td></tr>'
-
-            for key in media.metadata.keys():
-                if media.metadata[key] != '':
-                    if key == 'filepath' and not self.feeds_showfilepath:
-                        continue
-                    if key == 'filename' and not self.feeds_showfilename:
-                        continue
-                    media_description += media_description_item % (key.capitalize(),
-                                                                   media.metadata[key])
-                    json_item[key] = media.metadata[key]
-            if self.feeds_showfilepath:
-                media_description += media_description_item % ('Filepath', media.media)
-                json_item['filepath'] = media.media
-            if self.feeds_showfilename:
-                media_description += media_description_item % ('Filename', media.file_name)
-                json_item['filename'] = media.file_name
-            media_description += '</table>'
-
-            title, artist, song = self.get_songmeta(media)
-            media_absolute_playtime += media.length
-
-            if self.feeds_enclosure == '1':
-                media_link = self.feeds_media_url + media.file_name
-                media_link = media_link.decode('utf-8')
-                rss_item_list.append(RSSItem(
-                    title=song,
-                    link=media_link,
-                    description=media_description,
-                    enclosure=Enclosure(media_link, str(media.size), 'audio/mpeg'),
-                    guid=Guid(media_link),
-                    pubDate=media_date, )
-                )
-            else:
-                media_link = self.metadata_url + '/' + media.file_name + '.xml'
-                try:
-                    media_link = media_link.decode('utf-8')
-                except:
-                    continue
-                rss_item_list.append(RSSItem(
-                    title=song,
-                    link=media_link,
-                    description=media_description,
-                    guid=Guid(media_link),
-                    pubDate=media_date, )
-                )
-            json_data.append(json_item)
-
-        rss = RSS2(title=channel_subtitle,
-                   link=self.channel.url,
-                   description=self.channel.description.decode('utf-8'),
-                   lastBuildDate=date_now,
-                   items=rss_item_list, )
-        self.q.get(1)
-        try:
-            if self.feeds_rss:
-                f = open(rss_file + '.xml', 'w')
-                rss.write_xml(f, 'utf-8')
-                f.close()
-        except:
-            pass
+        with self.io.access('feed', rss_file, self.io_stats):
+            try:
+                if self.feeds_rss:
+                    write_file_atomic(rss_file + '.xml', rss_data, self.feeds_gzip)
+            except:
+                pass
 
-        try:
-            if self.feeds_json:
-                f = open(rss_file + '.json', 'w')
-                f.write(json.dumps(json_data, separators=(',', ':')))
-                f.close()
-        except:
-            pass
-        self.q.task_done()
+            try:
+                if self.feeds_json:
+                    write_file_atomic(rss_file + '.json', json_data, self.feeds_gzip)
+            except:
+                pass
 
     def update_twitter(self, message):
         try:
@@ -666,13 +928,16 @@ class Station(Thread):
 
     def set_relay_mode(self):
         self.prefix = '#nowplaying #LIVE'
+        self.frame_index = None
         self.title = ""
         self.artist = ""
         self.song = ""
 
         if self.type == 'stream-m':
-            relay = URLReader(self.relay_url)
-            self.channel.set_callback(relay.read_callback)
+            self.close_relay_reader()
+            relay = URLReader(self.relay_url, self._info)
+            self.relay_reader = relay
+            self.channel.set_callback(self.stream_m_callback(relay.read_callback))
             if self.record_mode:
                 relay.set_recorder(self.recorder)
         else:
@@ -707,33 +972,114 @@ class Station(Thread):
 
         self.title, self.artist, self.song = self.get_songmeta(self.current_media_obj)
 
-    def set_read_mode(self):
-        self.prefix = '#nowplaying'
+    def prepare_track(self, media, prime=False):
+        """Returns a Track for media with its metadata and its stream.  If
+        prime is True, the file is opened and its first chunk read"""
+        track = Track(media)
+        offset = 0
+        if self.media_frameindex and self.channel.format == 'mp3':
+            try:
+                track.frame_index = self.get_frame_index(media)
+                if self.resume_media == media:
+                    offset = track.frame_index.offset_at(media, self.resume_position)
+                    self._info('Resuming %s at %.1f s' % (media, self.resume_position))
+            except Exception, e:
+                self._err('Could not index the frames of %s: %s' % (media, str(e)))
 
         try:
-            self.get_currentsongmeta()
-            fn = self.current_media_obj.file_name
-            if fn:
-                self.metadata_file = self.metadata_dir + os.sep + fn + '.xml'
-            self.update_feeds([self.current_media_obj], self.feeds_current_file, '(currently playing)')
-            if fn:
-                self._info('DeeFuzzing:  id = %s, name = %s' % (self.id, fn))
+            track.media_obj = self.media_to_objs([media])[0]
         except:
-            pass
-        self.player.set_media(self.media)
+            self._info("Failed to get media object for %s" % (media))
+        track.title, track.artist, track.song = self.get_songmeta(track.media_obj)
+        if track.frame_index:
+            # Exact duration, even for VBR files without a Xing header
+            track.media_obj.length = datetime.timedelta(0, track.frame_index.get_duration())
+
+        track.player = Player(self.type)
+        track.player.set_media(media, offset)
+        # The generators open the media lazily, no I/O lock is needed here
+        cache = get_chunk_cache()
+        if self.media_zerocopy:
+            track.stream = track.player.file_read_mmap()
+        elif cache is not None:
+            track.stream = track.player.file_read_cached(cache, self.metrics)
+        elif self.player_mode:
+            track.stream = track.player.file_read_slow()
+        else:
+            track.stream = track.player.file_read_fast()
 
-        self.q.get(1)
+        if prime:
+            try:
+                track.stream = itertools.chain([track.stream.next()], track.stream)
+            except StopIteration:
+                pass
+            except Exception, e:
+                self._err('Could not read %s: %s' % (media, str(e)))
+        return track
+
+    def set_read_mode(self, track=None):
+        self.prefix = '#nowplaying'
+        if track is None:
+            track = self.prepare_track(self.media)
+        self.resume_media = None
+
+        self.track = track
+        self.frame_index = track.frame_index
+        self.current_media_obj = track.media_obj
+        self.title, self.artist, self.song = track.title, track.artist, track.song
+        self.stream = track.stream
+        fn = self.current_media_obj.file_name
+        if fn:
+            self.metadata_file = self.metadata_dir + os.sep + fn + '.xml'
+            self._info('DeeFuzzing:  id = %s, name = %s' % (self.id, fn))
+        if not self.media_prefetch:
+            self.update_current_feed()
+
+    def update_current_feed(self):
         try:
-            if self.player_mode:
-                self.stream = self.player.file_read_slow()
-            else:
-                self.stream = self.player.file_read_fast()
+            self.update_feeds([self.current_media_obj], self.feeds_current_file, '(currently playing)')
         except:
             pass
-        self.q.task_done()
+
+    def prefetch_next_track(self):
+        """Runs in a TrackPrefetch thread: updates the feeds of the track which
+        has just started, then chooses and prepares the next one"""
+        self.update_current_feed()
+        try:
+            media = self.pick_next_media()
+            if media is None or not os.path.exists(media) or os.sep + '.' in media:
+                return None
+            track = self.prepare_track(media, True)
+            track.status_id = self.id
+            if self.feeds_playlist:
+                self.update_feeds(self.media_to_objs(self.playlist), self.feeds_playlist_file, '(playlist)')
+            return track
+        except Exception, e:
+            self._err('Could not prepare the next track: ' + str(e))
+        return None
+
+    def get_prefetched_track(self):
+        """Returns the Track prepared during the current one, or None if there
+        is none or if it can not be played now"""
+        if self.prefetch is None:
+            return None
+        track = self.prefetch.get()
+        self.prefetch = None
+        if track is None or self.relay_mode:
+            return None
+        return track
 
     def set_webm_read_mode(self):
-        self.channel.set_callback(FileReader(self.media).read_callback)
+        self.channel.set_callback(self.stream_m_callback(FileReader(self.media).read_callback))
+
+    def stream_m_callback(self, read_callback):
+        """Wraps a read callback of the stream-m channel so that the upload
+        ends when the station is stopped"""
+        def callback(size):
+            if self.stopping:
+                return ''
+            return read_callback(size)
+        return callback
 
     def update_twitter_current(self):
         if not self.__twitter_should_update():
@@ -744,6 +1090,69 @@ class Station(Thread):
         message = message[:108] + ' > ' + self.m3u_url
         self.update_twitter(message)
 
+    def create_channel(self, server):
+        """Returns a new channel to a server section.  The options missing in
+        the section of a mirror are taken from the main server section."""
+        options = dict(self.station['server'])
+        options.update(server)
+        server_type = options.get('type', 'icecast')
+        mountpoint = options.get('mountpoint', self.mountpoint)
+
+        if 'stream-m' in server_type:
+            channel = HTTPStreamer()
+            channel.mount = '/publish/' + mountpoint
+        elif 'icecast' in server_type:
+            channel = shout.Shout()
+            channel.mount = '/' + mountpoint
+            if int(options.get('appendtype', 0)):
+                channel.mount = channel.mount + '.' + self.media_format
+        else:
+            return None
+
+        channel.url = self.station['infos']['url']
+        channel.name = self.station['infos']['name']
+        channel.genre = self.station['infos']['genre']
+        channel.description = self.station['infos']['description']
+        channel.format = self.media_format
+        channel.host = options['host']
+        channel.port = int(options['port'])
+        channel.user = 'source'
+        channel.password = options['sourcepassword']
+        channel.public = int(options['public'])
+        if channel.format == 'mp3':
+            channel.audio_info = {'bitrate': str(self.bitrate),
+                                  'samplerate': str(self.samplerate),
+                                  'channels': str(self.voices), }
+        else:
+            channel.audio_info = {'bitrate': str(self.bitrate),
+                                  'samplerate': str(self.samplerate),
+                                  'quality': str(self.ogg_quality),
+                                  'channels': str(self.voices), }
+        return channel
+
+    def create_mirrors(self):
+        self.mirrors = []
+        if self.type != 'icecast':
+            if self.station.get('server_mirrors'):
+                self._err('Mirrors are only supported by the icecast stations')
+            return
+        for server in self.station.get('server_mirrors', []):
+            channel = self.create_channel(server)
+            if channel is None:
+                self._err('Not a compatible mirror server type. Choose "stream-m" or "icecast".')
+                continue
+            name = '%s:%s%s' % (channel.host, channel.port, channel.mount)
+            self.mirrors.append(Mirror(name, lambda server=server: self.create_channel(server), self._info))
+
+    def start_mirrors(self):
+        for mirror in self.mirrors:
+            if not mirror.isAlive():
+                mirror.start()
+
+    def stop_mirrors(self):
+        for mirror in self.mirrors:
+            mirror.stop()
+
     def channel_open(self):
         if self.channelIsOpen:
             return True
@@ -753,6 +1162,7 @@ class Station(Thread):
             self.channel_delay = self.channel.delay()
             self._info('channel connected')
             self.channelIsOpen = True
+            self.metrics.start_stream(self.bitrate * 125)
             return True
         except:
             self._err('channel could not be opened')
@@ -767,24 +1177,110 @@ class Station(Thread):
         except:
             self._err('channel could not be closed')
 
-    def ping_server(self):
-        log = True
+    def channel_poll_open(self):
+        """Opens the channel in libshout nonblocking mode.  Returns True when
+        connected, None while the connection is in progress and False on error"""
+        if self.channelIsOpen:
+            return True
 
-        while not self.server_ping:
+        try:
+            self.channel.open()
+        except:
+            state = self.channel.get_connected()
+            if state == SHOUTERR_BUSY:
+                return None
+            if state != SHOUTERR_CONNECTED:
+                self._err('channel could not be opened')
+                return False
+
+        self._info('channel connected')
+        self.channelIsOpen = True
+        self.metrics.start_stream(self.bitrate * 125)
+        return True
+
+    def send_chunk(self, chunk):
+        """Queues a chunk for the mirrors and sends it to the channel"""
+        if self.track_end is not None:
+            self.metrics.observe('transition_seconds', time.time() - self.track_end)
+            self.track_end = None
+        for mirror in self.mirrors:
+            mirror.put(chunk)
+        self.send_primary(chunk)
+
+    def send_primary(self, chunk):
+        """Sends a chunk to the channel only, as when it is sent again after
+        a reconnection, and accounts the time it blocked"""
+        t = time.time()
+        self.channel.send(chunk)
+        self.metrics.sent(len(chunk), time.time() - t)
+
+    def sync_channel(self):
+        t = time.time()
+        self.channel.sync()
+        self.metrics.observe('sync_seconds', time.time() - t)
+
+    def get_metrics(self):
+        """Returns a snapshot of the metrics of the station"""
+        metrics = self.metrics.snapshot()
+        metrics['station'] = self.short_name
+        metrics['mount'] = self.channel.mount
+        metrics['server'] = '%s:%s' % (self.channel.host, self.channel.port)
+        metrics['running'] = int(self.is_running())
+        try:
+            metrics['relay_buffer_bytes'], metrics['relay_dropped_bytes'] = self.player.relay_stats()
+        except:
+            pass
+        if self.mirrors:
+            metrics['mirrors_connected'] = len([m for m in self.mirrors if m.connected])
+            metrics['mirror_dropped_bytes'] = sum([m.dropped for m in self.mirrors])
+            metrics['mirror_reconnects'] = sum([m.reconnects for m in self.mirrors])
+        return metrics
+
+    def check_server(self):
+        if not self.server_ping:
             try:
                 server = urllib.urlopen(self.server_url)
                 self.server_ping = True
                 self._info('Channel available.')
             except:
-                time.sleep(1)
-                if log:
-                    self._err('Could not connect the channel.  Waiting for channel to become available.')
-                    log = False
+                pass
+        return self.server_ping
+
+    def ping_server(self):
+        log = True
+
+        while not self.check_server() and not self.stopping:
+            time.sleep(1)
+            if log:
+                self._err('Could not connect the channel.  Waiting for channel to become available.')
+                log = False
+
+    def log_io_stats(self, previous):
+        """Logs the I/O lock wait and hold times accumulated since the previous snapshot"""
+        current = self.io_stats.snapshot()
+        count = current['count'] - previous['count']
+        if count:
+            wait = (current['wait'] - previous['wait']) * 1000
+            held = (current['held'] - previous['held']) * 1000
+            self._info('I/O: %d accesses, waited %.1f ms, held %.1f ms (max wait %.1f ms)' %
+                       (count, wait, held, current['max_wait'] * 1000))
 
     def icecastloop_nextmedia(self):
+        io_stats = self.io_stats.snapshot()
+        started = time.time()
+        if self.counter:
+            self.track_end = started
         try:
             self.next_media = 0
-            self.media = self.get_next_media()
+            track = self.get_prefetched_track()
+            self.apply_pending_station()
+            if track:
+                # Only swap the streams, the track was prepared while the previous one played
+                self.media = track.media
+                self.status_id = track.status_id
+                self.write_status(self.media)
+            else:
+                self.media = self.get_next_media()
             self.counter += 1
             self.counter = (self.counter % self.jingles_frequency) + self.jingles_frequency
             if self.relay_mode:
@@ -793,11 +1289,18 @@ class Station(Thread):
                 if self.lp == 0:
                     self._err('has no media to stream !')
                     return False
-                self.set_read_mode()
+                self.set_read_mode(track)
 
+            if self.media_prefetch and not self.relay_mode:
+                self.prefetch = TrackPrefetch(self)
+                self.prefetch.start()
+            self.log_io_stats(io_stats)
+            self.metrics.add('tracks')
             return True
         except Exception, e:
             self._err('icecastloop_nextmedia: Error: ' + str(e))
+        finally:
+            self.metrics.observe('nextmedia_seconds', time.time() - started)
         return False
 
     def __twitter_should_update(self):
@@ -818,15 +1321,140 @@ class Station(Thread):
     def icecastloop_metadata(self):
         try:
             self.update_twitter_current()
+            if self.record_mode:
+                self.recorder.mark(self.song)
             if self.song:
                 self.channel.set_metadata({'song': self.song, 'charset': 'utf-8'})
+                for mirror in self.mirrors:
+                    mirror.set_metadata({'song': self.song, 'charset': 'utf-8'})
             return True
         except Exception, e:
             self._err('icecastloop_metadata: Error: ' + str(e))
         return False
 
+    def is_running(self):
+        """Returns whether the station is streaming, either in its own thread
+        or as a coroutine of the event loop engine"""
+        return self.engine_running or self.isAlive()
+
+    def run_steps(self):
+        """The icecast loop of run() as a coroutine for the event loop engine.
+
+        Blocking work (server ping, next media, metadata) is yielded as
+        Blocking calls, and instead of sleeping in channel.sync() the
+        coroutine yields the libshout delay so that the loop can serve the
+        other stations meanwhile.  The shout queue length is used as
+        backpressure when the server does not read fast enough."""
+        log = True
+        while not (yield Blocking(self.check_server)):
+            if self.stopping:
+                return
+            if log:
+                self._err('Could not connect the channel.  Waiting for channel to become available.')
+                log = False
+            yield 1
+
+        self.channel.nonblocking = True
+        self.start_mirrors()
+
+        while not self.stopping:
+            while self.run_mode and not self.stopping:
+                opened = yield Blocking(self.channel_poll_open)
+                started = time.time()
+                while opened is None and time.time() - started < self.open_timeout:
+                    yield 0.1
+                    opened = self.channel_poll_open()
+                if not opened:
+                    return
+
+                if not (yield Blocking(self.icecastloop_nextmedia)):
+                    self._info('Something wrong happened in icecastloop_nextmedia.  Ending.')
+                    self.channel_close()
+                    return
+
+                yield Blocking(self.icecastloop_metadata)
+
+                while not (self.next_media or not self.run_mode or self.stopping):
+                    if self.relay_mode and self.player.relay:
+                        # Waiting for the relay would block the other stations of the loop
+                        self.chunk = self.player.relay_poll()
+                        while self.chunk is None and not (self.next_media or not self.run_mode or self.stopping):
+                            yield self.relay_poll_interval
+                            self.chunk = self.player.relay_poll()
+                    else:
+                        # The disk reads are done by the workers
+                        self.chunk = yield Blocking(self.read_chunk)
+                    if not self.chunk:
+                        break
+
+                    self.write_outputs(self.chunk)
+
+                    while self.channel.queuelen() > self.send_queue_limit:
+                        yield max(self.channel.delay(), 10) / 1000.0
+
+                    try:
+                        # Send the chunk to the stream
+                        self.send_chunk(self.chunk)
+                    except:
+                        self._err('could not send the buffer')
+                        self.metrics.add('send_errors')
+                        self.channel_close()
+                        opened = self.channel_poll_open()
+                        started = time.time()
+                        while opened is None and time.time() - started < self.open_timeout:
+                            yield 0.1
+                            opened = self.channel_poll_open()
+                        if not opened:
+                            self._err('could not restart the channel')
+                            self.close_outputs()
+                            return
+                        self.metrics.add('reconnects')
+                        try:
+                            self.channel.set_metadata({'song': self.song, 'charset': 'utf8', })
+                            self._info('channel restarted')
+                            self.send_primary(self.chunk)
+                        except:
+                            self._err('could not send data after restarting the channel')
+                            self.channel_close()
+                            self.close_outputs()
+                            return
+
+                    self.update_status_position()
+                    delay = self.channel.delay()
+                    if delay > 0:
+                        self.metrics.observe('sync_seconds', delay / 1000.0)
+                        yield delay / 1000.0
+
+            self._info("Play mode ended. Stopping stream.")
+            while not self.run_mode and not self.stopping:
+                yield 1
+
+        self.close_outputs()
+        self.channel_close()
+
+    def read_chunk(self):
+        """Returns the next chunk of the stream, or an empty string at its end"""
+        return next(self.stream, '')
+
+    def notify_exit(self):
+        """Closes the outputs and tells the supervisor that the station has ended"""
+        self.close_outputs()
+        self.close_relay_reader()
+        self.close_library_watch()
+        self.stop_mirrors()
+        if self.exit_callback:
+            self.exit_callback(self)
+
     def run(self):
+        try:
+            self.run_loop()
+        finally:
+            self.notify_exit()
+
+    def run_loop(self):
         self.ping_server()
+        if self.stopping:
+            return
 
         if self.type == 'stream-m':
             if self.relay_mode:
@@ -837,10 +1465,13 @@ class Station(Thread):
             if not self.channel_open():
                 return
             self.channel.start()
+            # Stay alive as long as the streamer so that the supervisor sees it end
+            self.channel.join()
 
         if self.type == 'icecast':
-            while True:  # Do this so that the handlers will still restart the stream
-                while self.run_mode:
+            self.start_mirrors()
+            while not self.stopping:  # Do this so that the handlers will still restart the stream
+                while self.run_mode and not self.stopping:
                     if not self.channel_open():
                         return
 
@@ -859,48 +1490,45 @@ class Station(Thread):
                         # else:
                             # break
 
-                        if self.next_media or not self.run_mode:
+                        if self.next_media or not self.run_mode or self.stopping:
                             break
 
-                        if self.record_mode:
-                            try:
-                                # Record the chunk
-                                self.recorder.write(self.chunk)
-                            except:
-                                self._err('could not write the buffer to the file')
+                        self.write_outputs(self.chunk)
 
                         try:
                             # Send the chunk to the stream
-                            self.channel.send(self.chunk)
-                            self.channel.sync()
+                            self.send_chunk(self.chunk)
+                            self.sync_channel()
                         except:
                             self._err('could not send the buffer')
+                            self.metrics.add('send_errors')
                             self.channel_close()
                             if not self.channel_open():
                                 self._err('could not restart the channel')
-                                if self.record_mode:
-                                    self.recorder.close()
+                                self.close_outputs()
                                 return
+                            self.metrics.add('reconnects')
                             try:
                                 self.channel.set_metadata({'song': self.song, 'charset': 'utf8', })
                                 self._info('channel restarted')
-                                self.channel.send(self.chunk)
-                                self.channel.sync()
+                                self.send_primary(self.chunk)
+                                self.sync_channel()
                             except:
                                 self._err('could not send data after restarting the channel')
                                 self.channel_close()
-                                if self.record_mode:
-                                    self.recorder.close()
+                                self.close_outputs()
                                 return
 
-                                # send chunk loop end
+                        self.update_status_position()
+                        # send chunk loop end
                 # while run_mode loop end
 
                 self._info("Play mode ended. Stopping stream.")
 
-                if self.record_mode:
-                    self.recorder.close()
-
                 self.channel_close()
-                time.sleep(1)
+                if not self.stopping:
+                    time.sleep(1)
+
+            # The recording and the HLS playlist go on across the pauses
+            self.close_outputs()
 
@@ -36,7 +36,10 @@
 
 # Author: Guillaume Pellerin <yomguy@parisson.com>
 
-from threading import Thread
+import time
+import random
+import collections
+from threading import Thread, Condition, Event
 
 
 class HTTPStreamer(Thread):
@@ -82,3 +85,132 @@ class HTTPStreamer(Thread):
 
     def close(self):
         self.curl.close()
+
+
+class Mirror(Thread):
+    """Sends a copy of the stream of a station to another server.
+
+    The station only queues the chunks it sends, the mirror sends them from
+    its own thread and reconnects on its own, after a delay doubling at each
+    failure in a row.  A slow or dead mirror thus never delays the station
+    nor the other mirrors.  When more than buffer_size bytes are waiting,
+    the oldest ones are dropped.
+
+    make_channel returns a new shout.Shout or HTTPStreamer for each
+    connection."""
+
+    buffer_size = 0x100000
+    backoff_min = 1
+    backoff_max = 30
+
+    def __init__(self, name, make_channel, logger=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.name = name
+        self.make_channel = make_channel
+        self.logger = logger
+        self.channel = None
+        self.connected = False
+        self.running = True
+        self.chunks = collections.deque()
+        self.size = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.metadata = None
+        self.metadata_sent = None
+        self.cond = Condition()
+        self.wakeup = Event()
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger('mirror %s: %s' % (self.name, msg))
+
+    def put(self, chunk):
+        with self.cond:
+            # The chunks may be buffers on memory reused by the player
+            self.chunks.append(str(chunk))
+            self.size += len(chunk)
+            while self.size > self.buffer_size:
+                self.size -= len(self.chunks[0])
+                self.dropped += len(self.chunks.popleft())
+            self.cond.notify()
+
+    def set_metadata(self, metadata):
+        """Sets the metadata sent with the next chunk"""
+        self.metadata = metadata
+
+    def get(self, size=None):
+        """Returns the next chunk, or up to size bytes, waiting for them, or
+        an empty string once stopped"""
+        with self.cond:
+            while not self.chunks and self.running:
+                self.cond.wait()
+            if not self.running:
+                return ''
+            chunk = self.chunks.popleft()
+            if size and len(chunk) > size:
+                self.chunks.appendleft(chunk[size:])
+                chunk = chunk[:size]
+            self.size -= len(chunk)
+            return chunk
+
+    def read_callback(self, size):
+        return self.get(size)
+
+    def stream(self):
+        """Sends the chunks until the connection fails or the mirror stops"""
+        if isinstance(self.channel, HTTPStreamer):
+            self.channel.set_callback(self.read_callback)
+            self.channel.open()
+            self.connected = True
+            self.channel.run()
+            return
+        self.channel.open()
+        self.connected = True
+        while self.running:
+            if self.metadata and self.metadata is not self.metadata_sent:
+                self.metadata_sent = self.metadata
+                self.channel.set_metadata(self.metadata)
+            chunk = self.get()
+            if chunk:
+                self.channel.send(chunk)
+
+    def run(self):
+        failures = 0
+        while self.running:
+            started = time.time()
+            try:
+                self.channel = self.make_channel()
+                self.metadata_sent = None
+                self.stream()
+                if not self.running:
+                    break
+                reason = 'the connection ended'
+            except Exception, e:
+                reason = str(e)
+            self.close_channel()
+            if not self.running:
+                break
+            if time.time() - started > self.backoff_max:
+                failures = 0
+            failures += 1
+            delay = min(self.backoff_max, self.backoff_min * 2 ** (failures - 1)) * random.uniform(0.5, 1)
+            self._log('%s, reconnecting in %.1f s' % (reason, delay))
+            self.wakeup.wait(delay)
+            self.reconnects += 1
+        self.close_channel()
+
+    def close_channel(self):
+        self.connected = False
+        if self.channel:
+            try:
+                self.channel.close()
+            except:
+                pass
+            self.channel = None
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        with self.cond:
+            self.cond.notify_all()
@@ -9,3 +9,11 @@ from logger import *
 from osc import *
 from twitt import *
 from utils import *
+from iocoord import *
+from mediaindex import *
+from watcher import *
+from metrics import *
+from profiler import *
+from control import *
+from archive import *
+from chunkcache import *
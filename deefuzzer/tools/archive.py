@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2007-2009 Guillaume Pellerin <yomguy@parisson.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://svn.parisson.org/deefuzz/wiki/DefuzzLicense.
+#
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import os
+import time
+import sqlite3
+from threading import Lock
+
+
+class RecordIndex(object):
+    """The index of a segmented recording, stored in a SQLite file in the
+    directory of the segments.
+
+    It keeps the start and end times and the size of each segment, and marks
+    of (time, segment, byte offset, title): the start of each segment and of
+    each track, and regular marks in between.  The offset of any time is
+    interpolated between the two marks around it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.dir = os.path.dirname(path)
+        self.lock = Lock()
+        self.pending = []
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS segments ('
+                        'name TEXT PRIMARY KEY, start REAL, end REAL, size INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS marks ('
+                        'time REAL, segment TEXT, offset INTEGER, title TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS segments_start ON segments (start)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS marks_segment ON marks (segment, time)')
+        self.db.commit()
+
+    def add_segment(self, name, start):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO segments VALUES (?, ?, NULL, NULL)', (name, start))
+
+    def end_segment(self, name, end, size):
+        with self.lock:
+            self.db.execute('UPDATE segments SET end = ?, size = ? WHERE name = ?', (end, size, name))
+
+    def add_mark(self, t, segment, offset, title=None):
+        """Adds a mark, written on the next flush()"""
+        with self.lock:
+            self.pending.append((t, segment, offset, title))
+
+    def flush(self):
+        with self.lock:
+            if self.pending:
+                self.db.executemany('INSERT INTO marks VALUES (?, ?, ?, ?)', self.pending)
+                self.pending = []
+            self.db.commit()
+
+    def segment_size(self, name, size):
+        if size is not None:
+            return size
+        # The segment being recorded
+        try:
+            return os.path.getsize(os.path.join(self.dir, name))
+        except OSError:
+            return 0
+
+    def segments(self, start=0, end=None):
+        """Returns the (name, start, end, size) of the segments overlapping
+        the times from start to end, in time order"""
+        if end is None:
+            end = time.time()
+        with self.lock:
+            rows = self.db.execute('SELECT name, start, end, size FROM segments '
+                                   'WHERE start <= ? AND (end IS NULL OR end >= ?) ORDER BY start',
+                                   (end, start)).fetchall()
+        return [(r[0], r[1], r[2], self.segment_size(r[0], r[3])) for r in rows]
+
+    def tracks(self, start=0, end=None):
+        """Returns the (time, segment, offset, title) of the tracks starting
+        between start and end"""
+        if end is None:
+            end = time.time()
+        with self.lock:
+            return self.db.execute('SELECT time, segment, offset, title FROM marks '
+                                   'WHERE title IS NOT NULL AND time >= ? AND time <= ? ORDER BY time',
+                                   (start, end)).fetchall()
+
+    def find(self, t):
+        """Returns the segment and the byte offset recorded at the time t, or
+        None if nothing was recorded then"""
+        with self.lock:
+            segment = self.db.execute('SELECT name, start, end, size FROM segments WHERE start <= ? '
+                                      'ORDER BY start DESC LIMIT 1', (t,)).fetchone()
+            if segment is None or (segment[2] is not None and t > segment[2]):
+                return None
+            name = segment[0]
+            before = self.db.execute('SELECT time, offset FROM marks WHERE segment = ? AND time <= ? '
+                                     'ORDER BY time DESC LIMIT 1', (name, t)).fetchone()
+            after = self.db.execute('SELECT time, offset FROM marks WHERE segment = ? AND time > ? '
+                                    'ORDER BY time LIMIT 1', (name, t)).fetchone()
+        size = self.segment_size(name, segment[3])
+        if before is None:
+            before = (segment[1], 0)
+        if after is None:
+            after = (segment[2] or time.time(), size)
+        offset = before[1]
+        if after[0] > before[0]:
+            offset += int((t - before[0]) * (after[1] - before[1]) / (after[0] - before[0]))
+        return name, min(offset, size)
+
+    def extract(self, start, end, output):
+        """Copies the recording from the time start to the time end to the
+        file object output, and returns the number of bytes copied"""
+        first = self.find(start)
+        last = self.find(end)
+        copied = 0
+        for name, s, e, size in self.segments(start, end):
+            begin = 0
+            stop = size
+            if first and name == first[0]:
+                begin = first[1]
+            if last and name == last[0]:
+                stop = last[1]
+            try:
+                media = open(os.path.join(self.dir, name), 'rb')
+            except IOError:
+                continue
+            media.seek(begin)
+            left = stop - begin
+            while left > 0:
+                data = media.read(min(left, 0x100000))
+                if not data:
+                    break
+                output.write(data)
+                copied += len(data)
+                left -= len(data)
+            media.close()
+        return copied
+
+    def prune(self, max_age=0, max_size=0, keep=None):
+        """Removes the segments which ended more than max_age seconds ago,
+        then the oldest ones while all the segments take more than max_size
+        bytes, except the segment keep.  Returns the names of the removed
+        segments"""
+        segments = self.segments()
+        total = sum([s[3] for s in segments])
+        removed = []
+        for name, start, end, size in segments:
+            if name == keep:
+                continue
+            if (max_age and end is not None and end < time.time() - max_age) or \
+                    (max_size and total > max_size):
+                try:
+                    os.remove(os.path.join(self.dir, name))
+                except OSError:
+                    pass
+                total -= size
+                removed.append(name)
+        if removed:
+            with self.lock:
+                for name in removed:
+                    self.db.execute('DELETE FROM segments WHERE name = ?', (name,))
+                    self.db.execute('DELETE FROM marks WHERE segment = ?', (name,))
+                self.db.commit()
+        return removed
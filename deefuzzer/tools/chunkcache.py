@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2007-2009 Guillaume Pellerin <yomguy@parisson.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://svn.parisson.org/deefuzz/wiki/DefuzzLicense.
+#
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import os
+import collections
+from threading import Lock
+
+
+class ChunkCache(object):
+    """An in-memory cache of media blocks shared by all the players of the
+    process, so that the stations playing the same library read a track
+    from the disk about once.
+
+    The blocks are keyed by the identity of the file (device, inode, size
+    and modification time, so a changed file is never served from the
+    cache) and their offset.  The least recently used blocks are evicted
+    when the cache holds more than size bytes."""
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = Lock()
+        self.blocks = collections.OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.blocks.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self.blocks[key] = data
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.size:
+            return
+        with self.lock:
+            old = self.blocks.pop(key, None)
+            if old is not None:
+                self.used -= len(old)
+            self.blocks[key] = data
+            self.used += len(data)
+            while self.used > self.size:
+                key, old = self.blocks.popitem(last=False)
+                self.used -= len(old)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {'size': self.size, 'used': self.used, 'blocks': len(self.blocks),
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def file_identity(path):
+    """Returns the key of the current content of a file"""
+    stats = os.stat(path)
+    return stats.st_dev, stats.st_ino, stats.st_size, stats.st_mtime
+
+
+chunk_cache = None
+
+
+def set_chunk_cache(size):
+    """Creates the ChunkCache of the process, of size bytes, or removes it if
+    size is 0"""
+    global chunk_cache
+    if size:
+        chunk_cache = ChunkCache(size)
+    else:
+        chunk_cache = None
+    return chunk_cache
+
+
+def get_chunk_cache():
+    return chunk_cache
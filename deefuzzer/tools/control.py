@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2007-2009 Guillaume Pellerin <yomguy@parisson.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://svn.parisson.org/deefuzz/wiki/DefuzzLicense.
+#
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import os
+import SocketServer
+from threading import Thread
+
+
+class ControlHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                answer = self.server.command(line)
+            except Exception, e:
+                answer = 'error: %s' % str(e)
+            self.wfile.write(answer + '\n')
+
+
+class ControlServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlSocket(Thread):
+    """A local UNIX socket taking one text command per line.  Each line is
+    passed to command(), which returns the answer written back"""
+
+    def __init__(self, path, command):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.path = path
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = ControlServer(self.path, ControlHandler)
+        os.chmod(self.path, 0600)
+        self.server.command = command
+
+    def run(self):
+        self.server.serve_forever()
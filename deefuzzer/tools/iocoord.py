@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2007-2009 Guillaume Pellerin <yomguy@parisson.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://svn.parisson.org/deefuzz/wiki/DefuzzLicense.
+#
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import time
+from contextlib import contextmanager
+from threading import Lock, RLock, BoundedSemaphore, local
+
+
+class IOStats(object):
+    """Accumulates the time a station waited for and held I/O locks"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.count = 0
+        self.wait = 0.0
+        self.held = 0.0
+        self.max_wait = 0.0
+        self.max_held = 0.0
+
+    def add(self, wait, held):
+        with self.lock:
+            self.count += 1
+            self.wait += wait
+            self.held += held
+            if wait > self.max_wait:
+                self.max_wait = wait
+            if held > self.max_held:
+                self.max_held = held
+
+    def snapshot(self):
+        """Returns a copy of the counters as a dictionary"""
+        with self.lock:
+            return {'count': self.count,
+                    'wait': self.wait,
+                    'held': self.held,
+                    'max_wait': self.max_wait,
+                    'max_held': self.max_held, }
+
+
+class IOCoordinator(object):
+    """Coordinates the disk I/O of all the stations of a DeeFuzzer.
+
+    Each resource (a media library, a feed file, a status file...) gets its
+    own lock so that stations only wait for each other when they really
+    touch the same files, and a bounded number of worker slots caps the
+    amount of concurrent I/O on the host."""
+
+    def __init__(self, workers=4):
+        self.workers = max(1, int(workers))
+        self.budget = BoundedSemaphore(self.workers)
+        self.locks = {}
+        self.locks_lock = Lock()
+        self.local = local()
+
+    def get_lock(self, kind, key):
+        """Returns the lock protecting the resource identified by kind and key"""
+        name = (kind, key)
+        with self.locks_lock:
+            if name not in self.locks:
+                self.locks[name] = RLock()
+            return self.locks[name]
+
+    def _acquire_slot(self):
+        depth = getattr(self.local, 'depth', 0)
+        if not depth:
+            self.budget.acquire()
+        self.local.depth = depth + 1
+
+    def _release_slot(self):
+        self.local.depth -= 1
+        if not self.local.depth:
+            self.budget.release()
+
+    @contextmanager
+    def access(self, kind, key=None, stats=None):
+        """Context manager holding the lock of a resource and one I/O slot.
+
+        The resource lock is always taken before the slot so that a thread
+        waiting for a busy resource never starves the others of slots.
+        Nested accesses from the same thread reuse the slot they already own.
+        If stats is an IOStats object, the wait and hold times are added to it."""
+        t0 = time.time()
+        lock = None
+        if key is not None:
+            lock = self.get_lock(kind, key)
+            lock.acquire()
+        try:
+            self._acquire_slot()
+            t1 = time.time()
+            try:
+                yield
+            finally:
+                self._release_slot()
+                if stats is not None:
+                    stats.add(t1 - t0, time.time() - t1)
+        finally:
+            if lock is not None:
+                lock.release()
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2007-2009 Guillaume Pellerin <yomguy@parisson.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://svn.parisson.org/deefuzz/wiki/DefuzzLicense.
+#
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import os
+import json
+import sqlite3
+import datetime
+from threading import Lock
+from mediabase import *
+from mp3 import *
+from utils import *
+
+
+class IndexedMedia(MediaBase):
+    """A media object rebuilt from a MediaIndex row, without parsing the file"""
+
+    def __init__(self, path, row):
+        MediaBase.__init__(self)
+        self.media = path
+        self.source = path
+        self.format = row['format']
+        self.mime_type = row['mime_type']
+        self.extension = row['extension']
+        self.description = row['description']
+        self.bitrate = row['bitrate']
+        self.length = datetime.timedelta(0, row['length'])
+        self.size = row['size']
+        self.media_info = get_file_info(path)
+        self.file_name = self.media_info[0]
+        self.file_title = self.media_info[1]
+        self.file_ext = self.media_info[2]
+        self.metadata = dict(row['metadata'])
+
+    def read_file_metadata(self):
+        # The metadata come from the index, there is no source object to read
+        pass
+
+
+class MediaIndex(object):
+    """A persistent index of the media metadata, stored in a SQLite file.
+
+    Entries are keyed by path and are only valid as long as the size and the
+    modification time of the file are the same.  All the rows are loaded in
+    memory on first use so that a lookup only costs one stat."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        self.rows = None
+        self.pending = []
+        index_dir = os.path.dirname(self.path)
+        if index_dir and not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS media ('
+                        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                        'format TEXT, mime_type TEXT, extension TEXT, description TEXT, '
+                        'bitrate INTEGER, length REAL, metadata TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS frames ('
+                        'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, data BLOB)')
+        self.db.commit()
+
+    def _load(self):
+        self.rows = {}
+        for r in self.db.execute('SELECT path, size, mtime, format, mime_type, extension, '
+                                 'description, bitrate, length, metadata FROM media'):
+            self.rows[r[0]] = {'size': r[1], 'mtime': r[2], 'format': r[3],
+                               'mime_type': r[4], 'extension': r[5], 'description': r[6],
+                               'bitrate': r[7], 'length': r[8], 'metadata': json.loads(r[9])}
+
+    def get(self, path):
+        """Returns an IndexedMedia for path, or None if the file is not indexed
+        or has changed since it was"""
+        try:
+            stats = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            if self.rows is None:
+                self._load()
+            row = self.rows.get(path)
+        if row is None or row['size'] != stats.st_size or row['mtime'] != stats.st_mtime:
+            return None
+        return IndexedMedia(path, row)
+
+    def put(self, media):
+        """Adds or refreshes the entry of a parsed media object.  The row is
+        written on the next flush()"""
+        try:
+            stats = os.stat(media.media)
+        except OSError:
+            return
+        length = media.length
+        if isinstance(length, datetime.timedelta):
+            length = length.days * 86400 + length.seconds + length.microseconds / 1e6
+        metadata = {}
+        for key in media.metadata.keys():
+            metadata[key] = media.metadata[key]
+        row = {'size': stats.st_size, 'mtime': stats.st_mtime, 'format': media.format,
+               'mime_type': media.mime_type, 'extension': media.extension,
+               'description': media.description, 'bitrate': int(media.bitrate or 0),
+               'length': float(length or 0), 'metadata': metadata}
+        with self.lock:
+            if self.rows is None:
+                self._load()
+            self.rows[media.media] = row
+            self.pending.append((media.media, row))
+
+    def flush(self):
+        """Writes the pending entries in a single transaction"""
+        with self.lock:
+            if not self.pending:
+                return
+            pending = self.pending
+            self.pending = []
+            self.db.executemany('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(path, row['size'], row['mtime'], row['format'], row['mime_type'],
+                                  row['extension'], row['description'], row['bitrate'],
+                                  row['length'], json.dumps(row['metadata'])) for path, row in pending])
+            self.db.commit()
+
+    def get_frame_index(self, path):
+        """Returns the Mp3FrameIndex stored for path, or None if there is none
+        or if the file has changed since it was built"""
+        try:
+            stats = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            r = self.db.execute('SELECT size, mtime, data FROM frames WHERE path = ?', (path,)).fetchone()
+        if r is None or r[0] != stats.st_size or r[1] != stats.st_mtime:
+            return None
+        return Mp3FrameIndex().loads(str(r[2]))
+
+    def put_frame_index(self, path, frame_index):
+        """Stores the frame index of a file and uses its exact duration as the
+        length of the media"""
+        try:
+            stats = os.stat(path)
+        except OSError:
+            return
+        duration = frame_index.get_duration()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?)',
+                            (path, stats.st_size, stats.st_mtime, sqlite3.Binary(frame_index.dumps())))
+            self.db.execute('UPDATE media SET length = ? WHERE path = ? AND size = ? AND mtime = ?',
+                            (duration, path, stats.st_size, stats.st_mtime))
+            self.db.commit()
+            if self.rows is not None and path in self.rows:
+                row = self.rows[path]
+                if row['size'] == stats.st_size and row['mtime'] == stats.st_mtime:
+                    row['length'] = duration
+
+
+media_indexes = {}
+media_indexes_lock = Lock()
+
+
+def get_media_index(path):
+    """Returns the MediaIndex stored at path, shared by all the stations of the process"""
+    path = os.path.abspath(path)
+    with media_indexes_lock:
+        if path not in media_indexes:
+            media_indexes[path] = MediaIndex(path)
+        return media_indexes[path]
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2007-2009 Guillaume Pellerin <yomguy@parisson.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://svn.parisson.org/deefuzz/wiki/DefuzzLicense.
+#
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import time
+import json
+import SocketServer
+import BaseHTTPServer
+from threading import Thread, Lock
+from utils import *
+
+# name: (type, help)
+STATION_METRICS = {
+    'bytes_sent': ('counter', 'Bytes sent to the streaming server'),
+    'chunks_sent': ('counter', 'Chunks sent to the streaming server'),
+    'send_errors': ('counter', 'Chunks which could not be sent'),
+    'reconnects': ('counter', 'Channel reconnections after a send error'),
+    'tracks': ('counter', 'Tracks started'),
+    'underruns': ('counter', 'Chunks sent after their play time'),
+    'underrun_seconds': ('counter', 'Delay of the chunks sent after their play time'),
+    'send_seconds': ('histogram', 'Time blocked in channel.send'),
+    'sync_seconds': ('histogram', 'Time blocked in channel.sync or waiting for the channel delay'),
+    'nextmedia_seconds': ('histogram', 'Time spent in icecastloop_nextmedia'),
+    'transition_seconds': ('histogram', 'Time between the end of a track and the first chunk of the next one'),
+    'mirrors_connected': ('gauge', 'Mirror servers connected'),
+    'mirror_dropped_bytes': ('counter', 'Bytes dropped for the mirror servers which fell behind'),
+    'mirror_reconnects': ('counter', 'Reconnections of the mirror servers'),
+    'record_overruns': ('counter', 'Chunks not recorded because the recording disk fell behind'),
+    'cache_hits': ('counter', 'Media blocks read from the shared chunk cache'),
+    'cache_misses': ('counter', 'Media blocks read from the disk into the shared chunk cache'),
+    'relay_dropped_bytes': ('counter', 'Bytes dropped from the relay buffer of a subscriber which fell behind'),
+    'relay_buffer_bytes': ('gauge', 'Bytes waiting in the relay buffer'),
+    'running': ('gauge', 'Whether the station is streaming'),
+}
+
+
+class Histogram(object):
+    """A histogram of durations with cumulative buckets, as in Prometheus"""
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        buckets = []
+        total = 0
+        for le, count in zip(self.buckets, self.counts):
+            total += count
+            buckets.append([le, total])
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class StationMetrics(object):
+    """The counters and histograms of a station"""
+
+    # Chunks sent later than this after their play time count as underruns
+    underrun_margin = 0.25
+
+    def __init__(self):
+        self.lock = Lock()
+        self.values = {}
+        self.histograms = {}
+        for name, (kind, text) in STATION_METRICS.items():
+            if kind == 'histogram':
+                self.histograms[name] = Histogram()
+            else:
+                self.values[name] = 0
+        self.byterate = 0
+        self.stream_time = None
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[name] += value
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def start_stream(self, byterate):
+        """Restarts the play clock of the stream on a new connection"""
+        with self.lock:
+            self.byterate = byterate
+            self.stream_time = None
+
+    def sent(self, size, seconds):
+        """Accounts a chunk sent in the given time.  The chunk is an underrun
+        when its sending started after the play time of its first byte"""
+        now = time.time()
+        with self.lock:
+            self.values['bytes_sent'] += size
+            self.values['chunks_sent'] += 1
+            self.histograms['send_seconds'].observe(seconds)
+            if not self.byterate:
+                return
+            started = now - seconds
+            if self.stream_time is None:
+                self.stream_time = started
+            late = started - self.stream_time
+            if late > self.underrun_margin:
+                self.values['underruns'] += 1
+                self.values['underrun_seconds'] += late
+                self.stream_time = started
+            self.stream_time += size / float(self.byterate)
+
+    def snapshot(self):
+        with self.lock:
+            data = dict(self.values)
+            for name, histogram in self.histograms.items():
+                data[name] = histogram.snapshot()
+        return data
+
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(metrics):
+    """Renders a metrics snapshot of DeeFuzzer.get_metrics() in the Prometheus text format"""
+    lines = []
+    for name in sorted(STATION_METRICS):
+        kind, text = STATION_METRICS[name]
+        full_name = 'deefuzzer_' + name
+        if kind == 'counter':
+            full_name += '_total'
+        lines.append('# HELP %s %s' % (full_name, text))
+        lines.append('# TYPE %s %s' % (full_name, kind))
+        for station in metrics['stations']:
+            if name not in station:
+                continue
+            labels = 'station="%s",mount="%s",server="%s"' % (escape_label(station['station']),
+                                                             escape_label(station['mount']),
+                                                             escape_label(station['server']))
+            value = station[name]
+            if kind != 'histogram':
+                lines.append('%s{%s} %s' % (full_name, labels, repr(value)))
+                continue
+            for le, count in value['buckets']:
+                lines.append('%s_bucket{%s,le="%s"} %d' % (full_name, labels, repr(float(le)), count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (full_name, labels, value['count']))
+            lines.append('%s_sum{%s} %s' % (full_name, labels, repr(value['sum'])))
+            lines.append('%s_count{%s} %d' % (full_name, labels, value['count']))
+    return u'\n'.join(lines).encode('utf-8') + '\n'
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/metrics':
+            data = render_prometheus(self.server.collect())
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            data = json.dumps(self.server.collect())
+            content_type = 'application/json'
+        elif path in self.server.files:
+            content_type, data = self.server.files[path]
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsExporter(Thread):
+    """Serves the metrics returned by collect() over HTTP, in the Prometheus
+    text format on /metrics and as JSON on /metrics.json, and writes them to
+    a JSON file every interval seconds.  The files dictionary maps other paths
+    to the (content type, data) they serve."""
+
+    def __init__(self, collect, host='127.0.0.1', port=0, path=None, interval=10, logger=None, files=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.collect = collect
+        self.logger = logger
+        self.path = path
+        self.interval = interval
+        self.server = None
+        if port:
+            self.server = MetricsServer((host, port), MetricsHandler)
+            self.server.collect = collect
+            self.server.files = files if files is not None else {}
+            self.server_thread = Thread(target=self.server.serve_forever)
+            self.server_thread.setDaemon(True)
+
+    def run(self):
+        if self.server:
+            self.server_thread.start()
+        while self.path:
+            time.sleep(self.interval)
+            try:
+                write_file_atomic(self.path, json.dumps(self.collect()))
+            except Exception, e:
+                if self.logger:
+                    self.logger('Could not write the metrics to %s: %s' % (self.path, str(e)))
@@ -37,7 +37,11 @@
 # Author: Guillaume Pellerin <yomguy@parisson.com>
 
 import os
+import mmap
+import array
+import struct
 import string
+import bisect
 import datetime
 from mutagen.easyid3 import EasyID3
 from mutagen.mp3 import MP3, MPEGInfo
@@ -128,3 +132,167 @@ class Mp3(MediaBase):
             raise IOError('ExporterError: cannot write tags')
 
 
+MPEG_VERSIONS = {0: 2.5, 2: 2, 3: 1}
+MPEG_BITRATES = {1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+                 2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]}
+MPEG_SAMPLERATES = {1: [44100, 48000, 32000],
+                    2: [22050, 24000, 16000],
+                    2.5: [11025, 12000, 8000]}
+
+
+def parse_mp3_frame_header(data, offset):
+    """Returns (frame length, samples, samplerate) of the MPEG Layer III frame
+    starting at offset, or None if there is no valid frame header there"""
+    if offset + 4 > len(data):
+        return None
+    h = struct.unpack('>I', data[offset:offset + 4])[0]
+    if h >> 21 != 0x7ff:
+        return None
+    version = MPEG_VERSIONS.get((h >> 19) & 3)
+    layer = (h >> 17) & 3
+    bitrate_index = (h >> 12) & 0xf
+    samplerate_index = (h >> 10) & 3
+    if version is None or layer != 1 or bitrate_index in (0, 15) or samplerate_index == 3:
+        return None
+    padding = (h >> 9) & 1
+    row = 1
+    if version != 1:
+        row = 2
+    bitrate = MPEG_BITRATES[row][bitrate_index] * 1000
+    samplerate = MPEG_SAMPLERATES[version][samplerate_index]
+    if version == 1:
+        return 144 * bitrate / samplerate + padding, 1152, samplerate
+    return 72 * bitrate / samplerate + padding, 576, samplerate
+
+
+def is_mp3_info_frame(data, offset, length):
+    """Returns whether the frame at offset is a Xing, Info or VBRI header frame (no audio)"""
+    frame = data[offset:offset + min(length, 64)]
+    return 'Xing' in frame or 'Info' in frame or frame[36:40] == 'VBRI'
+
+
+class Mp3FrameIndex(object):
+    """The frame offsets and timestamps of a MP3 file.
+
+    Only one frame every `step` frames is kept (about one per second) as a
+    seek point.  The exact frame boundary for a given time is found by
+    walking the frame headers from the nearest seek point."""
+
+    step = 38
+
+    def __init__(self, samplerate=44100, frames=0, samples=0, points=None):
+        self.samplerate = samplerate
+        self.frames = frames
+        self.samples = samples
+        # Interleaved (byte offset, sample position) pairs
+        self.points = points or array.array('I')
+
+    def get_duration(self):
+        """The exact duration of the audio in seconds"""
+        if not self.samplerate:
+            return 0.0
+        return float(self.samples) / self.samplerate
+
+    def dumps(self):
+        return struct.pack('>III', self.samplerate, self.frames, self.samples) + self.points.tostring()
+
+    def loads(self, data):
+        self.samplerate, self.frames, self.samples = struct.unpack('>III', data[:12])
+        self.points = array.array('I')
+        self.points.fromstring(data[12:])
+        return self
+
+    def build(self, path):
+        """Walks all the frame headers of the file"""
+        self.frames = 0
+        self.samples = 0
+        self.points = array.array('I')
+        f = open(path, 'rb')
+        try:
+            if not os.fstat(f.fileno()).st_size:
+                return self
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        try:
+            offset = 0
+            if data[:3] == 'ID3':
+                # Skip the ID3v2 tag, its size is a syncsafe integer
+                size = 0
+                for c in data[6:10]:
+                    size = (size << 7) | (ord(c) & 0x7f)
+                offset = 10 + size
+                if ord(data[5]) & 0x10:
+                    offset += 10
+
+            first = True
+            end = len(data)
+            while offset < end:
+                header = parse_mp3_frame_header(data, offset)
+                if header is None or (first and not
+                                      parse_mp3_frame_header(data, offset + header[0])):
+                    # Garbage (or a tag): look for the next frame synchronization
+                    offset = data.find('\xff', offset + 1)
+                    if offset < 0:
+                        break
+                    continue
+                length, samples, self.samplerate = header
+                if first:
+                    first = False
+                    if is_mp3_info_frame(data, offset, length):
+                        offset += length
+                        continue
+                if not self.frames % self.step:
+                    self.points.append(offset)
+                    self.points.append(self.samples)
+                self.frames += 1
+                self.samples += samples
+                offset += length
+        finally:
+            data.close()
+        return self
+
+    def _point(self, i):
+        return self.points[2 * i], self.points[2 * i + 1]
+
+    def time_at(self, offset):
+        """Returns the time in seconds at a byte offset of the file"""
+        n = len(self.points) / 2
+        if not n or not self.samplerate:
+            return 0.0
+        offsets = self.points[0::2]
+        i = max(0, bisect.bisect_right(offsets, offset) - 1)
+        point_offset, point_samples = self._point(i)
+        if i + 1 < n:
+            next_offset, next_samples = self._point(i + 1)
+        else:
+            next_offset, next_samples = None, self.samples
+        if next_offset and next_offset > point_offset:
+            ratio = min(1.0, float(offset - point_offset) / (next_offset - point_offset))
+            point_samples += ratio * (next_samples - point_samples)
+        return float(point_samples) / self.samplerate
+
+    def offset_at(self, path, seconds):
+        """Returns the byte offset of the frame playing at the given time"""
+        n = len(self.points) / 2
+        if not n:
+            return 0
+        target = int(seconds * self.samplerate)
+        samples = self.points[1::2]
+        i = max(0, bisect.bisect_right(samples, target) - 1)
+        offset, position = self._point(i)
+        f = open(path, 'rb')
+        try:
+            f.seek(offset)
+            data = f.read(self.step * 1441 + 4)
+        finally:
+            f.close()
+        walked = 0
+        while True:
+            header = parse_mp3_frame_header(data, walked)
+            if header is None or position + header[1] > target:
+                break
+            walked += header[0]
+            position += header[1]
+        return offset + walked
@@ -40,6 +40,9 @@ from threading import Thread
 
 
 class OSCController(Thread):
+
+    running = True
+
     def __init__(self, port):
         Thread.__init__(self)
         import liblo
@@ -53,6 +56,11 @@ class OSCController(Thread):
     def add_method(self, path, type, method):
         self.server.add_method(path, type, method)
 
+    def stop(self):
+        """Ends the thread, which then frees the port"""
+        self.running = False
+
     def run(self):
-        while True:
+        while self.running:
             self.server.recv(100)
+        self.server.free()
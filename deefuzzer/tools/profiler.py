@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2007-2009 Guillaume Pellerin <yomguy@parisson.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://svn.parisson.org/deefuzz/wiki/DefuzzLicense.
+#
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import os
+import re
+import sys
+import time
+import threading
+from threading import Thread
+from utils import *
+
+
+def frame_label(code):
+    name = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+    return name.replace(';', ':')
+
+
+class SamplingProfiler(Thread):
+    """Samples the Python stacks of all the threads every interval seconds
+    for duration seconds, then writes them as collapsed stacks: one
+    'thread;frame;frame... count' line per distinct stack, the input format
+    of flamegraph.pl and speedscope.
+
+    If target is given, only the stacks running a method of this object are
+    kept.  This follows a station in its own thread as well as in the event
+    loop and worker threads of the loop engine.  The samples are taken on
+    the wall clock, a blocked thread shows its waiting frame.  Nothing runs
+    when no profiler is started."""
+
+    interval = 0.005
+
+    def __init__(self, path, duration, target=None, interval=None, logger=None):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.path = path
+        self.duration = duration
+        self.target = target
+        if interval:
+            self.interval = interval
+        self.logger = logger
+        self.counts = {}
+        self.samples = 0
+        self.hidden = 0
+
+    def _log(self, msg):
+        if self.logger:
+            self.logger(msg)
+
+    def is_target(self, frame):
+        code = frame.f_code
+        return code.co_argcount and code.co_varnames[0] == 'self' and \
+            frame.f_locals.get('self') is self.target
+
+    def sample(self):
+        threads = dict((t.ident, t) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            thread = threads.get(ident)
+            if thread is None or ident == self.ident:
+                continue
+            matched = self.target is None
+            stack = []
+            while True:
+                if not matched and self.is_target(frame):
+                    matched = True
+                stack.append(frame_label(frame.f_code))
+                if frame.f_back is None:
+                    break
+                frame = frame.f_back
+            if not isinstance(thread, threading._MainThread) and frame.f_locals.get('self') is not thread:
+                # Python 2 keeps the thread states of the parent process in a
+                # forked child, their stale frames hide the new threads which
+                # get the same ident
+                self.hidden += 1
+                continue
+            if not matched:
+                continue
+            stack.append(thread.name.replace(';', ':'))
+            key = ';'.join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    def run(self):
+        end = time.time() + self.duration
+        while time.time() < end:
+            self.sample()
+            time.sleep(self.interval)
+        lines = ['%s %d' % (stack, count) for stack, count in sorted(self.counts.items())]
+        try:
+            write_file_atomic(self.path, '\n'.join(lines) + '\n')
+            self._log('Profile of %d samples written to %s' % (self.samples, self.path))
+            if self.hidden:
+                self._log('%d thread stacks could not be sampled' % self.hidden)
+        except Exception, e:
+            self._log('Could not write the profile %s: %s' % (self.path, str(e)))
+
+
+def start_profiler(directory, name, duration, target=None, interval=None, logger=None):
+    """Starts a SamplingProfiler writing to a file named after name and the
+    current time in directory, and returns the path of this file"""
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name)
+    path = os.path.join(directory, 'profile_%s_%s.folded' % (name, time.strftime('%Y%m%d-%H%M%S')))
+    SamplingProfiler(path, duration, target, interval, logger).start()
+    return path
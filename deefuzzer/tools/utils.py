@@ -12,8 +12,12 @@
 
 import os
 import re
+import gzip
+import time
+import cPickle
 import string
 import mimetypes
+import threading
 from itertools import chain
 from deefuzzer.tools import *
 
@@ -63,6 +67,12 @@ def merge_defaults(setting, default):
     return combined
 
 
+def copy_conf(conf):
+    """Returns a deep copy of a parsed config, made through pickle which is
+    several times faster than copy.deepcopy on these plain structures"""
+    return cPickle.loads(cPickle.dumps(conf, 2))
+
+
 def replace_all(option, repl):
     if isinstance(option, list):
         r = []
@@ -82,6 +92,26 @@ def replace_all(option, repl):
     return option
 
 
+conf_yaml_loader = None
+
+
+def get_yaml_loader():
+    """Returns the YAML loader class of the config files, based on the C
+    loader of libyaml when it is available.  The str constructor is
+    registered once, on this class only."""
+    global conf_yaml_loader
+    if conf_yaml_loader is None:
+        import yaml
+
+        def custom_str_constructor(loader, node):
+            return loader.construct_scalar(node).encode('utf-8')
+
+        base = getattr(yaml, 'CLoader', yaml.Loader)
+        conf_yaml_loader = type('ConfLoader', (base,), {})
+        conf_yaml_loader.add_constructor(u'tag:yaml.org,2002:str', custom_str_constructor)
+    return conf_yaml_loader
+
+
 def get_conf_dict(file):
     mime_type = mimetypes.guess_type(file)[0]
 
@@ -95,14 +125,10 @@ def get_conf_dict(file):
     elif 'yaml' in mime_type or 'yml' in mime_type:
         import yaml
 
-        def custom_str_constructor(loader, node):
-            return loader.construct_scalar(node).encode('utf-8')
-
-        yaml.add_constructor(u'tag:yaml.org,2002:str', custom_str_constructor)
         confile = open(file, 'r')
         data = confile.read()
         confile.close()
-        return yaml.load(data)
+        return yaml.load(data, Loader=get_yaml_loader())
 
     elif 'json' in mime_type:
         import json
@@ -115,12 +141,143 @@ def get_conf_dict(file):
     return False
 
 
+def get_conf_dict_timed(file):
+    """Returns the path, the config, the parse time and the error message of
+    a config file, for the worker processes of load_conf_files()"""
+    t = time.time()
+    try:
+        return file, get_conf_dict(file), time.time() - t, None
+    except Exception, e:
+        return file, None, time.time() - t, str(e)
+
+
+class ConfCache(object):
+    """The parsed config files stored in a pickle file.  An entry is only
+    valid as long as the size and the modification time of the file are
+    the same, so an unchanged file costs one stat.  The configs are kept
+    pickled, the callers may change the ones they get.  The files looked up
+    are remembered, so that prune() can drop the entries of the others."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.seen = set()
+        self.changed = False
+        try:
+            f = open(self.path, 'rb')
+            try:
+                self.entries = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            self.entries = {}
+
+    def get(self, file, stats):
+        self.seen.add(file)
+        entry = self.entries.get(file)
+        if entry is None or entry[0] != stats.st_size or entry[1] != stats.st_mtime:
+            return None
+        if not isinstance(entry[2], str):
+            # Written by a version storing the configs themselves
+            return None
+        return cPickle.loads(entry[2])
+
+    def put(self, file, stats, conf):
+        self.seen.add(file)
+        self.entries[file] = (stats.st_size, stats.st_mtime, cPickle.dumps(conf, 2))
+        self.changed = True
+
+    def prune(self):
+        """Drops the entries of the files not looked up since the cache was
+        loaded, which were removed or renamed"""
+        for file in set(self.entries) - self.seen:
+            del self.entries[file]
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        write_file_atomic(self.path, cPickle.dumps(self.entries, 2))
+        self.changed = False
+
+
+def load_conf_files(files, cache=None, workers=0, parallel_min=16):
+    """Parses config files, the ones missing from the ConfCache in a pool of
+    workers processes when there are at least parallel_min of them.  Returns
+    a list of (path, config, seconds, cached, error) in the order of files.
+    The cache is updated but not saved."""
+    results = {}
+    missing = []
+    for file in files:
+        t = time.time()
+        try:
+            stats = os.stat(file)
+        except OSError, e:
+            results[file] = (file, None, 0.0, False, str(e))
+            continue
+        conf = None
+        if cache is not None:
+            conf = cache.get(file, stats)
+        if conf is not None:
+            results[file] = (file, conf, time.time() - t, True, None)
+        else:
+            missing.append((file, stats))
+
+    parsed = None
+    if len(missing) >= parallel_min and workers != 1:
+        try:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers or None)
+            try:
+                parsed = pool.map(get_conf_dict_timed, [file for file, stats in missing],
+                                  max(1, len(missing) / (4 * (workers or multiprocessing.cpu_count()))))
+            finally:
+                pool.close()
+                pool.join()
+        except Exception:
+            parsed = None
+    if parsed is None:
+        parsed = [get_conf_dict_timed(file) for file, stats in missing]
+
+    for (file, stats), (path, conf, seconds, error) in zip(missing, parsed):
+        if cache is not None and conf is not None and error is None:
+            cache.put(file, stats, conf)
+        results[file] = (file, conf, seconds, False, error)
+    return [results[file] for file in files]
+
+
 def folder_contains_music(folder):
     files = os.listdir(folder)
     for file in files:
         filepath = os.path.join(folder, file)
         if os.path.isfile(filepath):
             mime_type = mimetypes.guess_type(filepath)[0]
-            if 'audio/mpeg' in mime_type or 'audio/ogg' in mime_type:
+            if mime_type and ('audio/mpeg' in mime_type or 'audio/ogg' in mime_type):
                 return True
     return False
+
+
+def write_file_atomic(path, data, compress=False):
+    """Writes data to a temporary file renamed over path, so that readers never
+    see a partial file.  If compress is True, a gzipped copy is written to
+    path.gz the same way, to be served directly by the web server."""
+    tmp = '%s.%d-%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+    f = open(tmp, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+    if compress:
+        f = open(tmp, 'wb')
+        try:
+            z = gzip.GzipFile('', 'wb', 9, f, 0)
+            z.write(data)
+            z.close()
+        finally:
+            f.close()
+        os.rename(tmp, path + '.gz')
@@ -0,0 +1,331 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2007-2009 Guillaume Pellerin <yomguy@parisson.com>
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution. The terms
+# are also available at http://svn.parisson.org/deefuzz/wiki/DefuzzLicense.
+#
+# Author: Guillaume Pellerin <yomguy@parisson.com>
+
+import os
+import time
+from threading import Lock
+from utils import *
+
+
+def media_extension_match(path, extension):
+    s = path.split('.')
+    return s[len(s) - 1].lower() == extension
+
+
+class LibraryWatch(object):
+    """The view of one station on a watched library: the files of its format
+    and the changes which happened since it last looked"""
+
+    def __init__(self, library, extension):
+        self.library = library
+        self.extension = extension
+        self.lock = Lock()
+        self.added = set()
+        self.removed = set()
+
+    def notify(self, path, added):
+        if not media_extension_match(path, self.extension):
+            return
+        with self.lock:
+            if added:
+                self.removed.discard(path)
+                self.added.add(path)
+            elif path in self.added:
+                self.added.discard(path)
+            else:
+                self.removed.add(path)
+
+    def get_files(self):
+        """Returns the sorted list of the current files and forgets the pending changes"""
+        with self.lock:
+            self.added = set()
+            self.removed = set()
+        return sorted(f for f in self.library.get_files() if media_extension_match(f, self.extension))
+
+    def get_changes(self):
+        """Returns the (added, removed) sets since the previous call"""
+        with self.lock:
+            added, removed = self.added, self.removed
+            self.added = set()
+            self.removed = set()
+        return added, removed
+
+    def close(self):
+        """Stops following the changes of the library"""
+        self.library.unsubscribe(self)
+
+
+class Library(object):
+    """The file set of a media folder, kept up to date by inotify events"""
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = Lock()
+        self.files = set()
+        self.watches = []
+
+    def scan(self, folder):
+        files = set()
+        for root, dirs, names in os.walk(folder):
+            for name in names:
+                files.add(os.path.join(root, name))
+        return files
+
+    def get_files(self):
+        with self.lock:
+            return list(self.files)
+
+    def subscribe(self, extension):
+        watch = LibraryWatch(self, extension)
+        with self.lock:
+            self.watches.append(watch)
+        return watch
+
+    def unsubscribe(self, watch):
+        with self.lock:
+            self.watches = [w for w in self.watches if w is not watch]
+
+    def _dispatch(self, paths, added):
+        with self.lock:
+            if added:
+                paths = paths - self.files
+                self.files |= paths
+            else:
+                paths = paths & self.files
+                self.files -= paths
+            watches = list(self.watches)
+        for path in paths:
+            for watch in watches:
+                watch.notify(path, added)
+
+    def add_path(self, path, is_dir=False):
+        if is_dir:
+            self._dispatch(self.scan(path), True)
+        else:
+            self._dispatch(set([path]), True)
+
+    def remove_path(self, path, is_dir=False):
+        if is_dir:
+            prefix = path.rstrip(os.sep) + os.sep
+            with self.lock:
+                paths = set(f for f in self.files if f.startswith(prefix))
+            self._dispatch(paths, False)
+        else:
+            self._dispatch(set([path]), False)
+
+    def rescan(self):
+        """Synchronizes the file set with the disk, initially and after an inotify queue overflow"""
+        files = self.scan(self.root)
+        with self.lock:
+            current = set(self.files)
+        self._dispatch(files - current, True)
+        self._dispatch(current - files, False)
+
+
+class LibraryWatcher(object):
+    """A single inotify thread watching all the media libraries of the process.
+
+    Requires pyinotify, Linux only."""
+
+    def __init__(self):
+        import pyinotify
+
+        self.pyinotify = pyinotify
+        self.mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE | \
+            pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM
+        self.lock = Lock()
+        self.libraries = {}
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(self.wm, self.process_overflow)
+        self.notifier.setDaemon(True)
+        self.notifier.start()
+
+    def process_overflow(self, event):
+        if event.mask & self.pyinotify.IN_Q_OVERFLOW:
+            for library in self.libraries.values():
+                library.rescan()
+
+    def process_event(self, library, event):
+        pyinotify = self.pyinotify
+        if event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+            library.remove_path(event.pathname, event.dir)
+        elif event.dir:
+            # New folders are watched by auto_add but their content was
+            # created (or moved) before the watch, so scan it
+            if event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO):
+                library.add_path(event.pathname, True)
+        elif event.mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO):
+            library.add_path(event.pathname)
+
+    def watch(self, root, extension):
+        """Returns a LibraryWatch on the files of the given extension under root"""
+        key = os.path.abspath(root)
+        with self.lock:
+            if key not in self.libraries:
+                library = Library(root)
+                self.wm.add_watch(root, self.mask, rec=True, auto_add=True,
+                                  proc_fun=lambda event: self.process_event(library, event))
+                # Scan once the watch is set so that no file is missed in between
+                library.rescan()
+                self.libraries[key] = library
+            return self.libraries[key].subscribe(extension)
+
+
+library_watcher = None
+library_watcher_lock = Lock()
+
+
+def watch_library(root, extension):
+    """Returns a LibraryWatch from the process wide LibraryWatcher, or None if
+    inotify is not available on this system"""
+    global library_watcher
+    with library_watcher_lock:
+        if library_watcher is None:
+            try:
+                library_watcher = LibraryWatcher()
+            except (ImportError, OSError):
+                return None
+    return library_watcher.watch(root, extension)
+
+
+class FolderScanner(object):
+    """Finds the subfolders of a folder which contain music, for the
+    stationfolder option.  A scan only looks again at the folders which
+    changed since the previous one: the folder itself when subfolders are
+    added, and the subfolders without music yet when files are added to
+    them.  The changes are told by inotify when pyinotify is available, by
+    the modification times of the folders otherwise."""
+
+    # Folders modified more recently may still change within the same mtime
+    # tick, so they are looked at again on the next scan
+    mtime_margin = 2
+
+    def __init__(self, root):
+        self.root = root
+        self.mtimes = {}
+        self.pending = set()
+        self.found = set()
+        self.lock = Lock()
+        self.dirty = set([root])
+        self.watches = {}
+        self.wm = None
+        self.notifier = None
+        try:
+            import pyinotify
+
+            self.pyinotify = pyinotify
+            self.wm = pyinotify.WatchManager()
+            self.notifier = pyinotify.ThreadedNotifier(self.wm, self.process_event)
+            self.notifier.setDaemon(True)
+            self.notifier.start()
+            self.watch(root)
+        except (ImportError, OSError):
+            self.wm = None
+
+    def process_event(self, event):
+        with self.lock:
+            if event.mask & self.pyinotify.IN_Q_OVERFLOW:
+                self.dirty.add(self.root)
+                self.dirty.update(self.pending)
+            else:
+                self.dirty.add(event.path)
+
+    def watch(self, folder):
+        mask = self.pyinotify.IN_CREATE | self.pyinotify.IN_MOVED_TO | self.pyinotify.IN_DELETE | \
+            self.pyinotify.IN_MOVED_FROM | self.pyinotify.IN_CLOSE_WRITE
+        wd = self.wm.add_watch(folder, mask).get(folder, -1)
+        if wd >= 0:
+            self.watches[folder] = wd
+
+    def unwatch(self, folder):
+        wd = self.watches.pop(folder, None)
+        if wd is not None:
+            try:
+                self.wm.rm_watch(wd, quiet=True)
+            except Exception:
+                pass
+
+    def changed(self, folder, dirty):
+        """Returns whether a folder has to be looked at again"""
+        if self.wm is not None and folder in self.watches:
+            return folder in dirty
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            return True
+        if self.mtimes.get(folder) == mtime:
+            return False
+        if time.time() - mtime > self.mtime_margin:
+            self.mtimes[folder] = mtime
+        else:
+            self.mtimes.pop(folder, None)
+        return True
+
+    def has_music(self, folder):
+        try:
+            return folder_contains_music(folder)
+        except OSError:
+            return False
+
+    def scan(self):
+        """Returns the subfolders in which music appeared since the previous scan"""
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+
+        if self.changed(self.root, dirty):
+            try:
+                names = os.listdir(self.root)
+            except OSError:
+                names = []
+            folders = set()
+            for name in names:
+                path = os.path.join(self.root, name)
+                if os.path.isdir(path):
+                    folders.add(path)
+            for folder in (self.pending | self.found) - folders:
+                # Removed, reported again if it comes back
+                self.unwatch(folder)
+                self.mtimes.pop(folder, None)
+            self.found &= folders
+            self.pending &= folders
+            new = folders - self.found - self.pending
+            self.pending |= new
+            dirty |= new
+
+        found = []
+        for folder in sorted(self.pending):
+            if not self.changed(folder, dirty):
+                continue
+            music = self.has_music(folder)
+            if not music and self.wm is not None and folder not in self.watches:
+                # Look again once watched, in case music came in between
+                self.watch(folder)
+                music = self.has_music(folder)
+            if music:
+                self.unwatch(folder)
+                self.mtimes.pop(folder, None)
+                self.pending.discard(folder)
+                self.found.add(folder)
+                found.append(folder)
+        return found
+
+    def close(self):
+        """Stops the inotify thread and closes its watches"""
+        if self.notifier is not None:
+            try:
+                self.notifier.stop()
+            except Exception:
+                pass
+            self.notifier = None
+        self.wm = None
+        self.watches = {}
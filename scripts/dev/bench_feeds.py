@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Feed build time against playlist size: the former full PyRSS2Gen
+# rendering compared to the cached FeedBuilder (first and next builds).
+#
+# Usage: bench_feeds.py [size ...]
+
+import os
+import sys
+import time
+import json
+import shutil
+import datetime
+import tempfile
+from deefuzzer.feeds import FeedBuilder
+from deefuzzer.tools import *
+
+
+def make_media(folder, size):
+    medias = []
+    for i in range(size):
+        path = os.path.join(folder, 'track_%05d.mp3' % i)
+        open(path, 'w').close()
+        row = {'format': 'MP3', 'mime_type': 'audio/mpeg', 'extension': 'mp3',
+               'description': 'MPEG audio Layer III', 'bitrate': 192,
+               'length': 180 + i % 120, 'size': 4000000 + i,
+               'metadata': {'title': u'Title %d' % i, 'artist': u'Artist %d' % (i % 50),
+                            'album': u'Album %d' % (i % 200), 'genre': u'Funk',
+                            'date': u'2014', 'comment': u'', 'copyright': u''}}
+        medias.append(IndexedMedia(path, row))
+    return medias
+
+
+def legacy_build(medias, title):
+    """The feed rendering before FeedBuilder: the whole document through PyRSS2Gen"""
+    _date_now = datetime.datetime.now()
+    media_absolute_playtime = _date_now
+    rss_item_list = []
+    json_data = []
+    for media in medias:
+        json_item = {}
+        media_stats = os.stat(media.media)
+        media_date = time.localtime(media_stats[8])
+        media_date = time.strftime("%a, %d %b %Y %H:%M:%S +0200", media_date)
+        media.metadata['Duration'] = str(media.length).split('.')[0]
+        media.metadata['Bitrate'] = str(media.bitrate) + ' kbps'
+        media.metadata['StartTime'] = str(media_absolute_playtime).split('.')[0]
+        media.metadata['EndTime'] = str(media_absolute_playtime + media.length).split('.')[0]
+        media_description = '<table>'
+        for key in media.metadata.keys():
+            if media.metadata[key] != '':
+                media_description += '<tr><td>%s:   </td><td><b>%s</b></td></tr>' % \
+                    (key.capitalize(), media.metadata[key])
+                json_item[key] = media.metadata[key]
+        media_description += '</table>'
+        media_absolute_playtime += media.length
+        media_link = u'http://localhost/rss/metadata/' + media.file_name + '.xml'
+        rss_item_list.append(RSSItem(title=media.get_song(True), link=media_link,
+                                     description=media_description, guid=Guid(media_link),
+                                     pubDate=media_date, ))
+        json_data.append(json_item)
+    rss = RSS2(title=title, link='http://localhost', description=u'Benchmark',
+               lastBuildDate=str(_date_now), items=rss_item_list, )
+    return rss.to_xml('utf-8'), json.dumps(json_data, separators=(',', ':'))
+
+
+def timed(func, *args):
+    t = time.time()
+    func(*args)
+    return (time.time() - t) * 1000
+
+
+def main():
+    sizes = [int(s) for s in sys.argv[1:]] or [100, 1000, 5000, 20000]
+    folder = tempfile.mkdtemp()
+    try:
+        print '%8s %12s %12s %12s' % ('tracks', 'legacy (ms)', 'first (ms)', 'next (ms)')
+        for size in sizes:
+            medias = make_media(folder, size)
+            builder = FeedBuilder('http://localhost', 'Benchmark', 'http://localhost/media/',
+                                  'http://localhost/rss/metadata')
+            legacy = timed(legacy_build, medias, 'Benchmark (playlist)')
+            first = timed(builder.build, medias, 'Benchmark (playlist)')
+            medias.append(medias.pop(0))
+            cached = timed(builder.build, medias, 'Benchmark (playlist)')
+            print '%8d %12.1f %12.1f %12.1f' % (size, legacy, first, cached)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Player chunk generators compared: throughput, bytes copied into new
+# Python objects and peak memory growth, each mode in a forked process.
+# The chunks are written to /dev/null like the Recorder would do.
+# The RSS of the mmap mode counts the mapped page cache, which is shared
+# between the processes and not allocated by Python.
+#
+# Usage: bench_player.py [size_in_MiB] [rounds]
+
+import os
+import sys
+import time
+import tempfile
+import resource
+from deefuzzer.player import Player
+
+MODES = ['file_read_slow', 'file_read_fast', 'file_read_mmap']
+
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_mode(path, mode, rounds):
+    player = Player()
+    sink = open(os.devnull, 'w')
+    rss = max_rss()
+    copied = 0
+    chunks = 0
+    t = time.time()
+    for i in range(rounds):
+        player.set_media(path)
+        for chunk in getattr(player, mode)():
+            if isinstance(chunk, str):
+                copied += len(chunk)
+            chunks += 1
+            sink.write(chunk)
+    t = time.time() - t
+    sink.close()
+    return t, chunks, copied, max_rss() - rss
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    fd, path = tempfile.mkstemp(suffix='.mp3')
+    block = os.urandom(0x100000)
+    for i in range(size):
+        os.write(fd, block)
+    os.close(fd)
+    # Warm the page cache so that all the modes read from memory
+    open(path, 'rb').read()
+
+    total = size * rounds
+    print '%d MiB x %d rounds' % (size, rounds)
+    print '%-16s %10s %8s %12s %12s' % ('mode', 'MiB/s', 'chunks', 'copied MiB', 'peak RSS KiB')
+    try:
+        for mode in MODES:
+            r, w = os.pipe()
+            pid = os.fork()
+            if not pid:
+                os.close(r)
+                os.write(w, repr(run_mode(path, mode, rounds)))
+                os._exit(0)
+            os.close(w)
+            result = os.read(r, 4096)
+            os.close(r)
+            os.waitpid(pid, 0)
+            t, chunks, copied, rss = eval(result)
+            print '%-16s %10.1f %8d %12.1f %12d' % (mode, total / t, chunks, copied / 1048576.0, rss)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
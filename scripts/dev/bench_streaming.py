@@ -0,0 +1,537 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# End to end streaming benchmark: a DeeFuzzer process runs N stations on
+# synthetic MP3 or Ogg libraries and streams them to a local Icecast
+# stand-in.
+#
+# The stand-in answers the SOURCE and PUT source requests, the metadata
+# updates and the availability checks, and timestamps the data it
+# receives.  The track boundaries are found in the received data (ID3 tags
+# and Ogg BOS pages of the synthetic files), so that the transition gaps
+# are measured like a listener would hear them.  The CPU and RSS of the
+# DeeFuzzer process tree are sampled from /proc (Linux only).
+#
+# The result is written as JSON.  Compare it with a previous run to catch
+# regressions, the exit status is 1 when a metric got worse than the
+# tolerance:
+#
+#   bench_streaming.py --stations 50 --output new.json --baseline old.json
+#   bench_streaming.py --compare old.json new.json
+
+import os
+import sys
+import json
+import math
+import time
+import struct
+import shutil
+import signal
+import socket
+import urlparse
+import argparse
+import platform
+import tempfile
+import subprocess
+import SocketServer
+from threading import Thread, Lock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+MP3_BITRATES = {32: 1, 40: 2, 48: 3, 56: 4, 64: 5, 80: 6, 96: 7, 112: 8,
+                128: 9, 160: 10, 192: 11, 224: 12, 256: 13, 320: 14}
+
+# Markers of the first bytes of a synthetic track in the stream
+TRACK_MARKERS = {'mp3': 'ID3', 'ogg': 'OggS\x00\x02'}
+
+# name: (higher is better, absolute slack)
+METRICS = [('streams_connected', True, 0),
+           ('cpu_percent_per_stream', False, 1.0),
+           ('rss_kib_per_stream', False, 512),
+           ('rate_ratio_min', True, 0.01),
+           ('jitter_ms_mean', False, 5),
+           ('transition_gap_ms_max', False, 20),
+           ('underrun_ms_total', False, 50), ]
+
+
+def make_mp3(path, title, seconds, bitrate):
+    """Writes a CBR MPEG-1 Layer III file of silent frames with an ID3 tag"""
+    from mutagen.id3 import ID3, TIT2, TPE1
+
+    samplerate = 44100
+    frames = int(seconds * samplerate / 1152)
+    size = 144000 * bitrate / samplerate
+    remainder = 144000 * bitrate % samplerate
+    f = open(path, 'wb')
+    rest = 0
+    for i in range(frames):
+        rest += remainder
+        padding = 0
+        if rest >= samplerate:
+            rest -= samplerate
+            padding = 1
+        header = struct.pack('>BBBB', 0xff, 0xfb, MP3_BITRATES[bitrate] << 4 | padding << 1, 0x44)
+        f.write(header + '\x00' * (size + padding - 4))
+    f.close()
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=title))
+    tags.add(TPE1(encoding=3, text=u'DeeFuzzer benchmark'))
+    tags.save(path)
+
+
+def make_ogg(path, title, seconds, bitrate, serial):
+    """Writes an Ogg Vorbis file with valid headers and silent pages, at the
+    nominal bitrate.  It is enough for the metadata and the streaming, not
+    to be decoded"""
+    from mutagen.ogg import OggPage
+
+    samplerate = 44100
+    vendor = 'DeeFuzzer benchmark'
+    comments = ['TITLE=' + title.encode('utf-8'), 'ARTIST=DeeFuzzer benchmark']
+    info = struct.pack('<B6sIBIiiiBB', 1, 'vorbis', 0, 2, samplerate, 0, bitrate * 1000, 0, 0xb8, 1)
+    comment = '\x03vorbis' + struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments))
+    for c in comments:
+        comment += struct.pack('<I', len(c)) + c
+    comment += '\x01'
+    setup = '\x05vorbis' + '\x00' * 32
+
+    pages = []
+    page = OggPage()
+    page.packets = [info]
+    page.first = True
+    pages.append(page)
+    page = OggPage()
+    page.packets = [comment, setup]
+    pages.append(page)
+    page_time = 0.5
+    count = int(seconds / page_time)
+    for i in range(count):
+        page = OggPage()
+        page.packets = ['\x00' * (int(bitrate * 1000 / 8 * page_time) - 40)]
+        page.position = int((i + 1) * page_time * samplerate)
+        page.last = i == count - 1
+        pages.append(page)
+    f = open(path, 'wb')
+    for i, page in enumerate(pages):
+        page.serial = serial
+        page.sequence = i
+        f.write(page.write())
+    f.close()
+
+
+def make_library(folder, media_format, tracks, seconds, bitrate):
+    os.makedirs(folder)
+    for i in range(tracks):
+        path = os.path.join(folder, 'track_%03d.%s' % (i, media_format))
+        title = u'Benchmark track %d' % i
+        if media_format == 'mp3':
+            make_mp3(path, title, seconds, bitrate)
+        else:
+            make_ogg(path, title, seconds, bitrate, i + 1)
+
+
+class Mount(object):
+    """What the stand-in received on a mountpoint"""
+
+    def __init__(self, name, marker):
+        self.name = name
+        self.marker = marker
+        self.lock = Lock()
+        self.connections = 0
+        self.bytes = 0
+        self.chunks = []
+        self.titles = []
+
+    def receive(self, data, tail):
+        """Records a chunk, with the stream offsets of the tracks starting in it"""
+        t = time.time()
+        buf = tail + data
+        starts = []
+        i = buf.find(self.marker)
+        while i >= 0:
+            starts.append(self.bytes - len(tail) + i)
+            i = buf.find(self.marker, i + 1)
+        with self.lock:
+            self.chunks.append((t, self.bytes, len(data), starts))
+            self.bytes += len(data)
+        return buf[-(len(self.marker) - 1):]
+
+
+class IcecastHandler(SocketServer.BaseRequestHandler):
+
+    def read_request(self, data):
+        while '\r\n\r\n' not in data:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                return None, None, None, None
+            data += chunk
+        head, data = data.split('\r\n\r\n', 1)
+        lines = head.split('\r\n')
+        method, path = lines[0].split(' ')[:2]
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        return method, path, headers, data
+
+    def handle(self):
+        data = ''
+        while True:
+            method, path, headers, data = self.read_request(data)
+            if method is None:
+                return
+            if method == 'OPTIONS':
+                self.request.sendall('HTTP/1.1 200 OK\r\nAllow: GET, SOURCE, PUT\r\nContent-Length: 0\r\n\r\n')
+                continue
+            if method in ('SOURCE', 'PUT'):
+                if headers.get('expect', '').lower() == '100-continue':
+                    self.request.sendall('HTTP/1.1 100 Continue\r\n\r\n')
+                else:
+                    self.request.sendall('HTTP/1.0 200 OK\r\n\r\n')
+                self.receive(path, data)
+                return
+            url = urlparse.urlparse(path)
+            if url.path == '/admin/metadata':
+                query = urlparse.parse_qs(url.query)
+                mount = self.server.get_mount(query.get('mount', [''])[0])
+                with mount.lock:
+                    mount.titles.append((time.time(), query.get('song', [''])[0]))
+                self.request.sendall('HTTP/1.0 200 OK\r\nContent-Type: text/xml\r\n\r\n'
+                                     '<?xml version="1.0"?>\n<iceresponse><message>Metadata update '
+                                     'successful</message><return>1</return></iceresponse>\n')
+            else:
+                self.request.sendall('HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n\r\n'
+                                     '<html><body>DeeFuzzer benchmark</body></html>\n')
+            return
+
+    def receive(self, path, data):
+        mount = self.server.get_mount(path)
+        with mount.lock:
+            mount.connections += 1
+        tail = ''
+        while True:
+            if data:
+                tail = mount.receive(data, tail)
+            try:
+                data = self.request.recv(0x10000)
+            except socket.error:
+                return
+            if not data:
+                return
+
+
+class FakeIcecast(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """A local Icecast stand-in recording the source streams"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, media_format):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), IcecastHandler)
+        self.port = self.server_address[1]
+        self.marker = TRACK_MARKERS[media_format]
+        self.mounts = {}
+        self.mounts_lock = Lock()
+        self.thread = Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+
+    def get_mount(self, name):
+        with self.mounts_lock:
+            if name not in self.mounts:
+                self.mounts[name] = Mount(name, self.marker)
+            return self.mounts[name]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def mean(values):
+    if not values:
+        return 0.0
+    return sum(values) / float(len(values))
+
+
+def stddev(values):
+    if len(values) < 2:
+        return 0.0
+    m = mean(values)
+    return math.sqrt(sum((v - m) ** 2 for v in values) / (len(values) - 1))
+
+
+def stream_stats(mount, byterate, burst_gap=0.02):
+    """Replays the received chunks against a listener playing the stream
+    at its nominal rate from the first byte"""
+    with mount.lock:
+        chunks = list(mount.chunks)
+        titles = len(mount.titles)
+    stats = {'connections': mount.connections, 'bytes': mount.bytes, 'metadata_updates': titles,
+             'nominal_bytes_per_sec': byterate}
+    if len(chunks) < 2:
+        stats.update({'bytes_per_sec': 0.0, 'rate_ratio': 0.0, 'transitions': 0,
+                      'transition_gap_ms_mean': 0.0, 'transition_gap_ms_max': 0.0,
+                      'underruns': 0, 'underrun_ms': 0.0, 'jitter_ms': 0.0, 'drift_ms_per_min': 0.0})
+        return stats
+
+    t0 = chunks[0][0]
+    elapsed = chunks[-1][0] - t0
+    # The last chunk was sent ahead of its play time, only count the data
+    # whose play time was reached
+    played = max(1, chunks[-1][1])
+    stats['bytes_per_sec'] = played / elapsed if elapsed else 0.0
+    stats['rate_ratio'] = stats['bytes_per_sec'] / byterate
+
+    stalled = 0.0
+    gaps = []
+    underruns = []
+    bursts = []
+    previous = None
+    for t, offset, size, starts in chunks:
+        play_time = t0 + stalled + offset / float(byterate)
+        if t > play_time:
+            stall = t - play_time
+            stalled += stall
+        else:
+            stall = 0.0
+        if starts and offset:
+            gaps.append(stall)
+        elif stall:
+            underruns.append(stall)
+        if previous is None or t - previous > burst_gap:
+            bursts.append(t - offset / float(byterate))
+        previous = t
+
+    steps = [b - a for a, b in zip(bursts, bursts[1:])]
+    stats['transitions'] = len(gaps)
+    stats['transition_gap_ms_mean'] = mean(gaps) * 1000
+    stats['transition_gap_ms_max'] = max(gaps or [0.0]) * 1000
+    stats['underruns'] = len(underruns)
+    stats['underrun_ms'] = sum(underruns) * 1000
+    stats['jitter_ms'] = stddev(steps) * 1000
+    stats['drift_ms_per_min'] = (bursts[-1] - bursts[0]) / elapsed * 60000 if elapsed else 0.0
+    return stats
+
+
+def process_tree(pid):
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % name).read()
+        except IOError:
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    pids = [pid]
+    i = 0
+    while i < len(pids):
+        pids.extend(children.get(pids[i], []))
+        i += 1
+    return pids
+
+
+def sample_tree(pid):
+    """Returns the CPU time in seconds and the RSS in KiB of a process and
+    its children"""
+    cpu = 0
+    rss = 0
+    for p in process_tree(pid):
+        try:
+            fields = open('/proc/%d/stat' % p).read().rsplit(')', 1)[1].split()
+            cpu += int(fields[11]) + int(fields[12])
+            for line in open('/proc/%d/status' % p):
+                if line.startswith('VmRSS:'):
+                    rss += int(line.split()[1])
+        except (IOError, IndexError, ValueError):
+            pass
+    return cpu / float(os.sysconf('SC_CLK_TCK')), rss
+
+
+def set_option(station, option):
+    """Applies a 'section.key=value' option to a station definition"""
+    key, value = option.split('=', 1)
+    path = key.split('.')
+    d = station
+    for k in path[:-1]:
+        d = d.setdefault(k, {})
+    d[path[-1]] = value
+
+
+def make_config(args, workdir, port):
+    library = os.path.join(workdir, 'library')
+    stations = []
+    for i in range(args.stations):
+        name = 'bench%d' % i
+        station = {'infos': {'short_name': name, 'name': 'Benchmark %d' % i, 'url': 'http://localhost',
+                             'genre': 'Benchmark', 'description': 'DeeFuzzer benchmark station'},
+                   'media': {'source': library, 'format': args.format, 'bitrate': args.bitrate,
+                             'ogg_quality': 4, 'samplerate': 44100, 'voices': '2', 'shuffle': 0},
+                   'server': {'host': '127.0.0.1', 'port': port, 'mountpoint': name,
+                              'sourcepassword': 'hackme', 'public': 0, 'type': 'icecast',
+                              'appendtype': 1},
+                   'feeds': {'dir': os.path.join(workdir, 'feeds', name), 'mode': 1, 'rss': 1,
+                             'json': 0, 'playlist': 0, 'enclosure': 0, 'media_url': ''}, }
+        for option in args.set:
+            set_option(station, option)
+        stations.append(station)
+    conf = {'deefuzzer': {'log': os.path.join(workdir, 'log', 'deefuzzer.log'),
+                          'm3u': os.path.join(workdir, 'deefuzzer.m3u'),
+                          'processes': args.processes,
+                          'engine': {'mode': args.engine},
+                          'station': stations}}
+    path = os.path.join(workdir, 'deefuzzer.json')
+    f = open(path, 'w')
+    json.dump(conf, f, indent=2)
+    f.close()
+    return path
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='deefuzzer-bench-')
+    server = FakeIcecast(args.format)
+    process = None
+    try:
+        make_library(os.path.join(workdir, 'library'), args.format, args.tracks, args.track_length, args.bitrate)
+        conf = make_config(args, workdir, server.port)
+        server.start()
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+        output = open(os.path.join(workdir, 'output.txt'), 'w')
+        started = time.time()
+        process = subprocess.Popen([sys.executable, os.path.join(ROOT, 'scripts', 'deefuzzer'), conf],
+                                   env=env, stdout=output, stderr=subprocess.STDOUT)
+
+        time.sleep(args.warmup)
+        cpu_start, rss = sample_tree(process.pid)
+        t_start = time.time()
+        rss_samples = [rss]
+        while time.time() - started < args.warmup + args.duration and process.poll() is None:
+            time.sleep(1)
+            rss_samples.append(sample_tree(process.pid)[1])
+        cpu_end, rss = sample_tree(process.pid)
+        t_end = time.time()
+        exit_code = process.poll()
+    finally:
+        if process is not None and process.poll() is None:
+            for pid in reversed(process_tree(process.pid)):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            process.wait()
+        server.stop()
+
+    byterate = args.bitrate * 1000 / 8.0
+    streams = {}
+    for i in range(args.stations):
+        mount = server.get_mount('/bench%d.%s' % (i, args.format))
+        streams[mount.name] = stream_stats(mount, byterate)
+    values = streams.values()
+    connected = [s for s in values if s['bytes']]
+    cpu_percent = (cpu_end - cpu_start) / (t_end - t_start) * 100 if t_end > t_start else 0.0
+    summary = {'streams': args.stations,
+               'streams_connected': len(connected),
+               'cpu_percent': cpu_percent,
+               'cpu_percent_per_stream': cpu_percent / args.stations,
+               'rss_kib': max(rss_samples),
+               'rss_kib_per_stream': max(rss_samples) / float(args.stations),
+               'rate_ratio_min': min(s['rate_ratio'] for s in values) if values else 0.0,
+               'rate_ratio_mean': mean([s['rate_ratio'] for s in values]),
+               'jitter_ms_mean': mean([s['jitter_ms'] for s in connected]),
+               'jitter_ms_max': max([s['jitter_ms'] for s in connected] or [0.0]),
+               'transition_gap_ms_mean': mean([s['transition_gap_ms_mean'] for s in connected]),
+               'transition_gap_ms_max': max([s['transition_gap_ms_max'] for s in connected] or [0.0]),
+               'underrun_ms_total': sum(s['underrun_ms'] for s in values), }
+
+    result = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': {'system': platform.system(), 'machine': platform.machine(),
+                       'python': platform.python_version(), 'cpus': os.sysconf('SC_NPROCESSORS_ONLN')},
+              'params': {'stations': args.stations, 'format': args.format, 'bitrate': args.bitrate,
+                         'tracks': args.tracks, 'track_length': args.track_length,
+                         'duration': args.duration, 'warmup': args.warmup, 'engine': args.engine,
+                         'processes': args.processes, 'set': args.set},
+              'exit_code': exit_code,
+              'summary': summary,
+              'streams': streams}
+    if args.keep:
+        result['workdir'] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def compare(old, new, tolerance):
+    """Prints the summary metrics of two results and returns the list of
+    the ones which got worse than the tolerance"""
+    regressions = []
+    if old.get('params') != new.get('params'):
+        print >> sys.stderr, 'warning: the results were run with different parameters'
+    print >> sys.stderr, '%-24s %12s %12s' % ('metric', 'baseline', 'current')
+    for name, higher, slack in METRICS:
+        a = old['summary'].get(name)
+        b = new['summary'].get(name)
+        if a is None or b is None:
+            continue
+        if higher:
+            worse = b < a * (1 - tolerance) - slack
+        else:
+            worse = b > a * (1 + tolerance) + slack
+        print >> sys.stderr, '%-24s %12.3f %12.3f%s' % (name, a, b, '  REGRESSION' if worse else '')
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def load(path):
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DeeFuzzer end to end streaming benchmark')
+    parser.add_argument('--stations', type=int, default=10)
+    parser.add_argument('--format', choices=['mp3', 'ogg'], default='mp3')
+    parser.add_argument('--bitrate', type=int, choices=sorted(MP3_BITRATES), default=128)
+    parser.add_argument('--tracks', type=int, default=5, help='tracks in the synthetic library')
+    parser.add_argument('--track-length', type=float, default=15, help='seconds')
+    parser.add_argument('--duration', type=float, default=60, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=5, help='seconds before measuring CPU and RSS')
+    parser.add_argument('--engine', choices=['thread', 'loop'], default='thread')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--set', action='append', default=[], metavar='SECTION.KEY=VALUE',
+                        help='station option, e.g. media.zerocopy=1')
+    parser.add_argument('--output', help='JSON result file, stdout by default')
+    parser.add_argument('--baseline', help='previous JSON result to compare with')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='only compare two JSON results')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative, 0.1 by default')
+    parser.add_argument('--keep', action='store_true', help='keep the work folder and logs')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(load(args.compare[0]), load(args.compare[1]), args.tolerance) else 0)
+
+    result = run(args)
+    data = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        f = open(args.output, 'w')
+        f.write(data + '\n')
+        f.close()
+    else:
+        print data
+
+    if args.baseline:
+        sys.exit(1 if compare(load(args.baseline), result, args.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import liblo
+import sys
+
+# send all messages to port 1234 on the local machine
+try:
+    target = liblo.Address(1234)
+except liblo.AddressError, err:
+    sys.exit(err)
+
+# profile the station for the given number of seconds (10 by default)
+seconds = 10
+if len(sys.argv) > 1:
+    seconds = int(sys.argv[1])
+liblo.send(target, "/profile", seconds)
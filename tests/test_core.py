@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import Queue
+import shutil
+import tempfile
+import time
+import unittest
+
+from deefuzzer.core import DeeFuzzer
+
+
+def make_station(name, **sections):
+    station = {'infos': {'short_name': name, 'name': name.capitalize()},
+               'media': {'source': '/tmp', 'format': 'mp3', 'bitrate': 128, 'shuffle': 0},
+               'server': {'host': '127.0.0.1', 'port': 8000, 'mountpoint': name,
+                          'sourcepassword': 'hackme', 'type': 'icecast'},
+               'jingles': {'dir': '/tmp/jingles', 'mode': 0, 'shuffle': 0}}
+    for section, options in sections.items():
+        station.setdefault(section, {}).update(options)
+    return station
+
+
+class DeeFuzzerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.conf_file = os.path.join(self.folder, 'deefuzzer.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_conf(self, stations, **options):
+        options['log'] = os.path.join(self.folder, 'deefuzzer.log')
+        options['station'] = stations
+        f = open(self.conf_file, 'w')
+        json.dump({'deefuzzer': options}, f)
+        f.close()
+
+    def make_deefuzzer(self, stations, **options):
+        self.write_conf(stations, **options)
+        # The log messages stay in the queue
+        d = DeeFuzzer(self.conf_file, log_queue=Queue.Queue())
+        d.restart_timers = []
+        d.restart_seq = 0
+        return d
+
+
+class RestartBackoffTestCase(DeeFuzzerTestCase):
+
+    def test_delay_doubles_up_to_the_maximum(self):
+        d = self.make_deefuzzer([make_station('a')], maxretry=-1, restartdelay=1, restartmaxdelay=10)
+        d.station_settings[0]['station_start_time'] = time.time()
+        for retries, base in enumerate([1, 2, 4, 8, 10, 10], 1):
+            d.restart_timers = []
+            start = time.time()
+            d.station_exited(0)
+            self.assertEqual(d.station_settings[0]['retries'], retries)
+            delay = d.restart_timers[0][0] - start
+            self.assertTrue(0.5 * base - 0.1 <= delay <= 1.5 * base + 0.1, (retries, delay))
+
+    def test_retries_reset_after_a_long_run(self):
+        d = self.make_deefuzzer([make_station('a')], maxretry=-1, restartdelay=1)
+        d.station_settings[0]['station_start_time'] = time.time()
+        for i in range(3):
+            d.station_exited(0)
+        self.assertEqual(d.station_settings[0]['retries'], 3)
+        d.station_settings[0]['station_start_time'] = time.time() - d.restart_reset_time - 1
+        d.station_exited(0)
+        self.assertEqual(d.station_settings[0]['retries'], 1)
+
+    def test_stopped_after_max_retry(self):
+        d = self.make_deefuzzer([make_station('a')], maxretry=2)
+        d.station_settings[0]['station_start_time'] = time.time()
+        d.station_exited(0)
+        d.station_exited(0)
+        self.assertEqual(len(d.restart_timers), 2)
+        d.station_exited(0)
+        self.assertEqual(len(d.restart_timers), 2)
+        self.assertTrue(d.station_settings[0]['station_stopped'])
+
+    def test_timers_are_ordered_by_time(self):
+        d = self.make_deefuzzer([make_station('a'), make_station('b')], maxretry=-1)
+        d.schedule_start(0, 5)
+        d.schedule_start(1, 1)
+        self.assertEqual(d.restart_timers[0][2], 1)
+        d.drop_timers(1)
+        self.assertEqual([timer[2] for timer in d.restart_timers], [0])
+
+
+class LiveChangeTestCase(DeeFuzzerTestCase):
+
+    def setUp(self):
+        DeeFuzzerTestCase.setUp(self)
+        self.d = self.make_deefuzzer([])
+
+    def test_live_sections(self):
+        old = make_station('a')
+        self.assertTrue(self.d.is_live_change(old, make_station('a', jingles={'mode': 1})))
+        self.assertTrue(self.d.is_live_change(old, make_station('a', feeds={'json': 1})))
+        self.assertTrue(self.d.is_live_change(old, make_station('a', media={'shuffle': 1})))
+
+    def test_restart_sections(self):
+        old = make_station('a')
+        self.assertFalse(self.d.is_live_change(old, make_station('a', media={'bitrate': 96})))
+        self.assertFalse(self.d.is_live_change(old, make_station('a', server={'port': 8001})))
+        self.assertFalse(self.d.is_live_change(old, make_station('a', record={'mode': 1})))
+
+    def test_stream_m_restarts(self):
+        old = make_station('a', server={'type': 'stream-m'})
+        new = make_station('a', server={'type': 'stream-m'}, jingles={'mode': 1})
+        self.assertFalse(self.d.is_live_change(old, new))
+
+
+class ReloadTestCase(DeeFuzzerTestCase):
+
+    def test_diff_classification(self):
+        d = self.make_deefuzzer([make_station('same'), make_station('live'), make_station('changed'),
+                                 make_station('removed')])
+        calls = []
+        d.reconfigure_station = lambda i, definition, defaults: calls.append(('reconfigure', i))
+        d.replace_station = lambda i, definition: calls.append(('replace', i))
+        d.remove_station = lambda i: calls.append(('remove', i))
+        self.write_conf([make_station('added'), make_station('same'), make_station('live', jingles={'mode': 1}),
+                         make_station('changed', media={'bitrate': 96})])
+        d.reload()
+        self.assertEqual(sorted(calls), [('reconfigure', 1), ('remove', 3), ('replace', 2)])
+        self.assertEqual(len(d.station_settings), 5)
+        self.assertEqual(d.station_settings[4]['infos']['short_name'], 'added')
+
+    def test_unchanged_reload(self):
+        stations = [make_station('a'), make_station('b')]
+        d = self.make_deefuzzer(stations)
+        calls = []
+        d.reconfigure_station = d.replace_station = d.remove_station = lambda *args: calls.append(args)
+        d.reload()
+        self.assertEqual(calls, [])
+        self.assertEqual(len(d.station_settings), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
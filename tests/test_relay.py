@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from deefuzzer.relay import RingBuffer
+
+
+class RingBufferTestCase(unittest.TestCase):
+
+    def test_read_write(self):
+        ring = RingBuffer(10)
+        ring.write('ABCDEF')
+        self.assertEqual(str(ring.read(4)), 'ABCD')
+        self.assertEqual(str(ring.read(4)), 'EF')
+
+    def test_drop_oldest(self):
+        ring = RingBuffer(10, 'drop')
+        ring.write('ABCDEFGH')
+        ring.write('1234')
+        self.assertEqual(ring.dropped, 2)
+        self.assertEqual(str(ring.read(10)), 'CDEFGH12')
+        self.assertEqual(str(ring.read(10)), '34')
+
+    def test_drop_keeps_held_chunk(self):
+        ring = RingBuffer(10, 'drop')
+        ring.write('ABCDEFGH')
+        chunk = ring.read(4)
+        ring.write('123456')
+        # The chunk read is not overwritten before the next read
+        self.assertEqual(str(chunk), 'ABCD')
+        self.assertEqual(ring.dropped, 4)
+        self.assertEqual(str(ring.read(10)), '123456')
+
+    def test_drop_chunk_larger_than_ring(self):
+        ring = RingBuffer(10, 'drop')
+        ring.write('ABCD')
+        chunk = ring.read(2)
+        ring.write('0123456789')
+        self.assertEqual(str(chunk), 'AB')
+        self.assertEqual(str(ring.read(10)), '23456789')
+
+    def test_read_without_blocking(self):
+        ring = RingBuffer(10)
+        self.assertEqual(ring.read(4, False), None)
+        ring.write('AB')
+        self.assertEqual(str(ring.read(4, False)), 'AB')
+        ring.close()
+        self.assertEqual(ring.read(4, False), '')
+
+    def test_close(self):
+        ring = RingBuffer(10)
+        ring.write('AB')
+        ring.close()
+        self.assertEqual(str(ring.read(10)), 'AB')
+        self.assertEqual(ring.read(10), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
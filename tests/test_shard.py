@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from deefuzzer.shard import station_key, shard_owner
+
+
+def make_stations(names):
+    return [{'server': {'mountpoint': name}} for name in names]
+
+
+class ShardOwnerTestCase(unittest.TestCase):
+
+    shards = [0, 1, 2, 3]
+
+    def owners(self, stations, shards=None):
+        shards = shards or self.shards
+        return dict((station_key(i, s), shard_owner(station_key(i, s), shards))
+                    for i, s in enumerate(stations))
+
+    def test_all_shards_used(self):
+        owners = self.owners(make_stations(['s%d' % i for i in range(100)]))
+        self.assertEqual(set(owners.values()), set(self.shards))
+
+    def test_stable_when_a_station_is_added(self):
+        names = ['s%d' % i for i in range(100)]
+        before = self.owners(make_stations(names))
+        # Inserted first, so that the indexes of all the others change
+        after = self.owners(make_stations(['new'] + names))
+        del after['new']
+        self.assertEqual(before, after)
+
+    def test_stable_when_a_station_is_removed(self):
+        names = ['s%d' % i for i in range(100)]
+        before = self.owners(make_stations(names))
+        after = self.owners(make_stations(names[:10] + names[11:]))
+        del before['s10']
+        self.assertEqual(before, after)
+
+    def test_retired_shard_only_moves_its_stations(self):
+        stations = make_stations(['s%d' % i for i in range(100)])
+        before = self.owners(stations)
+        after = self.owners(stations, [0, 1, 3])
+        for key, shard in before.items():
+            if shard != 2:
+                self.assertEqual(after[key], shard)
+            else:
+                self.assertNotEqual(after[key], 2)
+
+    def test_key_falls_back_to_short_name_then_index(self):
+        self.assertEqual(station_key(3, {'server': {'mountpoint': 'm'}}), 'm')
+        self.assertEqual(station_key(3, {'infos': {'short_name': 'n'}}), 'n')
+        self.assertEqual(station_key(3, {}), '3')
+
+
+if __name__ == '__main__':
+    unittest.main()